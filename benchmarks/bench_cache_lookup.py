@@ -0,0 +1,96 @@
+"""
+Compares Cache.get against the previous string keyed probe loop.
+
+Usage: python benchmarks/bench_cache_lookup.py [--decisions N] [--lookups N]
+"""
+
+import argparse
+import ipaddress
+import random
+import timeit
+
+from pycrowdsec.cache import NETMASKS_BY_KEY_TYPE, Cache, item_to_string
+
+
+class ProbeLoopCache:
+    """
+    The dict backed cache which probes every netmask with a formatted key.
+    """
+
+    def __init__(self):
+        self.cache = {}
+
+    def insert(self, item, action):
+        self.cache[item_to_string(item)] = action
+
+    def get(self, item):
+        key = item_to_string(item)
+        key_parts = key.split("_")
+        key_type = key_parts[0]
+        if key_type == "normal":
+            return self.cache.get(key)
+        item_network_address = int(key_parts[-1])
+        for netmask in NETMASKS_BY_KEY_TYPE[key_type]:
+            resp = self.cache.get(f"{key_type}_{netmask}_{item_network_address & netmask}")
+            if resp:
+                return resp
+
+
+def random_ipv4(rng):
+    return str(ipaddress.IPv4Address(rng.getrandbits(32)))
+
+
+def random_ipv6(rng):
+    return str(ipaddress.IPv6Address(rng.getrandbits(128)))
+
+
+def build_decisions(rng, count):
+    """
+    Returns count decision values, like LAPI sends them: 80% plain IPv4 and IPv6 addresses,
+    10% IPv4 /24 and 10% IPv6 /64 ranges.
+    """
+    decisions = []
+    for i in range(count):
+        if i % 10 == 0:
+            decisions.append(str(ipaddress.ip_network(f"{random_ipv4(rng)}/24", strict=False)))
+        elif i % 10 == 1:
+            decisions.append(str(ipaddress.ip_network(f"{random_ipv6(rng)}/64", strict=False)))
+        elif i % 2:
+            decisions.append(random_ipv4(rng))
+        else:
+            decisions.append(random_ipv6(rng))
+    return decisions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--decisions", type=int, default=50_000)
+    parser.add_argument("--lookups", type=int, default=20_000)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    decisions = build_decisions(rng, args.decisions)
+    hits = [d.split("/")[0] for d in rng.sample(decisions, min(len(decisions), args.lookups))]
+    lookups = {
+        "ipv4 miss": [random_ipv4(rng) for _ in range(args.lookups)],
+        "ipv6 miss": [random_ipv6(rng) for _ in range(args.lookups)],
+        "hit": hits,
+    }
+
+    caches = {"probe loop": ProbeLoopCache(), "trie": Cache()}
+    for cache in caches.values():
+        for decision in decisions:
+            cache.insert(decision, "ban")
+
+    print(f"{args.decisions} decisions, {args.lookups} lookups per case, usec per lookup")
+    for case, items in lookups.items():
+        row = [f"{case:<10}"]
+        for name, cache in caches.items():
+            get = cache.get
+            elapsed = min(timeit.repeat(lambda: [get(i) for i in items], number=1, repeat=3))
+            row.append(f"{name}: {elapsed / len(items) * 1e6:7.2f}")
+        print("  ".join(row))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Reports the memory used per decision by the string keyed dict cache, Cache and Cache(compact=True).
+Build times are measured with tracemalloc running, which slows allocations down.
+
+Usage: python benchmarks/bench_cache_memory.py [--decisions N,N,...]
+"""
+
+import argparse
+import gc
+import random
+import time
+import tracemalloc
+
+from bench_cache_lookup import ProbeLoopCache, build_decisions
+
+from pycrowdsec.cache import Cache
+
+
+def measure(factory, decisions):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    cache = factory()
+    if isinstance(cache, ProbeLoopCache):
+        for decision in decisions:
+            cache.insert(decision, "ban")
+    else:
+        cache.insert_many((decision, "ban") for decision in decisions)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--decisions", default="10000,100000")
+    args = parser.parse_args()
+
+    factories = {
+        "string keyed dict": ProbeLoopCache,
+        "Cache": Cache,
+        "Cache(compact=True)": lambda: Cache(compact=True),
+    }
+    for count in map(int, args.decisions.split(",")):
+        decisions = build_decisions(random.Random(1), count)
+        print(f"{count} decisions")
+        for name, factory in factories.items():
+            size, elapsed = measure(factory, decisions)
+            print(f"  {name:<20} {size / count:8.1f} bytes/decision  built in {elapsed:6.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""
+Compares applying a startup delta to RedisCache one decision at a time with apply_delta.
+
+Usage: python benchmarks/bench_redis_apply.py [--decisions N] [--chunk-sizes N,N,...]
+"""
+
+import argparse
+import ipaddress
+import random
+import time
+
+from redislite import Redis
+
+from pycrowdsec.cache import RedisCache
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--decisions", type=int, default=60_000)
+    parser.add_argument("--chunk-sizes", default="100,1000,10000")
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    items = [str(ipaddress.IPv4Address(rng.getrandbits(32))) for _ in range(args.decisions)]
+    redis = Redis()
+
+    def run(name, apply):
+        redis.delete("pycrowdsec_cache")
+        start = time.perf_counter()
+        apply()
+        elapsed = time.perf_counter() - start
+        print(f"{name:<24} {elapsed:8.3f}s")
+
+    print(f"{args.decisions} decisions against redislite")
+    cache = RedisCache(redis)
+    run("insert per decision", lambda: [cache.insert(item, "ban") for item in items])
+    for chunk_size in map(int, args.chunk_sizes.split(",")):
+        cache = RedisCache(redis, chunk_size=chunk_size)
+        run(
+            f"apply_delta chunk={chunk_size}",
+            lambda: cache.apply_delta(new=((item, "ban") for item in items)),
+        )
+
+
+if __name__ == "__main__":
+    main()
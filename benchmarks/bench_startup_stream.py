@@ -0,0 +1,108 @@
+"""
+Compares loading a large startup response with resp.json() against decoding it as it is
+received, with json and with orjson, from a local fake LAPI.
+
+Usage: python benchmarks/bench_startup_stream.py [--decisions N] [--compact]
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pycrowdsec.decoding
+from bench_cache_lookup import build_decisions
+from pycrowdsec.client import StreamClient
+
+
+def build_body(count):
+    rng = random.Random(1)
+    return json.dumps(
+        {
+            "new": [
+                {
+                    "duration": "152h17m3.25s",
+                    "id": i,
+                    "origin": "CAPI",
+                    "scenario": "crowdsecurity/http-bad-user-agent",
+                    "scope": "Range" if "/" in value else "Ip",
+                    "type": "ban",
+                    "value": value,
+                }
+                for i, value in enumerate(build_decisions(rng, count))
+            ],
+            "deleted": None,
+        }
+    ).encode()
+
+
+def serve(body):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+def load_whole_body(client):
+    resp = client.session.get(f"{client.lapi_url}v1/decisions/stream", params={"startup": "true"})
+    client.startup = True
+    client.process_response(resp.json())
+
+
+def load_streamed(client):
+    client.cycle("true")
+
+
+def measure(load, url, compact):
+    """
+    Returns the wall time and the peak traced memory of a startup load, and the number of
+    loaded decisions.
+    """
+    client = StreamClient("abcd", lapi_url=url, compact_cache=compact)
+    start = time.perf_counter()
+    load(client)
+    elapsed = time.perf_counter() - start
+
+    client = StreamClient("abcd", lapi_url=url, compact_cache=compact)
+    tracemalloc.start()
+    load(client)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, len(client.cache)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--decisions", type=int, default=200_000)
+    parser.add_argument("--compact", action="store_true", help="use a compact cache")
+    args = parser.parse_args()
+
+    body = build_body(args.decisions)
+    url = serve(body)
+    print(f"{args.decisions} decisions, {len(body) / 2**20:.1f} MiB body")
+
+    orjson = pycrowdsec.decoding.orjson
+    cases = [("resp.json()", load_whole_body, None), ("streamed json", load_streamed, None)]
+    if orjson is not None:
+        cases.append(("streamed orjson", load_streamed, orjson))
+    for name, load, decoder in cases:
+        pycrowdsec.decoding.orjson = decoder
+        elapsed, peak, count = measure(load, url, args.compact)
+        print(f"{name:<16} {elapsed:6.2f} s  peak {peak / 2**20:7.1f} MiB  ({count} decisions)")
+
+
+if __name__ == "__main__":
+    main()
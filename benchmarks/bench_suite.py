@@ -0,0 +1,300 @@
+"""
+Measures the hot paths of the caches and of StreamClient, without network access:
+
+- item_to_key() and item_to_string() conversions,
+- lookups of IPv4 and IPv6 addresses, of addresses in ranges and of scoped strings, hit and
+  miss, in usec per lookup,
+- process_response() applying a startup response, in usec per decision,
+- get_all() exports, in usec per decision,
+- the memory used per decision, in bytes.
+
+for every backend, Cache, Cache(compact=True) and RedisCache against redislite, at every
+number of decisions. Results can be saved, and compared with the results of another commit:
+
+    git checkout main && python benchmarks/bench_suite.py --output main.json
+    git checkout my-branch && python benchmarks/bench_suite.py --compare main.json
+
+Usage: python benchmarks/bench_suite.py [--sizes N,N,...] [--backends memory,compact,redis]
+    [--lookups N] [--redis-lookups N] [--output FILE] [--compare FILE] [--load FILE]
+"""
+
+import argparse
+import datetime
+import gc
+import ipaddress
+import json
+import platform
+import random
+import subprocess
+import timeit
+import tracemalloc
+
+from pycrowdsec.cache import item_to_key, item_to_string
+from pycrowdsec.client import StreamClient
+
+BACKENDS = ("memory", "compact", "redis")
+
+# Decisions only use addresses below 224.0.0.0 and in 2001::/16, misses are looked up above
+# 240.0.0.0 and in 2a00::/16.
+IPV6_HIT_PREFIX = 0x2001 << 112
+IPV6_MISS_PREFIX = 0x2A00 << 112
+
+
+def random_ipv4(rng, miss=False):
+    first = rng.randrange(240, 256) if miss else rng.randrange(1, 224)
+    return str(ipaddress.IPv4Address((first << 24) | rng.getrandbits(24)))
+
+
+def random_ipv6(rng, miss=False):
+    prefix = IPV6_MISS_PREFIX if miss else IPV6_HIT_PREFIX
+    return str(ipaddress.IPv6Address(prefix | rng.getrandbits(112)))
+
+
+def build_decisions(rng, count):
+    """
+    Returns count decisions, like LAPI sends them: 40% IPv4 and 20% IPv6 addresses, 10% IPv4
+    /24 and 10% IPv6 /64 ranges, and 20% usernames.
+    """
+    decisions = []
+    for i in range(count):
+        kind = i % 10
+        if kind < 4:
+            scope, value = "Ip", random_ipv4(rng)
+        elif kind < 6:
+            scope, value = "Ip", random_ipv6(rng)
+        elif kind == 6:
+            scope, value = "Range", str(ipaddress.ip_network(f"{random_ipv4(rng)}/24", False))
+        elif kind == 7:
+            scope, value = "Range", str(ipaddress.ip_network(f"{random_ipv6(rng)}/64", False))
+        else:
+            scope, value = "Username", f"user{i}"
+        decisions.append(
+            {
+                "duration": "152h17m3.25s",
+                "id": i,
+                "origin": "CAPI",
+                "scenario": "crowdsecurity/http-bad-user-agent",
+                "scope": scope,
+                "type": "ban",
+                "value": value,
+            }
+        )
+    return decisions
+
+
+def address_in(rng, network):
+    network = ipaddress.ip_network(network)
+    host = rng.getrandbits(network.max_prefixlen - network.prefixlen)
+    return str(network.network_address + host)
+
+
+def build_lookups(rng, decisions, count):
+    """
+    Returns {case: [(item, scope)]} of count lookups per case. Ranges are hit by addresses
+    they contain, a miss on a range is an address miss.
+    """
+
+    def sample(values):
+        return [rng.choice(values) for _ in range(count)] if values else []
+
+    by_kind = {"ipv4": [], "ipv6": [], "range": [], "string": []}
+    for decision in decisions:
+        value = decision["value"]
+        if decision["scope"] == "Username":
+            by_kind["string"].append(value)
+        elif decision["scope"] == "Range":
+            by_kind["range"].append(value)
+        else:
+            by_kind["ipv6" if ":" in value else "ipv4"].append(value)
+    return {
+        "ipv4 hit": [(item, None) for item in sample(by_kind["ipv4"])],
+        "ipv4 miss": [(random_ipv4(rng, miss=True), None) for _ in range(count)],
+        "ipv6 hit": [(item, None) for item in sample(by_kind["ipv6"])],
+        "ipv6 miss": [(random_ipv6(rng, miss=True), None) for _ in range(count)],
+        "range hit": [(address_in(rng, item), None) for item in sample(by_kind["range"])],
+        "string hit": [(item, "username") for item in sample(by_kind["string"])],
+        "string miss": [(f"nobody{i}", "username") for i in range(count)],
+    }
+
+
+def startup_response(decisions):
+    # process_response() fills the missing keys in, every run gets its own response.
+    return {"new": list(decisions), "deleted": None}
+
+
+def new_client(backend, redis):
+    if backend == "redis":
+        redis.flushdb()
+        return StreamClient("abcd", redis_connection=redis)
+    return StreamClient("abcd", compact_cache=backend == "compact")
+
+
+def apply_startup(client, decisions):
+    client.startup = True
+    try:
+        client.process_response(startup_response(decisions))
+    finally:
+        client.startup = False
+
+
+def best_time(function, repeat=3):
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+class Suite:
+    def __init__(self, args):
+        self.args = args
+        self.results = {}
+
+    def record(self, name, value, unit):
+        self.results[name] = [value, unit]
+        print(f"{name:<48} {value:12.3f} {unit}", flush=True)
+
+    def run_conversions(self, rng):
+        items = {
+            "ipv4": [random_ipv4(rng) for _ in range(self.args.lookups)],
+            "ipv6": [random_ipv6(rng) for _ in range(self.args.lookups)],
+            "range": [f"{random_ipv4(rng)}/24" for _ in range(self.args.lookups)],
+            "string": [f"user{i}" for i in range(self.args.lookups)],
+        }
+        for function in (item_to_key, item_to_string):
+            for kind, values in items.items():
+                elapsed = best_time(lambda: [function(value) for value in values])
+                self.record(f"{function.__name__} {kind}", elapsed / len(values) * 1e6, "usec")
+
+    def run_backend(self, backend, size, decisions, lookups, redis):
+        prefix = f"{backend} {size}"
+        client = new_client(backend, redis)
+        # The first run warms up interning and allocations, it isn't timed.
+        apply_startup(client, decisions)
+        elapsed = best_time(lambda: apply_startup(client, decisions), repeat=2)
+        self.record(f"{prefix} process_response", elapsed / size * 1e6, "usec/decision")
+
+        get = client.cache.get
+        for case, items in lookups.items():
+            if backend == "redis":
+                items = items[: self.args.redis_lookups]
+            if not items:
+                continue
+            if (get(*items[0]) is None) == case.endswith("hit"):
+                raise RuntimeError(f"{prefix} lookup {case} got the wrong result")
+            elapsed = best_time(lambda: [get(item, scope) for item, scope in items])
+            self.record(f"{prefix} lookup {case}", elapsed / len(items) * 1e6, "usec")
+
+        elapsed = best_time(client.cache.get_all, repeat=2)
+        self.record(f"{prefix} get_all", elapsed / size * 1e6, "usec/decision")
+        del client, get
+        self.record(f"{prefix} memory", self.memory_per_decision(backend, decisions, redis), "B")
+
+    def memory_per_decision(self, backend, decisions, redis):
+        if backend == "redis":
+            redis.flushdb()
+            before = redis.info("memory")["used_memory"]
+            client = new_client(backend, redis)
+            apply_startup(client, decisions)
+            return (redis.info("memory")["used_memory"] - before) / len(decisions)
+        response = startup_response(decisions)
+        gc.collect()
+        tracemalloc.start()
+        client = new_client(backend, redis)
+        client.startup = True
+        client.process_response(response)
+        del response
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return size / len(decisions)
+
+    def run(self):
+        backends = self.args.backends.split(",")
+        redis = None
+        if "redis" in backends:
+            from redislite import Redis
+
+            redis = Redis()
+        rng = random.Random(1)
+        self.run_conversions(rng)
+        for size in map(int, self.args.sizes.split(",")):
+            decisions = build_decisions(rng, size)
+            lookups = build_lookups(rng, decisions, self.args.lookups)
+            for backend in backends:
+                self.run_backend(backend, size, decisions, lookups, redis)
+
+
+def git_revision():
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+        status = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return f"{revision}-dirty" if status.strip() else revision
+
+
+def compare(baseline, current, threshold):
+    """
+    Prints the results of current next to those of baseline. All results are lower is better,
+    those more than threshold percent above their baseline are flagged as regressions.
+    """
+    print(f"\n{baseline['revision']} -> {current['revision']}")
+    regressions = 0
+    for name, (value, unit) in current["results"].items():
+        if name not in baseline["results"]:
+            continue
+        old = baseline["results"][name][0]
+        change = (value - old) / old * 100 if old else 0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{name:<48} {old:12.3f} {value:12.3f} {unit:<14} {change:+7.1f}%{flag}")
+    print(f"{regressions} regressions over {threshold}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--sizes", default="1000,100000,1000000")
+    parser.add_argument("--backends", default=",".join(BACKENDS))
+    parser.add_argument("--lookups", type=int, default=20_000, help="lookups per case")
+    parser.add_argument(
+        "--redis-lookups", type=int, default=2_000, help="lookups per case against redis"
+    )
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--compare", help="compare the results with those of this JSON file")
+    parser.add_argument("--load", help="load the results from this JSON file instead of running")
+    parser.add_argument(
+        "--threshold", type=float, default=10, help="percentage flagged as a regression"
+    )
+    args = parser.parse_args()
+
+    if args.load:
+        with open(args.load) as f:
+            current = json.load(f)
+    else:
+        suite = Suite(args)
+        suite.run()
+        current = {
+            "revision": git_revision(),
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "results": suite.results,
+        }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), current, args.threshold)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+import asyncio
+import contextvars
+import logging
+import ssl
+
+import aiohttp
+
+from pycrowdsec.client import STREAM_CHUNK_SIZE, StreamClient, __version__
+from pycrowdsec.decoding import iter_decisions, loads
+from pycrowdsec.resilience import (
+    FAILURE_POLICIES,
+    CircuitBreaker,
+    CircuitOpenError,
+    apply_failure_policy,
+    backoff_delay,
+    is_transient,
+)
+from pycrowdsec.tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Errors of aiohttp which are worth retrying.
+TRANSIENT_ERRORS = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError)
+
+
+def client_timeout(timeout):
+    """
+    Returns the aiohttp timeout waiting at most timeout seconds to connect or to receive data.
+    """
+    return aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout)
+
+
+def create_async_session(
+    api_key, insecure_skip_verify, key_path, cert_path, ca_cert_path, user_agent, max_connections
+):
+    """
+    Returns an aiohttp session configured like the requests session of create_session(), keeping
+    at most max_connections connections to LAPI open.
+    """
+    headers = {"User-Agent": user_agent}
+    if api_key:
+        headers["X-Api-Key"] = api_key
+        ssl_context = ssl.create_default_context()
+    else:
+        ssl_context = ssl.create_default_context(cafile=ca_cert_path or None)
+        ssl_context.load_cert_chain(cert_path, key_path)
+    if insecure_skip_verify:
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+    connector = aiohttp.TCPConnector(limit=max_connections, ssl=ssl_context)
+    return aiohttp.ClientSession(headers=headers, connector=connector)
+
+
+class AsyncQueryClient:
+    def __init__(
+        self,
+        api_key="",
+        lapi_url="http://localhost:8080/",
+        user_agent=f"python-bouncer/{__version__}",
+        insecure_skip_verify=False,
+        key_path="",
+        cert_path="",
+        ca_cert_path="",
+        max_connections=100,
+        timeout=5,
+        deadline=None,
+        retries=2,
+        retry_backoff=0.1,
+        max_backoff=1,
+        breaker_threshold=5,
+        breaker_reset_timeout=30,
+        failure_policy="raise",
+        fail_closed_action="ban",
+    ):
+        """
+        Initializes a new instance of the asyncio CrowdSec API client. It must be used from a
+        running event loop, and closed with close() or by using it as an async context manager.
+
+        Failed queries are retried and LAPI is considered down after repeated failures like
+        with QueryClient.
+
+        Args:
+            api_key (str): The API key to use for authentication.
+            lapi_url (str): The URL of the local API server.
+            user_agent (str): The user agent string to use for requests.
+            insecure_skip_verify (bool): Whether to skip SSL verification.
+            key_path (str): The path to the client's private key file.
+            cert_path (str): The path to the client's certificate file.
+            ca_cert_path (str): The path to the CA certificate file.
+            max_connections (int): The maximum number of concurrent connections to LAPI.
+            timeout (float): The number of seconds to wait for each LAPI response.
+            deadline (float): The maximum number of seconds a lookup takes, including retries.
+                None for no limit besides timeout and retries.
+            retries (int): The maximum number of times a failed query is retried.
+            retry_backoff (float): The maximum delay in seconds before the first retry.
+            max_backoff (float): The maximum delay in seconds before any retry.
+            breaker_threshold (int): The number of consecutive failures after which LAPI is
+                considered down. None disables the circuit breaker.
+            breaker_reset_timeout (float): The number of seconds LAPI is considered down for,
+                before a query is tried again.
+            failure_policy (str): "raise", "open" or "closed".
+            fail_closed_action (str): The action of failed lookups with the "closed" policy.
+        """
+
+        if api_key == "" and key_path == "" and cert_path == "":
+            raise ValueError("You must provide an api_key or a key_path and cert_path")
+        if failure_policy not in FAILURE_POLICIES:
+            raise ValueError(f"failure_policy must be one of {', '.join(FAILURE_POLICIES)}")
+
+        self.lapi_url = lapi_url
+        self.session = create_async_session(
+            api_key,
+            insecure_skip_verify,
+            key_path,
+            cert_path,
+            ca_cert_path,
+            user_agent,
+            max_connections,
+        )
+        self.timeout = timeout
+        self.deadline = deadline
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.max_backoff = max_backoff
+        self.breaker = (
+            CircuitBreaker(breaker_threshold, breaker_reset_timeout) if breaker_threshold else None
+        )
+        self.failure_policy = failure_policy
+        self.fail_closed_action = fail_closed_action
+
+    async def get_decisions_for(self, item, timeout=None):
+        async with self.session.get(
+            f"{self.lapi_url}v1/decisions",
+            params={"ip": item},
+            timeout=client_timeout(timeout or self.timeout),
+        ) as resp:
+            resp.raise_for_status()
+            return loads(await resp.read())
+
+    async def query_action_for(self, item):
+        """
+        Returns the type of the latest decision for item from LAPI, retrying transient errors.
+        Raises CircuitOpenError without querying LAPI while it is considered down.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if self.deadline is None else loop.time() + self.deadline
+        attempt = 0
+        while True:
+            if self.breaker is not None and not self.breaker.allow():
+                raise CircuitOpenError("pycrowdsec LAPI is unavailable")
+            timeout = self.timeout
+            if deadline is not None:
+                timeout = min(timeout, max(deadline - loop.time(), 0.001))
+            try:
+                decisions = await self.get_decisions_for(item, timeout)
+            except Exception as e:
+                transient = is_transient(e, TRANSIENT_ERRORS)
+                if self.breaker is not None:
+                    # Other errors, eg 403, still mean that LAPI is up.
+                    if transient:
+                        self.breaker.record_failure()
+                    else:
+                        self.breaker.record_success()
+                if not transient or attempt >= self.retries:
+                    raise
+                delay = backoff_delay(attempt, self.retry_backoff, self.max_backoff)
+                if deadline is not None and loop.time() + delay >= deadline:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            if self.breaker is not None:
+                self.breaker.record_success()
+            if not decisions:
+                return None
+            return max(decisions, key=lambda d: d["id"])["type"]
+
+    async def get_action_for(self, item):
+        """
+        Returns the type of the latest decision for item, None if there is none. Applies
+        failure_policy if LAPI can't be queried.
+        """
+        try:
+            return await self.query_action_for(item)
+        except Exception as e:
+            return apply_failure_policy(self.failure_policy, e, self.fail_closed_action)
+
+    async def close(self):
+        await self.session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+class AsyncStreamClient(StreamClient):
+    """
+    StreamClient polling LAPI from a task of the running event loop, with the same arguments
+    and cache backends. run(), cycle() and stop() are coroutines.
+
+    Decoding responses and writing them to the cache happen in the default executor, so that
+    large startup responses and RedisCache writes don't block the event loop. Lookups are
+    synchronous, as they only read the cache.
+    """
+
+    transient_errors = TRANSIENT_ERRORS
+
+    def __post_init__(self, **kwargs):
+        super().__post_init__(**kwargs)
+        self.async_session = None
+        self.task = None
+
+    def get_async_session(self):
+        if self.async_session is None:
+            self.async_session = create_async_session(
+                self.api_key,
+                self.insecure_skip_verify,
+                self.key_path,
+                self.cert_path,
+                self.ca_cert_path,
+                self.user_agent,
+                max_connections=1,
+            )
+        return self.async_session
+
+    async def run_traced_in_executor(self, function, *args):
+        # Spans opened in the executor are children of the current one.
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(None, context.run, function, *args)
+
+    async def fetch(self):
+        loop = asyncio.get_running_loop()
+        url = f"{self.lapi_url}v1/decisions/stream"
+        params = self.stream_params()
+        if not self.startup:
+            with span(self.tracer, "pycrowdsec.fetch", streamed=False) as attributes:
+                async with self.get_async_session().get(
+                    url, params=params, timeout=client_timeout(self.timeout)
+                ) as resp:
+                    resp.raise_for_status()
+                    body = await resp.read()
+                attributes["bytes"] = len(body)
+            self.record_payload(len(body))
+            with span(self.tracer, "pycrowdsec.decode"):
+                response = await self.run_traced_in_executor(loads, body)
+            self.changed = bool(response.get("new") or response.get("deleted"))
+            counts = {key: len(response.get(key) or ()) for key in ("new", "deleted")}
+            self.record_decisions(counts)
+            with span(self.tracer, "pycrowdsec.process_response", **counts):
+                await self.run_traced_in_executor(self.process_response, response)
+            return
+
+        with span(self.tracer, "pycrowdsec.fetch", streamed=True):
+            resp = await self.get_async_session().get(
+                url, params=params, timeout=client_timeout(self.timeout)
+            )
+        async with resp:
+            resp.raise_for_status()
+
+            def chunks():
+                # Runs in the executor, reading the body from the event loop as it is decoded.
+                while True:
+                    chunk = asyncio.run_coroutine_threadsafe(
+                        resp.content.read(STREAM_CHUNK_SIZE), loop
+                    ).result()
+                    if not chunk:
+                        return
+                    yield chunk
+
+            decisions = self.count_decisions(iter_decisions(self.count_payload(chunks())))
+            with span(self.tracer, "pycrowdsec.process_decisions"):
+                await self.run_traced_in_executor(self.process_decisions, decisions)
+
+    async def cycle(self, first_time):
+        loop = asyncio.get_running_loop()
+        if not await loop.run_in_executor(None, self.before_cycle):
+            return
+        steps = self.cycle_steps(first_time)
+        try:
+            delay = next(steps)
+            while True:
+                if delay is not None:
+                    await asyncio.sleep(delay)
+                    delay = steps.send(None)
+                    continue
+                try:
+                    await loop.run_in_executor(None, self.check_leadership)
+                    await self.fetch()
+                except Exception as e:
+                    delay = steps.throw(e)
+                else:
+                    delay = steps.send(None)
+        except StopIteration:
+            pass
+        await loop.run_in_executor(None, self.after_cycle)
+
+    async def run(self):
+        """
+        Fetches the decisions, unless a snapshot was loaded, then starts polling in a task of the
+        running event loop.
+        """
+        if self.warm_start():
+            self.resync = True
+        else:
+            await self.cycle("true")  # So we catch errors on startup
+        self.loop = asyncio.get_running_loop()
+        self.async_wakeup = asyncio.Event()
+        self.task = self.loop.create_task(self.poll())
+
+    async def poll(self):
+        if self.resync:
+            await self.cycle("false")
+        while True:
+            try:
+                await asyncio.wait_for(self.async_wakeup.wait(), self.next_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.async_wakeup.clear()
+            await self.cycle("false")
+            self.update_interval()
+
+    def refresh_now(self):
+        """
+        Wakes the poller up to fetch the decisions right away. Can be called from any thread.
+        """
+        if self.is_running():
+            self.loop.call_soon_threadsafe(self.async_wakeup.set)
+
+    def is_running(self):
+        return self.task is not None and not self.task.done()
+
+    async def stop(self):
+        """
+        Stops polling, closes the connections to LAPI and gives the leadership up.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        await asyncio.get_running_loop().run_in_executor(None, StreamClient.stop, self)
+        if self.async_session is not None:
+            await self.async_session.close()
+            self.async_session = None
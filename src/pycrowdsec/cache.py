@@ -1,5 +1,16 @@
+import heapq
 import ipaddress
+import itertools
+import os
 import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from socket import AF_INET, AF_INET6, inet_pton
+from urllib.parse import unquote
+
+from pycrowdsec.intervals import IntervalTable, merge_prefixes
+from pycrowdsec.trie import PrefixTrie
 
 IPV4_NETMASKS = [int(ipaddress.ip_network(f"0.0.0.0/{i}").netmask) for i in range(32, -1, -1)]
 
@@ -7,106 +18,1225 @@ IPV6_NETMASKS = [int(ipaddress.ip_network(f"::/{i}").netmask) for i in range(128
 
 NETMASKS_BY_KEY_TYPE = {"ipv4": IPV4_NETMASKS, "ipv6": IPV6_NETMASKS}
 
+# Netmasks as integers, indexed by prefix length.
+NETMASKS_BY_VERSION = {4: IPV4_NETMASKS[::-1], 6: IPV6_NETMASKS[::-1]}
+
+ADDRESS_BITS = {4: 32, 6: 128}
+
+# (field prefix, netmask) of every prefix length, longest first.
+FIELD_PREFIXES = {
+    4: [(f"ipv4_{netmask}_", netmask) for netmask in IPV4_NETMASKS],
+    6: [(f"ipv6_{netmask}_", netmask) for netmask in IPV6_NETMASKS],
+}
+
+IP_NETWORK_BY_VERSION = {4: ipaddress.IPv4Network, 6: ipaddress.IPv6Network}
+
+# Scopes whose values are IP addresses or ranges.
+IP_SCOPES = {"ip", "range"}
+
+MISSING = object()
+
+# Details of IP keys inserted without details, which hide those of shorter prefixes.
+NO_DETAILS = object()
+
+EMPTY = {}
+
+# The prefix counts hash of RedisCache holds the number of stored IP fields per prefix, eg
+# "ipv4_4294967295", along with a "complete" field once it accounts for every stored field.
+# Lua pattern of that prefix in a field.
+PREFIX_PATTERN = "^(ipv[46]_%d+)_"
+
+# Sets the KEYS[1] hash fields and values given as ARGV pairs, counting the new IP fields in the
+# KEYS[2] prefix counts hash.
+SET_SCRIPT = f"""
+for i = 1, #ARGV, 2 do
+    if redis.call("HSET", KEYS[1], ARGV[i], ARGV[i + 1]) == 1 then
+        local prefix = string.match(ARGV[i], "{PREFIX_PATTERN}")
+        if prefix then
+            redis.call("HINCRBY", KEYS[2], prefix, 1)
+        end
+    end
+end
+"""
+
+# Deletes the KEYS[1] hash fields given as ARGV, uncounting the deleted IP fields from the KEYS[2]
+# prefix counts hash.
+DELETE_SCRIPT = f"""
+for i = 1, #ARGV do
+    if redis.call("HDEL", KEYS[1], ARGV[i]) == 1 then
+        local prefix = string.match(ARGV[i], "{PREFIX_PATTERN}")
+        if prefix and redis.call("HINCRBY", KEYS[2], prefix, -1) <= 0 then
+            redis.call("HDEL", KEYS[2], prefix)
+        end
+    end
+end
+"""
+
+# Counts every IP field of the KEYS[1] hash in the KEYS[2] prefix counts hash, unless that was
+# already done. Needed once for caches written by versions which didn't count prefixes.
+COUNT_PREFIXES_SCRIPT = f"""
+if redis.call("HEXISTS", KEYS[2], "complete") == 1 then
+    return 0
+end
+redis.call("DEL", KEYS[2])
+for _, field in ipairs(redis.call("HKEYS", KEYS[1])) do
+    local prefix = string.match(field, "{PREFIX_PATTERN}")
+    if prefix then
+        redis.call("HINCRBY", KEYS[2], prefix, 1)
+    end
+end
+redis.call("HSET", KEYS[2], "complete", 1)
+return 1
+"""
+
+# Deletes at most ARGV[2] fields of the KEYS[1] hash whose score in the KEYS[2] sorted set is
+# lower than ARGV[1], uncounting them from the KEYS[4] prefix counts hash, and increments the
+# KEYS[3] generation counter if it deleted any.
+EXPIRE_SCRIPT = f"""
+local fields = redis.call("ZRANGEBYSCORE", KEYS[2], "-inf", ARGV[1], "LIMIT", 0, ARGV[2])
+for _, field in ipairs(fields) do
+    if redis.call("HDEL", KEYS[1], field) == 1 then
+        local prefix = string.match(field, "{PREFIX_PATTERN}")
+        if prefix and redis.call("HINCRBY", KEYS[4], prefix, -1) <= 0 then
+            redis.call("HDEL", KEYS[4], prefix)
+        end
+    end
+end
+if #fields > 0 then
+    redis.call("ZREM", KEYS[2], unpack(fields))
+    redis.call("INCR", KEYS[3])
+end
+return #fields
+"""
+
+# Sets the KEYS[1] hash fields given as ARGV (field, action, deadline) triples, after the
+# ARGV[1] actions of ARGV[2:] by decreasing priority, unless the stored action of a field
+# outranks() the new one. Deadlines are kept in the KEYS[3] sorted set, an empty deadline means
+# none, and new IP fields are counted in the KEYS[2] prefix counts hash.
+MERGE_SCRIPT = f"""
+local count = tonumber(ARGV[1])
+local ranks = {{}}
+for i = 1, count do
+    ranks[ARGV[i + 1]] = i
+end
+for i = count + 2, #ARGV, 3 do
+    local field, action, deadline = ARGV[i], ARGV[i + 1], ARGV[i + 2]
+    local current = redis.call("HGET", KEYS[1], field)
+    local keep = false
+    if current then
+        local rank, current_rank = ranks[action] or count + 1, ranks[current] or count + 1
+        if rank ~= current_rank then
+            keep = rank > current_rank
+        elseif action == current then
+            local current_deadline = redis.call("ZSCORE", KEYS[3], field)
+            keep = not current_deadline
+                or (deadline ~= "" and tonumber(deadline) < tonumber(current_deadline))
+        end
+    end
+    if not keep then
+        if redis.call("HSET", KEYS[1], field, action) == 1 then
+            local prefix = string.match(field, "{PREFIX_PATTERN}")
+            if prefix then
+                redis.call("HINCRBY", KEYS[2], prefix, 1)
+            end
+        end
+        if deadline == "" then
+            redis.call("ZREM", KEYS[3], field)
+        else
+            redis.call("ZADD", KEYS[3], deadline, field)
+        end
+    end
+end
+"""
+
+
+# Replaces every KEYS[i] key by the KEYS[count + i] staging key, count being (#KEYS - 1) / 2. A
+# staging key which doesn't exist deletes its counterpart, and replaced keys are freed in the
+# background. Then increments the KEYS[#KEYS] generation counter and returns it.
+SWAP_SCRIPT = """
+local count = (#KEYS - 1) / 2
+for i = 1, count do
+    redis.call("UNLINK", KEYS[i])
+    if redis.call("EXISTS", KEYS[count + i]) == 1 then
+        redis.call("RENAME", KEYS[count + i], KEYS[i])
+        redis.call("PERSIST", KEYS[i])
+    end
+end
+return redis.call("INCR", KEYS[#KEYS])
+"""
+
+# Keys of the decisions of RedisCache, which replaces swap whole.
+REDIS_KEYS = (
+    "pycrowdsec_cache",
+    "pycrowdsec_cache_prefixes",
+    "pycrowdsec_cache_expiry",
+    "pycrowdsec_cache_scopes",
+)
+
+# Number of seconds the staging keys of an interrupted replace are kept for.
+STAGING_TTL = 600
+
+
+def outranks(ranks, action, deadline, current_action, current_deadline):
+    """
+    Returns whether a decision for an item takes precedence over the current one. The action
+    with the lowest rank in ranks wins, actions missing from ranks come after the others, and
+    of two decisions with the same action the one lasting the longest wins. A deadline of None
+    never passes. Otherwise the new decision wins.
+    """
+    rank = ranks.get(action, len(ranks))
+    current_rank = ranks.get(current_action, len(ranks))
+    if rank != current_rank:
+        return rank < current_rank
+    if action != current_action:
+        return True
+    return current_deadline is not None and (deadline is None or deadline >= current_deadline)
+
 
-def item_to_string(item):
+def entry_deadline(entry):
+    return entry[2] if len(entry) > 2 else None
+
+
+def coalesce_entries(entries, ranks):
+    """
+    Returns the entries of an apply_delta() new argument, keeping only the one which outranks()
+    the others of every item.
+    """
+    kept = {}
+    for entry in entries:
+        key = item_to_key(entry[0])
+        current = kept.get(key)
+        if current is None or outranks(
+            ranks, entry[1], entry_deadline(entry), current[1], entry_deadline(current)
+        ):
+            kept[key] = entry
+    return list(kept.values())
+
+
+def chunked(iterable, size):
+    """
+    Yields lists of at most size consecutive elements of iterable.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def parse_ip(item):
+    """
+    Returns (version, address) with the address as an integer if item is an IPv4 or IPv6 address
+    literal, None otherwise.
+    """
     try:
-        ip = ipaddress.ip_network(item)
-        return f"ipv{ip.version}_{int(ip.netmask)}_{int(ip.network_address)}"
+        if ":" in item:
+            return 6, int.from_bytes(inet_pton(AF_INET6, item), "big")
+        return 4, int.from_bytes(inet_pton(AF_INET, item), "big")
+    except (OSError, TypeError, ValueError):
+        return None
+
+
+def parse_network(item):
+    try:
+        return ipaddress.ip_network(item)
     except ValueError:
-        return f"normal_{item}"
+        return None
 
 
-class Cache:
+def item_to_key(item, scope=None):
+    """
+    Returns the key under which item is stored: (version, network address, prefix length) for
+    IP addresses and ranges, (scope, item) for anything else. Items without a scope are stored
+    under the "normal" scope. Keys are returned as is.
+    """
+    if isinstance(item, tuple):
+        return item
+    if scope is not None:
+        scope = scope.lower()
+        if scope not in IP_SCOPES:
+            return scope, item
+    ip = parse_ip(item)
+    if ip is not None:
+        return ip[0], ip[1], ADDRESS_BITS[ip[0]]
+    # Only ranges and scoped IPv6 addresses can still be parsed by ipaddress.
+    if not isinstance(item, str) or "/" in item or "%" in item:
+        network = parse_network(item)
+        if network is not None:
+            return network.version, int(network.network_address), network.prefixlen
+    return scope or "normal", item
+
+
+def key_to_string(key):
+    """
+    Returns the redis field of key, eg "ipv4_4294967295_16909060", "normal_CN" or "country_CN".
+    """
+    if len(key) == 3:
+        version, net, plen = key
+        return f"ipv{version}_{NETMASKS_BY_VERSION[version][plen]}_{net}"
+    return f"{quote_scope(key[0])}_{key[1]}"
+
+
+def string_to_key(field):
+    kind, rest = field.split("_", maxsplit=1)
+    if kind in ("ipv4", "ipv6"):
+        netmask, net = rest.split("_")
+        return int(kind[3]), int(net), bin(int(netmask)).count("1")
+    return unquote(kind), rest
+
+
+def quote_scope(scope):
+    # "_" separates the scope from the value in redis fields.
+    return scope.replace("%", "%25").replace("_", "%5F")
+
+
+def key_to_item(key):
+    """
+    Returns the item of key as get_all returns it, eg "1.2.3.4/32" or "CN".
+    """
+    if len(key) == 3:
+        version, net, plen = key
+        return str(IP_NETWORK_BY_VERSION[version]((net, plen)))
+    return key[1]
+
+
+def item_to_string(item, scope=None):
+    return key_to_string(item_to_key(item, scope))
+
+
+class CowDict:
+    """
+    Mapping split into SHARDS dicts by the hash of its keys. copy() only copies the list of
+    shards: the copies share them, and a shard is copied the first time a copy writes to it.
+    A write thus costs O(n / SHARDS) after a copy instead of O(n).
+
+    As with PrefixTrie, once copied a mapping which is not written to anymore can be read from
+    any number of threads while its copies are being written to.
+    """
+
+    SHARDS = 256
+
+    __slots__ = ("shards", "owned", "size")
+
+    def __init__(self, items=()):
+        # Empty shards are shared until written to.
+        self.shards = [EMPTY] * self.SHARDS
+        self.owned = set()
+        self.size = 0
+        for key, value in items:
+            self[key] = value
+
+    def copy(self):
+        # Neither mapping owns the shared shards anymore, so both of them copy before writing.
+        self.owned = set()
+        copy = CowDict()
+        copy.shards = list(self.shards)
+        copy.size = self.size
+        return copy
+
+    def _own(self, index):
+        if index not in self.owned:
+            self.shards[index] = dict(self.shards[index])
+            self.owned.add(index)
+        return self.shards[index]
+
+    def get(self, key, default=None):
+        return self.shards[hash(key) & (self.SHARDS - 1)].get(key, default)
+
+    def __contains__(self, key):
+        return key in self.shards[hash(key) & (self.SHARDS - 1)]
+
+    def __setitem__(self, key, value):
+        shard = self._own(hash(key) & (self.SHARDS - 1))
+        if key not in shard:
+            self.size += 1
+        shard[key] = value
+
+    def __delitem__(self, key):
+        del self._own(hash(key) & (self.SHARDS - 1))[key]
+        self.size -= 1
+
+    def __len__(self):
+        return self.size
+
+    def items(self):
+        for shard in self.shards:
+            yield from shard.items()
+
+
+class DecisionTable:
+    """
+    Decisions of a Cache. IP and range decisions are kept in a PrefixTrie per address family,
+    everything else in a CowDict per scope. The details of decisions, if any, are kept the same
+    way, so that they are published along with the decisions.
+
+    copy() is cheap and only the copy may be modified afterwards, which lets readers keep using
+    a table while the next one is being built. freeze() must be called on the copy once it is
+    complete, before it is read.
+    """
+
     def __init__(self):
-        self.lock = threading.Lock()
-        self.cache = {}
+        self.tries = {4: PrefixTrie(32), 6: PrefixTrie(128)}
+        self.scopes = {}
+        self.owned_scopes = set()
+        # Created once details are stored.
+        self.detail_tries = None
+        self.other_details = None
 
-    def get(self, item):
-        with self.lock:
-            key = item_to_string(item)
-            key_parts = key.split("_")
-            key_type = key_parts[0]
-            if key_type == "normal":
-                return self.cache.get(key)
-            item_network_address = int(key_parts[-1])
-            netmasks = NETMASKS_BY_KEY_TYPE[key_type]
-            for netmask in netmasks:
-                resp = self.cache.get(f"{key_type}_{netmask}_{item_network_address & netmask}")
-                if resp:
-                    return resp
+    def copy(self):
+        table = DecisionTable()
+        table.tries = {version: trie.copy() for version, trie in self.tries.items()}
+        self._share(table)
+        return table
+
+    def _share(self, table):
+        """
+        Gives table copies of the non IP decisions and of the details.
+        """
+        table.scopes = dict(self.scopes)
+        self.owned_scopes = set()
+        if self.detail_tries is not None:
+            table.detail_tries = {
+                version: trie.copy() for version, trie in self.detail_tries.items()
+            }
+        if self.other_details is not None:
+            table.other_details = self.other_details.copy()
+
+    def freeze(self):
+        return self
+
+    def _own_scope(self, scope):
+        if scope not in self.owned_scopes:
+            values = self.scopes.get(scope)
+            self.scopes[scope] = CowDict() if values is None else values.copy()
+            self.owned_scopes.add(scope)
+        return self.scopes[scope]
+
+    def lookup_ip(self, version, address):
+        return self.tries[version].lookup(address)
+
+    def ip_items(self):
+        """
+        Yields (version, network address, prefix length, action) for every IP decision.
+        """
+        for version, trie in self.tries.items():
+            for net, plen, action in trie.items():
+                yield version, net, plen, action
+
+    def get_ip_key(self, key):
+        return self.tries[key[0]].get(key[1], key[2])
+
+    def insert_ip(self, key, action):
+        self.tries[key[0]].insert(key[1], key[2], action)
+
+    def delete_ip(self, key):
+        self.tries[key[0]].delete(key[1], key[2])
+
+    def ip_count(self):
+        return sum(map(len, self.tries.values()))
+
+    def get(self, item, scope=None):
+        if scope is not None:
+            scope = scope.lower()
+            if scope not in IP_SCOPES:
+                return self.scopes.get(scope, EMPTY).get(item)
+
+        ip = parse_ip(item)
+        if ip is not None:
+            return self.lookup_ip(ip[0], ip[1])
+        key = item_to_key(item, scope)
+        if len(key) == 3:
+            return self.lookup_ip(key[0], key[1])
+        if scope is not None:
+            return self.scopes.get(scope, EMPTY).get(item)
+        for values in self.scopes.values():
+            action = values.get(item)
+            if action is not None:
+                return action
+
+    def get_key(self, key):
+        """
+        Returns the action stored for exactly key, as returned by item_to_key, None if there
+        is none.
+        """
+        if len(key) == 3:
+            return self.get_ip_key(key)
+        return self.scopes.get(key[0], EMPTY).get(key[1])
 
     def get_all(self):
+        resp = {}
+        for values in self.scopes.values():
+            resp.update(values.items())
+        for version, net, plen, action in self.ip_items():
+            resp[key_to_item((version, net, plen))] = action
+        return resp
+
+    def insert(self, item, action, scope=None):
+        key = item_to_key(item, scope)
+        if len(key) == 3:
+            self.insert_ip(key, action)
+        else:
+            self._own_scope(key[0])[key[1]] = action
+
+    def delete(self, item, scope=None):
+        key = item_to_key(item, scope)
+        if len(key) == 3:
+            self.delete_ip(key)
+        elif key[1] in self.scopes.get(key[0], EMPTY):
+            del self._own_scope(key[0])[key[1]]
+
+    def get_details(self, item, scope=None):
+        """
+        Returns the details of the decision get() matches for item, None if there is none or
+        it was inserted without details.
+        """
+        if scope is not None:
+            scope = scope.lower()
+            if scope not in IP_SCOPES:
+                return self._other_details((scope, item))
+
+        ip = parse_ip(item)
+        if ip is None:
+            key = item_to_key(item, scope)
+            if len(key) == 2:
+                if scope is not None:
+                    return self._other_details(key)
+                # The scope get() finds item in.
+                for table_scope, values in self.scopes.items():
+                    if item in values:
+                        return self._other_details((table_scope, item))
+                return None
+            ip = key[0], key[1]
+        if self.detail_tries is None:
+            return None
+        details = self.detail_tries[ip[0]].lookup(ip[1])
+        return None if details is NO_DETAILS else details
+
+    def _other_details(self, key):
+        if self.other_details is None:
+            return None
+        return self.other_details.get(key)
+
+    def set_details(self, key, details):
+        """
+        Stores the details of an inserted key, eg its Decision, None if it has none.
+        """
+        if len(key) == 3:
+            if self.detail_tries is None:
+                if details is None:
+                    return
+                self.detail_tries = {4: PrefixTrie(32), 6: PrefixTrie(128)}
+            self.detail_tries[key[0]].insert(
+                key[1], key[2], NO_DETAILS if details is None else details
+            )
+        elif details is not None:
+            if self.other_details is None:
+                self.other_details = CowDict()
+            self.other_details[key] = details
+        else:
+            self.delete_details(key)
+
+    def delete_details(self, key):
+        if len(key) == 3:
+            if self.detail_tries is not None:
+                self.detail_tries[key[0]].delete(key[1], key[2])
+        elif self.other_details is not None and key in self.other_details:
+            del self.other_details[key]
+
+    def __len__(self):
+        return sum(map(len, self.scopes.values())) + self.ip_count()
+
+    def scope_sizes(self):
+        """
+        Returns the number of decisions per scope, IP and range decisions under "ip".
+        """
+        sizes = {scope: len(values) for scope, values in self.scopes.items() if values}
+        sizes["ip"] = self.ip_count()
+        return sizes
+
+
+class CompactTable(DecisionTable):
+    """
+    Decisions of a compact Cache. IP and range decisions are kept in an IntervalTable per address
+    family, with actions interned as small integer codes, which takes a fraction of the memory
+    of a PrefixTrie.
+
+    IntervalTables are immutable: inserts and deletes are recorded on the copy and merged into
+    new IntervalTables by freeze(), which costs O(n) per transaction instead of O(log n) per
+    change.
+    """
+
+    def __init__(self):
+        self.scopes = {}
+        self.owned_scopes = set()
+        self.detail_tries = None
+        self.other_details = None
+        self.intervals = {4: IntervalTable(32), 6: IntervalTable(128)}
+        # Shared by all the copies of a table. Only ever appended to, so that the codes of
+        # published tables stay valid.
+        self.actions = [None]
+        self.codes = {}
+        self.pending = {}
+
+    def copy(self):
+        table = CompactTable()
+        table.intervals = self.intervals
+        table.actions = self.actions
+        table.codes = self.codes
+        self._share(table)
+        return table
+
+    def code_for(self, action):
+        code = self.codes.get(action)
+        if code is None:
+            self.actions.append(action)
+            code = self.codes[action] = len(self.actions) - 1
+        return code
+
+    def freeze(self):
+        if not self.pending:
+            return self
+        intervals = dict(self.intervals)
+        for version, bits in ADDRESS_BITS.items():
+            changes = sorted(
+                (net, plen, code) for (v, net, plen), code in self.pending.items() if v == version
+            )
+            if changes:
+                prefixes = merge_prefixes(intervals[version].items(), changes)
+                intervals[version] = IntervalTable(bits, prefixes)
+        self.intervals = intervals
+        self.pending = {}
+        return self
+
+    def lookup_ip(self, version, address):
+        return self.actions[self.intervals[version].lookup(address)]
+
+    def ip_items(self):
+        for version, table in self.intervals.items():
+            for net, plen, code in table.items():
+                yield version, net, plen, self.actions[code]
+
+    def get_ip_key(self, key):
+        code = self.pending.get(key)
+        if code is None:
+            code = self.intervals[key[0]].get(key[1], key[2])
+        return self.actions[code]
+
+    def insert_ip(self, key, action):
+        self.pending[key] = self.code_for(action)
+
+    def delete_ip(self, key):
+        self.pending[key] = 0
+
+    def ip_count(self):
+        return sum(map(len, self.intervals.values()))
+
+    def nbytes(self):
+        """
+        Returns the size of the IP decision arrays.
+        """
+        return sum(table.nbytes() for table in self.intervals.values())
+
+
+class Cache:
+    """
+    In memory decision cache.
+
+    Reads don't take any lock, they use the table which is currently published. Writers build
+    a copy of that table and publish it with a single reference swap once they are done, so
+    readers either see all the changes of a transaction or none of them.
+
+    Items inserted with a deadline are kept in a heap, expire() deletes those whose deadline
+    has passed. Items can also be inserted with details, eg the Decision they come from, which
+    get_details() returns.
+
+    Args:
+        compact (bool): Store IP decisions in sorted arrays instead of tries. This takes much less
+            memory per decision, but every transaction rebuilds the arrays.
+        metrics (pycrowdsec.metrics.Metrics): Records the count and latency of lookups, and the
+            number of decisions per scope.
+    """
+
+    metrics_backend = "memory"
+
+    def __init__(self, compact=False, metrics=None):
+        self.lock = threading.Lock()
+        self.compact = compact
+        self.table = self.new_table()
+        self.deadlines = {}
+        self.expiry_heap = []
+        self.expiry_counter = itertools.count()
+        # key -> deadline before the transaction in progress, MISSING if there was none.
+        self.journal = None
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.register_gauge("pycrowdsec_decisions", self.scope_gauges)
+
+    def new_table(self):
+        return CompactTable() if self.compact else DecisionTable()
+
+    def after_fork(self):
+        """
+        Recreates the lock in a child process, a thread of the parent may have held it when it
+        forked.
+        """
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def transaction(self, replace=False):
+        """
+        Yields a copy of the current table to apply changes to, an empty table with replace.
+        It replaces the current table when the block exits without an exception. Otherwise the
+        deadlines changed by the block are rolled back, so that they still match the current
+        table.
+        """
         with self.lock:
-            resp = {}
-            for item, action in self.cache.items():
-                if item.startswith("normal_"):
-                    resp[item.split("_", maxsplit=1)[1]] = action
-                elif item.startswith("ipv"):
-                    _, netmask, address = item.split("_")
-                    ip_network = ipaddress.ip_network((int(address), bin(int(netmask)).count("1")))
-                    resp[ip_network.__str__()] = action
-            return resp
+            table = self.new_table() if replace else self.table.copy()
+            deadlines, expiry_heap = self.deadlines, self.expiry_heap
+            if replace:
+                # The previous deadlines are kept whole, no need for a journal.
+                self.deadlines, self.expiry_heap = {}, []
+            else:
+                self.journal = {}
+            try:
+                yield table
+            except BaseException:
+                if replace:
+                    self.deadlines, self.expiry_heap = deadlines, expiry_heap
+                else:
+                    self._rollback_deadlines()
+                raise
+            finally:
+                self.journal = None
+            self.publish(table.freeze())
+
+    def publish(self, table):
+        self.table = table
 
-    def insert(self, item, action):
-        key = item_to_string(item)
+    def snapshot(self):
+        """
+        Returns the current table and a copy of the deadlines of its items. The table must not
+        be modified.
+        """
         with self.lock:
-            self.cache[key] = action
+            return self.table, dict(self.deadlines)
 
-    def delete(self, item):
-        key = item_to_string(item)
+    def restore(self, table, deadlines):
+        """
+        Replaces the decisions with a frozen table, eg loaded from a snapshot, and the deadlines
+        of its items.
+        """
         with self.lock:
-            self.cache.pop(key, None)
+            self.table = table
+            self.deadlines = {}
+            self.expiry_heap = []
+            for key, deadline in deadlines.items():
+                self._set_deadline(key, deadline)
+
+    def get(self, item, scope=None):
+        """
+        Returns the action for item, None if there is none. Items of the "ip" and "range" scopes
+        are matched against IP ranges. Without a scope, IP addresses and ranges are matched
+        against IP ranges and anything else is looked up in every other scope.
+        """
+        if self.metrics is None:
+            return self.table.get(item, scope)
+        start = time.perf_counter()
+        action = self.table.get(item, scope)
+        self.metrics.record_lookup(
+            self.metrics_backend, action is not None, time.perf_counter() - start
+        )
+        return action
+
+    def get_all(self):
+        return self.table.get_all()
+
+    def scope_sizes(self):
+        return self.table.scope_sizes()
+
+    def scope_gauges(self):
+        return {(("scope", scope),): size for scope, size in self.scope_sizes().items()}
+
+    def get_details(self, item, scope=None):
+        """
+        Returns the details of the decision get() matches for item, None if there is none or
+        it was inserted without details.
+        """
+        return self.table.get_details(item, scope)
+
+    def insert(self, item, action, scope=None):
+        """
+        Inserts item in its own transaction. insert_many() is much faster for several items,
+        especially with a compact table, which is rebuilt by every transaction.
+        """
+        self.apply_delta(new=[(item_to_key(item, scope), action)])
+
+    def delete(self, item, scope=None):
+        """
+        Deletes item in its own transaction, see insert().
+        """
+        self.apply_delta(deleted=[item_to_key(item, scope)])
+
+    def insert_many(self, items):
+        """
+        Inserts every (item, action) pair of items in a single transaction. As in every bulk
+        method, items can be keys returned by item_to_key, eg to give their scope.
+        """
+        self.apply_delta(new=items)
+
+    def delete_many(self, items):
+        """
+        Deletes every item of items in a single transaction.
+        """
+        self.apply_delta(deleted=items)
+
+    def apply_delta(self, deleted=(), new=(), replace=False, priority=None):
+        """
+        Deletes every item of deleted, then inserts every (item, action),
+        (item, action, deadline) or (item, action, deadline, details) tuple of new, in a single
+        transaction. deadline is a time.time() timestamp after which expire() deletes the item.
+        Both arguments can be any iterable, they are consumed once. With replace, every stored
+        item is deleted first, eg to apply a startup response which holds every active decision.
+
+        An item of new which is inserted several times keeps the last entry, or with priority,
+        a sequence of actions by decreasing priority, the entry which outranks() the others.
+        """
+        ranks = None
+        if priority is not None:
+            ranks = {action: rank for rank, action in enumerate(priority)}
+        with self.transaction(replace) as table:
+            for item in deleted:
+                key = item_to_key(item)
+                table.delete(key)
+                table.delete_details(key)
+                self._set_deadline(key, None)
+            for entry in new:
+                key = item_to_key(entry[0])
+                deadline = entry_deadline(entry)
+                # The table holds the entries inserted so far by this delta, and by previous
+                # ones unless the journal shows that this delta already wrote the key.
+                if ranks is not None and (replace or key in self.journal):
+                    current = table.get_key(key)
+                    if current is not None and not outranks(
+                        ranks, entry[1], deadline, current, self.deadlines.get(key)
+                    ):
+                        continue
+                table.insert(key, entry[1])
+                table.set_details(key, entry[3] if len(entry) > 3 else None)
+                self._set_deadline(key, deadline)
+
+    def _set_deadline(self, key, deadline):
+        if self.journal is not None and key not in self.journal:
+            self.journal[key] = self.deadlines.get(key, MISSING)
+        if deadline is None:
+            self.deadlines.pop(key, None)
+            return
+
+        self.deadlines[key] = deadline
+        heapq.heappush(self.expiry_heap, (deadline, next(self.expiry_counter), key))
+        if len(self.expiry_heap) > 2 * len(self.deadlines) + 1024:
+            # Drop the entries of keys which were deleted or got another deadline since.
+            self.expiry_heap = [
+                (deadline, next(self.expiry_counter), key)
+                for key, deadline in self.deadlines.items()
+            ]
+            heapq.heapify(self.expiry_heap)
+
+    def _rollback_deadlines(self):
+        for key, deadline in self.journal.items():
+            if deadline is MISSING:
+                self.deadlines.pop(key, None)
+            else:
+                # Its heap entry may have been dropped, duplicates are harmless.
+                self.deadlines[key] = deadline
+                heapq.heappush(self.expiry_heap, (deadline, next(self.expiry_counter), key))
+
+    def expire(self, now=None):
+        """
+        Deletes the items whose deadline has passed, in a single transaction. Returns the number
+        of deleted items.
+        """
+        now = time.time() if now is None else now
+        if not self.expiry_heap or self.expiry_heap[0][0] > now:
+            return 0
+
+        expired = 0
+        with self.transaction() as table:
+            while self.expiry_heap and self.expiry_heap[0][0] <= now:
+                deadline, _, key = heapq.heappop(self.expiry_heap)
+                if self.deadlines.get(key) == deadline:
+                    self._set_deadline(key, None)
+                    table.delete(key)
+                    table.delete_details(key)
+                    expired += 1
+        return expired
 
     def __len__(self):
-        with self.lock:
-            return len(self.cache)
+        return len(self.table)
 
 
 class RedisCache:
-    def __init__(self, redis_connection):
+    """
+    Decision cache stored in the "pycrowdsec_cache" redis hash, so that it can be shared by
+    several processes.
+
+    Deadlines of items are stored as scores of the "pycrowdsec_cache_expiry" sorted set, expire()
+    deletes the items whose deadline has passed.
+
+    The scopes of the stored non IP items are kept in the "pycrowdsec_cache_scopes" set, so that
+    lookups without a scope know which fields to check. The number of stored IP fields per
+    prefix length is kept in the "pycrowdsec_cache_prefixes" hash, so that IP lookups only check
+    the prefix lengths which are in use.
+
+    Every write increments the "pycrowdsec_cache_generation" counter in the same transaction.
+    When local_cache_size is set, lookup results, misses included, are kept in a local LRU which
+    is dropped whenever that counter changes. The counter, the scopes and the prefix lengths are
+    read at most once every generation_check_interval seconds, so writes from other processes
+    can take that long to be seen. Writes from this instance are seen immediately.
+
+    Args:
+        redis_connection: The redis client to use.
+        chunk_size (int): The maximum number of fields sent in a single HSET or HDEL when
+            applying a delta.
+        local_cache_size (int): The maximum number of lookup results to keep locally. 0 disables
+            the local cache.
+        generation_check_interval (float): The minimum number of seconds between two reads of
+            the generation counter.
+        metrics (pycrowdsec.metrics.Metrics): Records the count and latency of lookups, and the
+            number of stored decisions.
+    """
+
+    def __init__(
+        self,
+        redis_connection,
+        chunk_size=1000,
+        local_cache_size=0,
+        generation_check_interval=1.0,
+        metrics=None,
+    ):
         self.lock = threading.Lock()
         self.redis = redis_connection
+        self.chunk_size = chunk_size
+        self.local_cache_size = local_cache_size
+        self.generation_check_interval = generation_check_interval
+        self.local_lock = threading.Lock()
+        self.local_cache = OrderedDict()
+        self.generation = None
+        self.next_generation_check = 0
+        self.scopes = []
+        # (field prefix, netmask) of the stored prefixes per IP version, longest first. None
+        # until they are known, all the prefixes are checked meanwhile.
+        self.field_prefixes = None
+        self.prefixes_counted = False
+        self.set_script = self.redis.register_script(SET_SCRIPT)
+        self.delete_script = self.redis.register_script(DELETE_SCRIPT)
+        self.count_prefixes_script = self.redis.register_script(COUNT_PREFIXES_SCRIPT)
+        self.expire_script = self.redis.register_script(EXPIRE_SCRIPT)
+        self.merge_script = self.redis.register_script(MERGE_SCRIPT)
+        self.swap_script = self.redis.register_script(SWAP_SCRIPT)
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.register_gauge("pycrowdsec_decisions", self.scope_gauges)
 
-    def get(self, item):
-        with self.lock:
-            key = item_to_string(item)
-            key_parts = key.split("_")
-            key_type = key_parts[0]
-            if key_type == "normal":
-                return self.redis.hget("pycrowdsec_cache", key)
-            item_network_address = int(key_parts[-1])
-            netmasks = NETMASKS_BY_KEY_TYPE[key_type]
-            check_for = []
-            for netmask in netmasks:
-                check_for.append(f"{key_type}_{netmask}_{item_network_address & netmask}")
-            responses = self.redis.hmget("pycrowdsec_cache", check_for)
-            for response in responses:
-                if response:
-                    return response.decode()
-
-    def insert(self, item, action):
+    def after_fork(self):
+        """
+        Recreates the locks in a child process, a thread of the parent may have held them when
+        it forked. redis-py reconnects on its own.
+        """
+        self.lock = threading.Lock()
+        self.local_lock = threading.Lock()
+
+    def check_generation(self, force=False):
+        """
+        Drops the local cache if the generation counter changed since the last check, and
+        refreshes the scopes and IP prefixes stored in redis.
+        """
+        now = time.monotonic()
+        if not force and now < self.next_generation_check:
+            return
+        self.next_generation_check = now + self.generation_check_interval
+        pipeline = self.redis.pipeline(transaction=False)
+        pipeline.get("pycrowdsec_cache_generation")
+        pipeline.smembers("pycrowdsec_cache_scopes")
+        pipeline.hgetall("pycrowdsec_cache_prefixes")
+        generation, scopes, prefix_counts = pipeline.execute()
+        generation = int(generation or 0)
+        field_prefixes = None
+        if b"complete" in prefix_counts:
+            field_prefixes = {4: [], 6: []}
+            for prefix, count in prefix_counts.items():
+                if prefix != b"complete" and int(count) > 0:
+                    kind, netmask = prefix.decode().split("_")
+                    field_prefixes[int(kind[3])].append((f"{kind}_{netmask}_", int(netmask)))
+            for prefixes in field_prefixes.values():
+                prefixes.sort(key=lambda prefix: prefix[1], reverse=True)
+        with self.local_lock:
+            self.scopes = sorted(scope.decode() for scope in scopes)
+            self.field_prefixes = field_prefixes
+            if generation != self.generation:
+                self.local_cache.clear()
+                self.generation = generation
+
+    def get(self, item, scope=None):
+        if self.metrics is None:
+            return self.cached_lookup(item, scope)
+        start = time.perf_counter()
+        action = self.cached_lookup(item, scope)
+        self.metrics.record_lookup("redis", action is not None, time.perf_counter() - start)
+        return action
+
+    def cached_lookup(self, item, scope=None):
+        if not self.local_cache_size:
+            return self.lookup(item, scope)
+
+        self.check_generation()
+        local_key = item if scope is None else (scope, item)
+        with self.local_lock:
+            generation = self.generation
+            action = self.local_cache.get(local_key, MISSING)
+            if action is not MISSING:
+                self.local_cache.move_to_end(local_key)
+                return action
+
+        action = self.lookup(item, scope)
+        with self.local_lock:
+            # Don't store results which might predate a write seen since the lookup started.
+            if generation == self.generation:
+                self.local_cache[local_key] = action
+                if len(self.local_cache) > self.local_cache_size:
+                    self.local_cache.popitem(last=False)
+        return action
+
+    def lookup(self, item, scope=None):
+        """
+        Looks item up in redis, with the same matching rules as Cache.get.
+        """
+        if scope is not None:
+            scope = scope.lower()
+            if scope not in IP_SCOPES:
+                return self.lookup_fields([key_to_string((scope, item))])
+
+        ip = parse_ip(item)
+        if ip is None:
+            key = item_to_key(item, scope)
+            if len(key) != 3:
+                if scope is not None:
+                    return self.lookup_fields([key_to_string(key)])
+                # The scope list is refreshed along with the generation counter.
+                self.check_generation()
+                return self.lookup_fields(
+                    [key_to_string((name, item)) for name in ["normal"] + self.scopes]
+                )
+            ip = key[:2]
+
+        version, address = ip
+        self.check_generation()
+        field_prefixes = (self.field_prefixes or FIELD_PREFIXES)[version]
+        if not field_prefixes:
+            return None
+        return self.lookup_fields(
+            [prefix + str(address & netmask) for prefix, netmask in field_prefixes]
+        )
+
+    def lookup_fields(self, fields):
+        """
+        Returns the value of the first of fields which is set.
+        """
         with self.lock:
-            key = item_to_string(item)
-            self.redis.hset("pycrowdsec_cache", key, action)
+            responses = self.redis.hmget("pycrowdsec_cache", fields)
+        for response in responses:
+            if response:
+                return response.decode()
+
+    def insert(self, item, action, scope=None):
+        self.apply_delta(new=[(item_to_key(item, scope), action)])
 
     def get_all(self):
         with self.lock:
             resp = {}
-            for item, action in self.redis.hgetall("pycrowdsec_cache").items():
-                item, action = item.decode(), action.decode()
-                if item.startswith("normal_"):
-                    resp[item.split("_", maxsplit=1)[1]] = action
-                elif item.startswith("ipv"):
-                    _, netmask, address = item.split("_")
-                    ip_network = ipaddress.ip_network((int(address), bin(int(netmask)).count("1")))
-                    resp[ip_network.__str__()] = action
+            for field, action in self.redis.hgetall("pycrowdsec_cache").items():
+                resp[key_to_item(string_to_key(field.decode()))] = action.decode()
             return resp
 
-    def delete(self, item):
+    def delete(self, item, scope=None):
+        self.apply_delta(deleted=[item_to_key(item, scope)])
+
+    def insert_many(self, items):
+        self.apply_delta(new=items)
+
+    def delete_many(self, items):
+        self.apply_delta(deleted=items)
+
+    def apply_delta(self, deleted=(), new=(), replace=False, priority=None):
+        """
+        Deletes every item of deleted, then inserts every (item, action) or
+        (item, action, deadline) tuple of new. deadline is a time.time() timestamp after which
+        expire() deletes the item. With replace, every stored item is deleted first. priority
+        resolves the entries of new for the same item as in Cache.apply_delta().
+
+        The changes are sent as script calls, ZREM and ZADD commands of at most chunk_size
+        fields, pipelined in a single MULTI/EXEC transaction, which also increments the
+        generation counter. Other clients of the redis server see either none or all of the
+        delta. The scripts keep the count of stored IP fields per prefix up to date.
+
+        A replace can be too large for a single transaction, which would block the server
+        until it completes. It is written to staging keys instead, a pipeline per chunk, which
+        are then swapped with the current keys by a single script. Staging keys left by a replace
+        which failed expire after STAGING_TTL seconds.
+        """
+        if replace:
+            return self.replace(new, priority)
+        pipeline = self.redis.pipeline(transaction=True)
+        if not self.prefixes_counted:
+            self.count_prefixes_script(keys=REDIS_KEYS[:2], client=pipeline)
+        if priority is not None:
+            new = coalesce_entries(new, {action: rank for rank, action in enumerate(priority)})
+        for chunk in chunked(deleted, self.chunk_size):
+            fields = [item_to_string(item) for item in chunk]
+            self.delete_script(keys=REDIS_KEYS[:2], args=fields, client=pipeline)
+            pipeline.zrem("pycrowdsec_cache_expiry", *fields)
+        scopes = set()
+        for chunk in chunked(new, self.chunk_size):
+            self.queue_inserts(pipeline, REDIS_KEYS, chunk, scopes)
+        if scopes:
+            pipeline.sadd("pycrowdsec_cache_scopes", *scopes)
+        pipeline.incr("pycrowdsec_cache_generation")
         with self.lock:
-            key = item_to_string(item)
-            self.redis.hdel("pycrowdsec_cache", key)
+            generation = pipeline.execute()[-1]
+        self.written(generation, scopes, replace=False)
+
+    def replace(self, new, priority=None):
+        """
+        Replaces every stored item by those of new, see apply_delta().
+        """
+        # Other clients may be replacing at the same time, eg while the leader changes.
+        staging = [f"{key}_staging_{os.urandom(8).hex()}" for key in REDIS_KEYS]
+        # Arguments of the merge script preceding its triples. The staging hash only holds the
+        # entries of this replace, the script resolves them against those of previous chunks.
+        ranking = None if priority is None else [len(priority), *priority]
+        scopes = set()
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            pipeline.hset(staging[1], "complete", 1)
+            for chunk in chunked(new, self.chunk_size):
+                self.queue_inserts(pipeline, staging, chunk, scopes, ranking)
+                self.execute_staging(pipeline, staging)
+            if scopes:
+                pipeline.sadd(staging[3], *scopes)
+            self.execute_staging(pipeline, staging)
+            with self.lock:
+                generation = self.swap_script(
+                    keys=[*REDIS_KEYS, *staging, "pycrowdsec_cache_generation"]
+                )
+        except BaseException:
+            try:
+                self.redis.delete(*staging)
+            except Exception:
+                pass
+            raise
+        self.written(generation, scopes, replace=True)
+
+    def execute_staging(self, pipeline, staging):
+        for key in staging:
+            pipeline.expire(key, STAGING_TTL)
+        with self.lock:
+            pipeline.execute()
+
+    def queue_inserts(self, pipeline, keys, chunk, scopes, ranking=None):
+        """
+        Queues the insertion of the entries of chunk in pipeline, into the hash, prefix counts
+        and expiry keys of keys, a REDIS_KEYS like list. Adds their non IP scopes to scopes.
+        With a ranking, the entries are resolved against those already stored by the merge
+        script.
+        """
+        actions, deadlines, no_deadline, triples = {}, {}, [], []
+        for entry in chunk:
+            key = item_to_key(entry[0])
+            if len(key) == 2 and key[0] != "normal":
+                scopes.add(key[0])
+            field = key_to_string(key)
+            deadline = entry_deadline(entry)
+            if ranking is not None:
+                triples += (field, entry[1], "" if deadline is None else repr(deadline))
+            else:
+                actions[field] = entry[1]
+                if deadline is not None:
+                    deadlines[field] = deadline
+                else:
+                    no_deadline.append(field)
+        if ranking is not None:
+            self.merge_script(keys=keys[:3], args=ranking + triples, client=pipeline)
+            return
+        self.set_script(
+            keys=keys[:2],
+            args=list(itertools.chain.from_iterable(actions.items())),
+            client=pipeline,
+        )
+        if deadlines:
+            pipeline.zadd(keys[2], deadlines)
+        if no_deadline:
+            pipeline.zrem(keys[2], *no_deadline)
+
+    def written(self, generation, scopes, replace):
+        """
+        Updates the local state after a write of this instance.
+        """
+        self.prefixes_counted = True
+        with self.local_lock:
+            self.local_cache.clear()
+            self.generation = generation
+            if replace:
+                self.scopes = sorted(scopes)
+            elif not scopes.issubset(self.scopes):
+                self.scopes = sorted(scopes.union(self.scopes))
+            # Reread the stored prefixes before the next lookup.
+            self.next_generation_check = 0
+
+    def expire(self, now=None):
+        """
+        Deletes the items whose deadline has passed, chunk_size items per atomic script call.
+        Returns the number of deleted items.
+        """
+        now = time.time() if now is None else now
+        expired = 0
+        while True:
+            with self.lock:
+                count = self.expire_script(
+                    keys=[
+                        "pycrowdsec_cache",
+                        "pycrowdsec_cache_expiry",
+                        "pycrowdsec_cache_generation",
+                        "pycrowdsec_cache_prefixes",
+                    ],
+                    args=[now, self.chunk_size],
+                )
+            expired += count
+            if count < self.chunk_size:
+                break
+        if expired:
+            self.check_generation(force=True)
+        return expired
 
     def __len__(self):
         with self.lock:
             return self.redis.hlen("pycrowdsec_cache")
+
+    def scope_sizes(self):
+        """
+        Returns the number of IP and range decisions under "ip", and of any other decision
+        under "other". Counting every scope would take a scan of the hash. Every decision is
+        under "all" until the IP decisions were counted.
+        """
+        with self.lock:
+            pipeline = self.redis.pipeline(transaction=True)
+            pipeline.hlen("pycrowdsec_cache")
+            pipeline.hgetall("pycrowdsec_cache_prefixes")
+            total, counts = pipeline.execute()
+        if counts.pop(b"complete", None) is None:
+            return {"all": total}
+        ip = sum(int(count) for count in counts.values())
+        return {"ip": ip, "other": total - ip}
+
+    def scope_gauges(self):
+        return {(("scope", scope),): size for scope, size in self.scope_sizes().items()}
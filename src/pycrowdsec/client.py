@@ -1,7 +1,13 @@
+import itertools
 import logging
+import os
 import queue
 import threading
+import weakref
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
 
 try:
     from importlib import metadata
@@ -10,14 +16,33 @@ except ImportError:  # for Python<3.8
 
 __version__ = metadata.version("pycrowdsec")
 
-from time import sleep
+from time import monotonic, perf_counter, sleep, time
 
 import requests
+from requests.adapters import HTTPAdapter
 
-from pycrowdsec.cache import Cache, RedisCache
+from pycrowdsec.cache import Cache, RedisCache, outranks
+from pycrowdsec.decision import Decision, decision_key
+from pycrowdsec.decoding import iter_decisions, loads
+from pycrowdsec.leader import FileLockElection, LeadershipLost, RedisLeaseElection
+from pycrowdsec.resilience import (
+    FAILURE_POLICIES,
+    TRANSIENT_ERRORS,
+    CircuitBreaker,
+    CircuitOpenError,
+    apply_failure_policy,
+    backoff_delay,
+    is_transient,
+)
+from pycrowdsec.shared import SharedCache
+from pycrowdsec.snapshot import load_snapshot, save_snapshot
+from pycrowdsec.tracing import span, timed_lookup
 
 logger = logging.getLogger(__name__)
 
+# Number of bytes read at once from startup responses.
+STREAM_CHUNK_SIZE = 64 * 1024
+
 
 def create_session(api_key, insecure_skip_verify, key_path, cert_path, ca_cert_path, user_agent):
     session = requests.Session()
@@ -38,6 +63,52 @@ def create_session(api_key, insecure_skip_verify, key_path, cert_path, ca_cert_p
     return session
 
 
+# Decision types by decreasing priority, when several decisions target the same item.
+ACTION_PRIORITY = ("ban", "captcha", "throttle")
+
+
+def coalesce_delta(response, now, priority=ACTION_PRIORITY):
+    """
+    Returns the keys to delete and the Decisions to insert which have the net effect of
+    deleting the "deleted" decisions of a stream response, then inserting its "new" ones. Every
+    key is written at most once: of the new decisions for the same key, the one whose type
+    comes first in priority, other types after them, then the one lasting the longest is kept,
+    see outranks(), and a key which is inserted again isn't deleted first.
+    """
+    ranks = {action: rank for rank, action in enumerate(priority)}
+    new = {}
+    for decision in response["new"]:
+        decision = Decision.from_dict(decision, now)
+        current = new.get(decision.key)
+        if current is None or outranks(
+            ranks, decision.type, decision.deadline, current.type, current.deadline
+        ):
+            new[decision.key] = decision
+    deleted = [
+        key
+        for key in dict.fromkeys(decision_key(decision) for decision in response["deleted"])
+        if key not in new
+    ]
+    return deleted, list(new.values())
+
+
+class InFlightQuery:
+    """
+    A LAPI query which callers asking for the same item wait for instead of sending their own.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.action = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.action
+
+
 class QueryClient:
     def __init__(
         self,
@@ -48,10 +119,36 @@ class QueryClient:
         key_path="",
         cert_path="",
         ca_cert_path="",
+        cache_size=0,
+        cache_ttl=60,
+        negative_cache_ttl=10,
+        max_concurrency=10,
+        timeout=5,
+        deadline=None,
+        retries=2,
+        retry_backoff=0.1,
+        max_backoff=1,
+        breaker_threshold=5,
+        breaker_reset_timeout=30,
+        failure_policy="raise",
+        fail_closed_action="ban",
+        metrics=None,
+        tracer=None,
     ):
         """
         Initializes a new instance of the CrowdSec API client.
 
+        Concurrent get_action_for() calls for the same item share a single LAPI query. With a
+        cache_size, their results are also kept for cache_ttl seconds, or negative_cache_ttl
+        seconds when there is no decision, in a LRU of at most cache_size items.
+
+        Queries failing with a connection error, a timeout or a 5XX response are retried up to
+        retries times, waiting a random delay growing exponentially from retry_backoff, within
+        deadline. After breaker_threshold consecutive failures, LAPI is not queried anymore for
+        breaker_reset_timeout seconds: lookups fail right away. Failed lookups raise the error,
+        return None or return fail_closed_action when failure_policy is "raise", "open" or
+        "closed".
+
         Args:
             api_key (str): The API key to use for authentication.
             lapi_url (str): The URL of the local API server.
@@ -60,24 +157,225 @@ class QueryClient:
             key_path (str): The path to the client's private key file.
             cert_path (str): The path to the client's certificate file.
             ca_cert_path (str): The path to the CA certificate file.
+            cache_size (int): The maximum number of cached results. 0 disables the cache.
+            cache_ttl (float): The number of seconds an action is cached for.
+            negative_cache_ttl (float): The number of seconds the absence of an action is
+                cached for.
+            max_concurrency (int): The maximum number of concurrent queries sent by
+                get_actions_for(), and of connections kept open to LAPI.
+            timeout (float): The number of seconds to wait for each LAPI response.
+            deadline (float): The maximum number of seconds a lookup takes, including retries.
+                None for no limit besides timeout and retries.
+            retries (int): The maximum number of times a failed query is retried.
+            retry_backoff (float): The maximum delay in seconds before the first retry.
+            max_backoff (float): The maximum delay in seconds before any retry.
+            breaker_threshold (int): The number of consecutive failures after which LAPI is
+                considered down. None disables the circuit breaker.
+            breaker_reset_timeout (float): The number of seconds LAPI is considered down for,
+                before a query is tried again.
+            failure_policy (str): "raise", "open" or "closed".
+            fail_closed_action (str): The action of failed lookups with the "closed" policy.
+            metrics (pycrowdsec.metrics.Metrics): Records the count and latency of lookups.
+            tracer (pycrowdsec.tracing.Tracer): Records slow lookups.
         """
 
         if api_key == "" and key_path == "" and cert_path == "":
             raise ValueError("You must provide an api_key or a key_path and cert_path")
+        if failure_policy not in FAILURE_POLICIES:
+            raise ValueError(f"failure_policy must be one of {', '.join(FAILURE_POLICIES)}")
 
         self.lapi_url = lapi_url
+        self.metrics = metrics
+        self.tracer = tracer
         self.session = create_session(
             api_key, insecure_skip_verify, key_path, cert_path, ca_cert_path, user_agent
         )
+        self.max_concurrency = max_concurrency
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.negative_cache_ttl = negative_cache_ttl
+        self.lock = threading.Lock()
+        # item -> (monotonic() deadline, action), least recently used first.
+        self.results = OrderedDict()
+        self.in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.timeout = timeout
+        self.deadline = deadline
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.max_backoff = max_backoff
+        self.breaker = (
+            CircuitBreaker(breaker_threshold, breaker_reset_timeout) if breaker_threshold else None
+        )
+        self.failure_policy = failure_policy
+        self.fail_closed_action = fail_closed_action
 
-    def get_decisions_for(self, item):
-        resp = self.session.get(f"{self.lapi_url}v1/decisions?ip={item}")
+    def get_decisions_for(self, item, timeout=None):
+        resp = self.session.get(
+            f"{self.lapi_url}v1/decisions?ip={item}", timeout=timeout or self.timeout
+        )
         resp.raise_for_status()
         return resp.json()
 
+    def query_action_for(self, item):
+        """
+        Returns the type of the latest decision for item from LAPI, retrying transient errors.
+        Raises CircuitOpenError without querying LAPI while it is considered down.
+        """
+        deadline = None if self.deadline is None else monotonic() + self.deadline
+        for attempt in itertools.count():
+            if self.breaker is not None and not self.breaker.allow():
+                raise CircuitOpenError("pycrowdsec LAPI is unavailable")
+            timeout = self.timeout
+            if deadline is not None:
+                timeout = min(timeout, max(deadline - monotonic(), 0.001))
+            try:
+                decisions = self.get_decisions_for(item, timeout)
+            except Exception as e:
+                transient = is_transient(e)
+                if self.breaker is not None:
+                    # Other errors, eg 403, still mean that LAPI is up.
+                    if transient:
+                        self.breaker.record_failure()
+                    else:
+                        self.breaker.record_success()
+                if not transient or attempt >= self.retries:
+                    raise
+                delay = backoff_delay(attempt, self.retry_backoff, self.max_backoff)
+                if deadline is not None and monotonic() + delay >= deadline:
+                    raise
+                sleep(delay)
+                continue
+            if self.breaker is not None:
+                self.breaker.record_success()
+            if not decisions:
+                return None
+            return max(decisions, key=lambda d: d["id"])["type"]
+
     def get_action_for(self, item):
-        decisions = self.get_decisions_for(item)
-        return max(decisions, key=lambda d: d["id"])["type"]
+        """
+        Returns the type of the latest decision for item, None if there is none. Applies
+        failure_policy if LAPI can't be queried.
+        """
+        if self.metrics is None and self.tracer is None:
+            return self.cached_action_for(item)
+        start = perf_counter()
+        # Failed lookups are recorded as errors, whatever failure_policy returns for them.
+        hit = None
+        try:
+            action, error = self.lookup_action_for(item)
+            if error is not None:
+                return apply_failure_policy(self.failure_policy, error, self.fail_closed_action)
+            hit = action is not None
+            return action
+        finally:
+            duration = perf_counter() - start
+            if self.metrics is not None:
+                self.metrics.record_lookup("query", hit, duration)
+            if self.tracer is not None:
+                self.tracer.record_lookup(item, duration)
+
+    def cached_action_for(self, item):
+        action, error = self.lookup_action_for(item)
+        if error is not None:
+            return apply_failure_policy(self.failure_policy, error, self.fail_closed_action)
+        return action
+
+    def lookup_action_for(self, item):
+        """
+        Returns (action, None) for item from the cache or LAPI, (None, error) if the query
+        failed.
+        """
+        with self.lock:
+            result = self.results.get(item)
+            if result is not None and result[0] > monotonic():
+                self.results.move_to_end(item)
+                self.hits += 1
+                return result[1], None
+            self.misses += 1
+            query = self.in_flight.get(item)
+            leader = query is None
+            if leader:
+                query = self.in_flight[item] = InFlightQuery()
+            else:
+                self.coalesced += 1
+        if not leader:
+            try:
+                return query.wait(), None
+            except Exception as e:
+                return None, e
+
+        try:
+            query.action = self.query_action_for(item)
+        except Exception as e:
+            query.error = e
+            return None, e
+        finally:
+            with self.lock:
+                del self.in_flight[item]
+                if query.error is None and self.cache_size:
+                    ttl = self.negative_cache_ttl if query.action is None else self.cache_ttl
+                    self.results[item] = monotonic() + ttl, query.action
+                    self.results.move_to_end(item)
+                    while len(self.results) > self.cache_size:
+                        self.results.popitem(last=False)
+            query.done.set()
+        return query.action, None
+
+    def get_actions_for(self, items, max_in_flight=None):
+        """
+        Yields (item, action) for every item of items, in the order the queries complete. At
+        most max_in_flight queries, max_concurrency by default, are sent at once from a pool of
+        threads. items is consumed as queries complete, so it can be a large generator.
+        """
+        max_in_flight = max_in_flight or self.max_concurrency
+        items = iter(items)
+        pending = {}
+        executor = ThreadPoolExecutor(max_workers=min(max_in_flight, self.max_concurrency))
+        try:
+            while True:
+                for item in itertools.islice(items, max_in_flight - len(pending)):
+                    pending[executor.submit(self.get_action_for, item)] = item
+                if not pending:
+                    return
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def stats(self):
+        """
+        Returns the numbers of cache hits and misses, of misses which waited for the query of
+        another caller, the hit ratio and the state of the circuit breaker.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "cached": len(self.results),
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "breaker": self.breaker.state if self.breaker is not None else "closed",
+            }
+
+
+def restart_after_fork(client_ref):
+    client = client_ref()
+    if client is None:
+        return
+    try:
+        client.after_fork()
+    except Exception as e:
+        logger.error(f"pycrowdsec got error {e} while restarting after fork")
 
 
 class BaseStreamClient(ABC):
@@ -95,6 +393,13 @@ class BaseStreamClient(ABC):
         key_path="",
         cert_path="",
         ca_cert_path="",
+        timeout=30,
+        retries=2,
+        retry_backoff=1,
+        min_interval=None,
+        max_interval=None,
+        metrics=None,
+        tracer=None,
         **kwargs,
     ):
         """
@@ -113,6 +418,19 @@ class BaseStreamClient(ABC):
             key_path (str): The path to the client's private key file.
             cert_path (str): The path to the client's certificate file.
             ca_cert_path (str): The path to the CA certificate file.
+            timeout (float): The number of seconds to wait for LAPI to connect or send data.
+            retries (int): The maximum number of times a cycle failing with a connection error,
+                a timeout or a 5XX response is retried, waiting a random delay growing
+                exponentially from retry_backoff seconds, up to interval.
+            retry_backoff (float): The maximum delay in seconds before the first retry.
+            min_interval (float): The interval in seconds after a cycle which fetched changes.
+                Defaults to interval.
+            max_interval (float): The longest interval in seconds, reached by doubling the
+                interval after every cycle which fetched no change. Defaults to interval.
+            metrics (pycrowdsec.metrics.Metrics): Records the duration, payload size and
+                numbers of new and deleted decisions of cycles, and the lookups of the cache.
+            tracer (pycrowdsec.tracing.Tracer): Traces cycles, fetching, decoding and applying
+                their responses, and records slow lookups.
             **kwargs: Additional keyword arguments to pass to the requests library.
         """
 
@@ -120,58 +438,313 @@ class BaseStreamClient(ABC):
             raise ValueError("You must provide an api_key or a key_path and cert_path")
 
         self.api_key = api_key
+        self.insecure_skip_verify = insecure_skip_verify
+        self.key_path = key_path
+        self.cert_path = cert_path
+        self.ca_cert_path = ca_cert_path
         self.scopes = scopes
         self.interval = int(interval)
         self.lapi_url = lapi_url
         self.user_agent = user_agent
         self.death_reason = None
+        # Whether the next cycle must fetch every active decision, and whether the response
+        # being processed holds every active decision.
+        self.resync = False
+        self.startup = False
         self.include_scenarios_containing = include_scenarios_containing
         self.exclude_scenarios_containing = exclude_scenarios_containing
         self.only_include_decisions_from = only_include_decisions_from
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.min_interval = self.interval if min_interval is None else min_interval
+        self.max_interval = self.interval if max_interval is None else max_interval
+        self.next_interval = self.interval
+        # Whether the last cycle fetched changes, None if it is unknown.
+        self.changed = None
+        self.t = None
+        self.stopped = threading.Event()
+        self.wakeup = threading.Event()
+        self.fork_hook_registered = False
+        self.metrics = metrics
+        self.tracer = tracer
 
         self.session = create_session(
             api_key, insecure_skip_verify, key_path, cert_path, ca_cert_path, user_agent
         )
         self.__post_init__(**kwargs)
 
-    def cycle(self, first_time):
+    def stream_params(self):
+        params = {
+            "startup": "true" if self.startup else "false",
+            "scopes": ",".join(self.scopes),
+            "scenarios_containing": ",".join(self.include_scenarios_containing),
+            "scenarios_not_containing": ",".join(self.exclude_scenarios_containing),
+            "origins": ",".join(self.only_include_decisions_from),
+        }
+        for k, v in params.copy().items():
+            if not v:
+                del params[k]
+        return params
+
+    def fetch_decisions(self):
+        url = f"{self.lapi_url}v1/decisions/stream"
+        params = self.stream_params()
+        if self.startup:
+            # Startup responses hold every active decision, decode them as they arrive
+            # instead of loading the whole body at once. Reading, decoding and applying them
+            # are then traced as a single span.
+            with span(self.tracer, "pycrowdsec.fetch", streamed=True):
+                resp = self.session.get(url=url, params=params, stream=True, timeout=self.timeout)
+            with resp:
+                resp.raise_for_status()
+                with span(self.tracer, "pycrowdsec.process_decisions"):
+                    chunks = self.count_payload(resp.iter_content(STREAM_CHUNK_SIZE))
+                    self.process_decisions(self.count_decisions(iter_decisions(chunks)))
+        else:
+            with span(self.tracer, "pycrowdsec.fetch", streamed=False) as attributes:
+                resp = self.session.get(url=url, params=params, timeout=self.timeout)
+                resp.raise_for_status()
+                content = resp.content
+                attributes["bytes"] = len(content)
+            self.record_payload(len(content))
+            with span(self.tracer, "pycrowdsec.decode"):
+                response = loads(content)
+            self.changed = bool(response.get("new") or response.get("deleted"))
+            counts = {key: len(response.get(key) or ()) for key in ("new", "deleted")}
+            self.record_decisions(counts)
+            with span(self.tracer, "pycrowdsec.process_response", **counts):
+                self.process_response(response)
+
+    def record_payload(self, size):
+        if self.metrics is not None:
+            self.metrics.inc("pycrowdsec_cycle_payload_bytes_total", amount=size)
+
+    def record_decisions(self, counts):
+        if self.metrics is not None:
+            for kind in ("new", "deleted"):
+                self.metrics.inc(
+                    "pycrowdsec_cycle_decisions_total", (("kind", kind),), counts.get(kind, 0)
+                )
+
+    def count_payload(self, chunks):
+        """
+        Yields the chunks of bytes of chunks, recording their size.
+        """
+        if self.metrics is None:
+            return chunks
+        return (self.record_payload(len(chunk)) or chunk for chunk in chunks)
+
+    def count_decisions(self, decisions):
+        """
+        Yields the (key, decision) pairs of decisions, recording their number per key.
+        """
+        if self.metrics is None:
+            return decisions
+        return self.counted_decisions(decisions)
+
+    def counted_decisions(self, decisions):
+        counts = {}
         try:
-            url = f"{self.lapi_url}v1/decisions/stream"
-            params = {
-                "startup": first_time,
-                "scopes": ",".join(self.scopes),
-                "scenarios_containing": ",".join(self.include_scenarios_containing),
-                "scenarios_not_containing": ",".join(self.exclude_scenarios_containing),
-                "origins": ",".join(self.only_include_decisions_from),
-            }
-            for k, v in params.copy().items():
-                if not v:
-                    del params[k]
-            resp = self.session.get(
-                url=url,
-                params=params,
-            )
-            resp.raise_for_status()
-            self.process_response(resp.json())
-        except Exception as e:
-            logger.error(f"pycrowdsec got error {e}")
-            if first_time == "true":
-                self.death_reason = e
-                raise e
+            for key, decision in decisions:
+                counts[key] = counts.get(key, 0) + 1
+                yield key, decision
+        finally:
+            self.record_decisions(counts)
 
-    def run(self):
-        self.cycle("true")  # So we catch errors on startup
+    def record_cycle(self, start, ok):
+        if self.metrics is not None:
+            self.metrics.inc("pycrowdsec_cycles_total", (("result", "ok" if ok else "error"),))
+            self.metrics.observe("pycrowdsec_cycle_duration_seconds", monotonic() - start)
+
+    # Errors worth retrying, besides 5XX and 429 responses.
+    transient_errors = TRANSIENT_ERRORS
+
+    def retry_delay(self, attempt, error):
+        """
+        Returns the number of seconds to wait before retrying a cycle which failed with error,
+        None if it must not be retried.
+        """
+        if attempt >= self.retries or not is_transient(error, self.transient_errors):
+            return None
+        delay = backoff_delay(attempt, self.retry_backoff, max(self.interval, self.retry_backoff))
+        logger.warning(f"pycrowdsec got error {error}, retrying in {delay:.1f}s")
+        return delay
 
-        def _thread_cycle():
+    def cycle_steps(self, first_time):
+        """
+        Generator running a cycle, shared by the synchronous and asynchronous clients, which
+        only differ by how they fetch and wait. It yields None when the response must be fetched
+        and processed, the caller then throws the error it failed with into the generator, if
+        any. It yields a number of seconds to wait before retrying after a failed attempt, the
+        caller then sends whether the client was stopped meanwhile, which ends the retries.
+        """
+        self.changed = None
+        resync = self.resync
+        start = monotonic()
+        with span(self.tracer, "pycrowdsec.cycle") as attributes:
+            try:
+                self.startup = first_time == "true" or resync
+                attributes["startup"] = self.startup
+                # Processing the response can ask for another resync.
+                self.resync = False
+                for attempt in itertools.count():
+                    attributes["attempts"] = attempt + 1
+                    try:
+                        # Responses are applied once read whole, a failed attempt left the
+                        # cache as it was.
+                        yield None
+                        break
+                    except Exception as e:
+                        delay = self.retry_delay(attempt, e)
+                        if delay is None:
+                            raise
+                        if (yield delay):
+                            raise
+                self.record_cycle(start, ok=True)
+                attributes["changed"] = self.changed
+            except LeadershipLost:
+                # Another client writes the decisions now, it isn't a failure of LAPI.
+                attributes["leadership_lost"] = True
+                logger.warning("pycrowdsec client lost the leadership during a cycle")
+            except Exception as e:
+                self.record_cycle(start, ok=False)
+                attributes["error"] = repr(e)
+                self.resync = self.resync or resync
+                logger.error(f"pycrowdsec got error {e}")
+                if first_time == "true":
+                    self.death_reason = e
+                    raise e
+            finally:
+                self.startup = False
+
+    def cycle(self, first_time):
+        steps = self.cycle_steps(first_time)
+        try:
+            delay = next(steps)
             while True:
-                sleep(self.interval)
-                self.cycle("false")
+                if delay is not None:
+                    # stop() interrupts the wait.
+                    delay = steps.send(self.stopped.wait(delay))
+                    continue
+                try:
+                    self.check_leadership()
+                    self.fetch_decisions()
+                except Exception as e:
+                    delay = steps.throw(e)
+                else:
+                    delay = steps.send(None)
+        except StopIteration:
+            pass
 
-        self.t = threading.Thread(target=_thread_cycle, daemon=True)
+    def warm_start(self):
+        """
+        Loads previously fetched decisions, if any, so that run() doesn't need to wait for LAPI.
+        Returns whether it did, the decisions are then resynced in the background.
+        """
+        return False
+
+    def check_leadership(self):
+        """
+        Raises LeadershipLost if this client must not write what it fetches anymore. Called
+        before every attempt of a cycle.
+        """
+
+    def startup_in_poller(self):
+        """
+        Returns whether run() must leave the startup cycle to the poller instead of running it
+        itself, eg because the cycle can wait for the caller.
+        """
+        return False
+
+    def update_interval(self):
+        """
+        Polls again after min_interval when the last cycle fetched changes, doubles the interval
+        up to max_interval when it didn't.
+        """
+        if self.changed:
+            self.next_interval = self.min_interval
+        elif self.changed is not None:
+            self.next_interval = min(self.next_interval * 2, self.max_interval)
+
+    def run(self):
+        if self.warm_start() or self.startup_in_poller():
+            # The poller fetches every active decision first.
+            self.resync = True
+        else:
+            self.cycle("true")  # So we catch errors on startup
+        if not self.fork_hook_registered and hasattr(os, "register_at_fork"):
+            # Threads don't survive a fork, eg of gunicorn workers with --preload. The hook
+            # mustn't keep the client alive.
+            os.register_at_fork(after_in_child=partial(restart_after_fork, weakref.ref(self)))
+            self.fork_hook_registered = True
+        self.start_polling()
+
+    def start_polling(self):
+        self.stopped.clear()
+        self.t = threading.Thread(target=self.poll, daemon=True)
         self.t.start()
 
+    def poll(self):
+        if self.resync:
+            self.cycle("false")
+        while True:
+            self.wakeup.wait(self.next_interval)
+            if self.stopped.is_set():
+                return
+            self.wakeup.clear()
+            self.cycle("false")
+            self.update_interval()
+
+    def refresh_now(self):
+        """
+        Wakes the poller up to fetch the decisions right away instead of at the next interval.
+        """
+        self.wakeup.set()
+
+    def stop(self, timeout=None):
+        """
+        Stops polling, waiting at most timeout seconds for a cycle in progress to complete.
+        """
+        self.stopped.set()
+        self.wakeup.set()
+        if self.t is not None and self.t is not threading.current_thread():
+            self.t.join(timeout)
+
     def is_running(self):
-        return self.t.is_alive()
+        return self.t is not None and self.t.is_alive()
+
+    def after_fork(self):
+        """
+        Called in the child process of a fork, which only has the thread which forked. Replaces
+        what the poller and other threads of the parent were using, and starts polling again
+        if the parent was.
+        """
+        polling = self.t is not None and not self.stopped.is_set()
+        self.t = None
+        self.stopped = threading.Event()
+        self.wakeup = threading.Event()
+        # Connections of the pool are shared with the parent.
+        self.session = create_session(
+            self.api_key,
+            self.insecure_skip_verify,
+            self.key_path,
+            self.cert_path,
+            self.ca_cert_path,
+            self.user_agent,
+        )
+        if polling:
+            self.start_polling()
+
+    def process_decisions(self, decisions):
+        """
+        Processes the (key, decision) pairs of a startup response, eg ("new", decision), as
+        they are decoded. Collects them into a response for process_response() by default.
+        """
+        response = {"new": [], "deleted": []}
+        for key, decision in decisions:
+            response.setdefault(key, []).append(decision)
+        self.process_response(response)
 
     @abstractmethod
     def process_response(self, response):
@@ -184,17 +757,206 @@ class BaseStreamClient(ABC):
 
 class StreamClient(BaseStreamClient):
     def __post_init__(self, **kwargs):
+        leader_election = kwargs.get("leader_election", False)
+        self.action_priority = kwargs.get("action_priority", ACTION_PRIORITY)
+        self.decision_details = kwargs.get("decision_details", False)
+        self.election = None
+        self.leader = False
+        # monotonic() time of the last renewal of the leadership.
+        self.leadership_renewed = 0
+        self.snapshot_path = kwargs.get("snapshot_path")
+        self.snapshot_interval = kwargs.get("snapshot_interval", 60)
+        self.next_snapshot = 0
+        self.snapshot_table = None
         if "redis_connection" in kwargs:
-            self.cache = RedisCache(redis_connection=kwargs["redis_connection"])
+            self.cache = RedisCache(
+                redis_connection=kwargs["redis_connection"],
+                chunk_size=kwargs.get("redis_chunk_size", 1000),
+                local_cache_size=kwargs.get("redis_local_cache_size", 0),
+                generation_check_interval=kwargs.get("redis_generation_check_interval", 1.0),
+                metrics=self.metrics,
+            )
+            if self.snapshot_path:
+                raise ValueError("snapshot_path can't be used with redis_connection")
+            if leader_election:
+                self.election = RedisLeaseElection(
+                    kwargs["redis_connection"],
+                    lease_duration=kwargs.get("leader_lease_duration", 3 * self.max_interval),
+                )
+        elif "shared_cache_path" in kwargs:
+            path = kwargs["shared_cache_path"]
+            self.cache = SharedCache(path, writer=not leader_election, metrics=self.metrics)
+            # The shared file holds the last decisions already.
+            self.snapshot_path = path
+            if leader_election:
+                self.election = FileLockElection(f"{path}.lock")
         else:
-            self.cache = Cache()
+            if leader_election:
+                raise ValueError("leader_election requires redis_connection or shared_cache_path")
+            self.cache = Cache(compact=kwargs.get("compact_cache", False), metrics=self.metrics)
+        if self.decision_details and (isinstance(self.cache, (RedisCache, SharedCache))):
+            raise ValueError("decision_details requires an in memory cache")
 
-    def get_action_for(self, item):
-        return self.cache.get(item)
+    def get_action_for(self, item, scope=None):
+        """
+        Returns the action to take for item, None if there is none. Giving the scope of item,
+        eg "country", avoids trying to parse it as an IP address.
+        """
+        return timed_lookup(self.tracer, item, self.cache.get, *(() if scope is None else (scope,)))
+
+    def get_decision_details(self, item, scope=None):
+        """
+        Returns the Decision whose action get_action_for() returns for item, None if there is
+        none. Requires the decision_details option.
+        """
+        if not self.decision_details:
+            raise ValueError("decision_details must be enabled to get decision details")
+        return self.cache.get_details(item, scope)
+
+    def cache_entry(self, decision):
+        entry = decision.key, decision.type, decision.deadline
+        return entry + (decision,) if self.decision_details else entry
 
     def get_current_decisions(self):
         return self.cache.get_all()
 
+    def warm_start(self):
+        if not self.snapshot_path:
+            return False
+        try:
+            loaded = load_snapshot(self.cache, self.snapshot_path)
+        except Exception as e:
+            logger.error(f"pycrowdsec got error {e} while loading {self.snapshot_path}")
+            return False
+        if loaded:
+            logger.info(f"pycrowdsec loaded {len(self.cache)} decisions from {self.snapshot_path}")
+        return loaded
+
+    def save_snapshot(self):
+        """
+        Saves the decisions to snapshot_path if they changed since the last save, at most once
+        every snapshot_interval seconds.
+        """
+        now = monotonic()
+        if now < self.next_snapshot or isinstance(self.cache, SharedCache):
+            return
+        table = self.cache.table
+        if table is self.snapshot_table:
+            return
+        self.next_snapshot = now + self.snapshot_interval
+        try:
+            save_snapshot(self.cache, self.snapshot_path)
+            self.snapshot_table = table
+        except Exception as e:
+            logger.error(f"pycrowdsec got error {e} while saving {self.snapshot_path}")
+
+    def update_leadership(self):
+        """
+        Tries to become or stay the leader, returns whether this client is the leader. A new
+        leader fetches every active decision, since it can't know which deltas it missed.
+        """
+        try:
+            leader = self.election.acquire()
+        except Exception as e:
+            logger.error(f"pycrowdsec got error {e} during leader election")
+            leader = False
+        if leader:
+            self.leadership_renewed = monotonic()
+        if leader and not self.leader:
+            logger.info("pycrowdsec client became the leader")
+            if isinstance(self.cache, SharedCache):
+                self.cache.refresh(force=True)
+                self.cache.writer = True
+            self.resync = True
+        elif not leader and self.leader:
+            logger.info("pycrowdsec client isn't the leader anymore")
+            if isinstance(self.cache, SharedCache):
+                self.cache.writer = False
+        self.leader = leader
+        return leader
+
+    def check_leadership(self):
+        # A cycle can outlast the lease renewed by before_cycle(), eg when LAPI is slow and
+        # attempts are retried.
+        if self.election is not None and not self.update_leadership():
+            raise LeadershipLost()
+
+    def leading(self, entries):
+        """
+        Yields the entries of entries, renewing the leadership while they are consumed and
+        once more after the last one, right before the cache applies them.
+        """
+        renew_interval = self.election.renew_interval
+        for entry in entries:
+            if renew_interval and monotonic() - self.leadership_renewed > renew_interval:
+                self.check_leadership()
+            yield entry
+        self.check_leadership()
+
+    def before_cycle(self):
+        """
+        Returns whether this client must poll LAPI, after expiring its decisions if it does.
+        """
+        # Only the leader polls, the other clients read what it writes to the shared cache.
+        if self.election is not None and not self.update_leadership():
+            return False
+        # Expire first, so that stale decisions go away even when LAPI can't be reached.
+        try:
+            self.cache.expire()
+        except Exception as e:
+            logger.error(f"pycrowdsec got error {e} while expiring decisions")
+        return True
+
+    def after_cycle(self):
+        if self.snapshot_path:
+            self.save_snapshot()
+
+    def stop(self, timeout=None):
+        """
+        Stops polling and lets another client become the leader right away.
+        """
+        super().stop(timeout)
+        if self.election is not None and self.leader:
+            try:
+                self.election.release()
+            except Exception as e:
+                logger.error(f"pycrowdsec got error {e} while releasing leadership")
+            self.leader = False
+            if isinstance(self.cache, SharedCache):
+                self.cache.writer = False
+
+    def after_fork(self):
+        self.cache.after_fork()
+        if self.election is not None:
+            self.election.after_fork()
+            self.leader = False
+            if isinstance(self.cache, SharedCache):
+                self.cache.writer = False
+        super().after_fork()
+
+    def cycle(self, first_time):
+        if not self.before_cycle():
+            return
+        super().cycle(first_time)
+        self.after_cycle()
+
+    def process_decisions(self, decisions):
+        if not self.startup:
+            return super().process_decisions(decisions)
+        # The cache is replaced by the new decisions, deleted ones can be skipped.
+        now = time()
+        # Decisions are decoded as the delta is applied, so the cache resolves those for the
+        # same item as coalesce_delta() does.
+        new = (
+            self.cache_entry(Decision.from_dict(decision, now))
+            for key, decision in decisions
+            if key == "new"
+        )
+        if self.election is not None:
+            new = self.leading(new)
+        with span(self.tracer, "pycrowdsec.apply_delta", replace=True):
+            self.cache.apply_delta(replace=True, priority=self.action_priority, new=new)
+
     def process_response(self, response):
         if response["new"] is None:
             response["new"] = []
@@ -202,25 +964,120 @@ class StreamClient(BaseStreamClient):
         if response["deleted"] is None:
             response["deleted"] = []
 
-        for decision in response["deleted"]:
-            self.cache.delete(decision["value"])
-
-        for decision in response["new"]:
-            self.cache.insert(decision["value"], decision["type"])
+        deleted, new = coalesce_delta(response, time(), self.action_priority)
+        if not (deleted or new or self.startup):
+            return
+        self.check_leadership()
+        with span(self.tracer, "pycrowdsec.apply_delta", replace=self.startup):
+            self.cache.apply_delta(
+                replace=self.startup, deleted=deleted, new=map(self.cache_entry, new)
+            )
 
 
 class StreamDecisionClient(BaseStreamClient):
+    """
+    Stream client delivering the decisions it fetches instead of storing them, eg to sync a
+    firewall. Every cycle queues its deleted decisions, then its new ones, as ("deleted",
+    Decision) and ("new", Decision) pairs. A cycle fetching every active decision, at startup
+    or after a resync, queues ("startup", None) first: the consumer must then drop the
+    decisions it has, and apply the new ones which follow.
+
+    With a max_queue_size, the "block" backpressure policy makes the poller wait for the
+    consumer when the queue is full, so the consumer must run in another thread. The "drop"
+    policy drops the rest of the cycle instead, and resyncs at the next one. dropped counts the
+    cycles which were cut short. The startup cycle then runs in the poller too, so that run()
+    returns before the consumer starts, and errors on startup are logged instead of raised.
+    """
+
     def __post_init__(self, **kwargs):
+        self.backpressure = kwargs.get("backpressure", "block")
+        if self.backpressure not in ("block", "drop"):
+            raise ValueError("backpressure must be block or drop")
+        self.decisions = queue.Queue(kwargs.get("max_queue_size", 0))
+        self.dropped = 0
+        # Decisions taken from the queue by get_new_decision() and get_deleted_decision(),
+        # waiting for the other one.
         self.deleted_decisions = queue.SimpleQueue()
         self.new_decisions = queue.SimpleQueue()
 
+    def startup_in_poller(self):
+        return self.decisions.maxsize > 0
+
+    def get_batch(self, max_items=1000, timeout=None):
+        """
+        Returns a list of up to max_items queued (key, decision) pairs, in order, waiting at
+        most timeout seconds for the first one. Returns an empty list if there is none.
+        """
+        try:
+            batch = [self.decisions.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(batch) < max_items:
+            try:
+                batch.append(self.decisions.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def get_decisions_of(self, kind, pending):
+        while True:
+            if not pending.empty():
+                yield pending.get()
+                continue
+            try:
+                key, decision = self.decisions.get_nowait()
+            except queue.Empty:
+                return
+            if key == kind:
+                yield decision
+            elif key == "new":
+                self.new_decisions.put(decision)
+            elif key == "deleted":
+                self.deleted_decisions.put(decision)
+
     def get_new_decision(self):
-        while not self.new_decisions.empty():
-            yield self.new_decisions.get()
+        yield from self.get_decisions_of("new", self.new_decisions)
 
     def get_deleted_decision(self):
-        while not self.deleted_decisions.empty():
-            yield self.deleted_decisions.get()
+        yield from self.get_decisions_of("deleted", self.deleted_decisions)
+
+    def put(self, key, decision):
+        """
+        Queues (key, decision) according to the backpressure policy. Returns whether it did.
+        """
+        if self.backpressure == "drop":
+            try:
+                self.decisions.put_nowait((key, decision))
+                return True
+            except queue.Full:
+                return False
+        while not self.stopped.is_set():
+            try:
+                self.decisions.put((key, decision), timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def deliver(self, decisions):
+        """
+        Queues the (key, decision) pairs of decisions, and those of a startup marker first for
+        a startup response. Drops the remaining ones and resyncs at the next cycle if one can't
+        be queued.
+        """
+        if self.startup:
+            decisions = itertools.chain([("startup", None)], decisions)
+        for key, decision in decisions:
+            if not self.put(key, decision):
+                self.dropped += 1
+                self.resync = True
+                logger.warning("pycrowdsec decision queue is full, dropped decisions to resync")
+                return
+
+    def process_decisions(self, decisions):
+        # Delivered as they are decoded.
+        now = time()
+        self.deliver((key, Decision.from_dict(decision, now)) for key, decision in decisions)
 
     def process_response(self, response):
         if response["new"] is None:
@@ -229,8 +1086,13 @@ class StreamDecisionClient(BaseStreamClient):
         if response["deleted"] is None:
             response["deleted"] = []
 
-        for decision in response["deleted"]:
-            self.deleted_decisions.put(decision)
-
-        for decision in response["new"]:
-            self.new_decisions.put(decision)
+        now = time()
+        self.deliver(
+            itertools.chain(
+                (
+                    ("deleted", Decision.from_dict(decision, now))
+                    for decision in response["deleted"]
+                ),
+                (("new", Decision.from_dict(decision, now)) for decision in response["new"]),
+            )
+        )
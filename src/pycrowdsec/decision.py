@@ -0,0 +1,183 @@
+import logging
+import sys
+
+from pycrowdsec.cache import item_to_key
+from pycrowdsec.utils import parse_duration
+
+logger = logging.getLogger(__name__)
+
+
+def decision_key(decision):
+    return item_to_key(decision["value"], decision.get("scope"))
+
+
+def decision_deadline(decision, now):
+    """
+    Returns the time.time() timestamp at which decision expires, None if it has no duration.
+    """
+    if not decision.get("duration"):
+        return None
+    try:
+        return now + parse_duration(decision["duration"])
+    except ValueError:
+        logger.warning(f"pycrowdsec ignored invalid duration {decision['duration']}")
+        return None
+
+
+def intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class Decision:
+    """
+    A decision fetched from LAPI. Takes a fraction of the memory of its JSON object: origins,
+    scenarios, types and scopes are interned, so they are shared by all the decisions which
+    repeat them, and the duration and value are parsed once into a deadline and a key.
+
+    Decisions used to be passed around as dicts, they can still be read like them: decision[name]
+    and decision.get(name) return the name attribute, None values counting as missing for get(),
+    and keys(), items(), "name in decision" and dict(decision) cover every attribute below.
+
+    Attributes:
+        id (int): The id of the decision in LAPI.
+        origin (str): Where the decision comes from, eg "crowdsec", "cscli" or "CAPI".
+        scenario (str): The scenario which triggered the decision.
+        type (str): The action to take, eg "ban" or "captcha".
+        scope (str): The scope of the value, eg "Ip", "Range" or "Country".
+        value (str): The IP address, range or other item targeted by the decision.
+        deadline (float): The time.time() timestamp at which the decision expires, None if it
+            doesn't.
+        key (tuple): The key of value, (version, network address, prefix length) for IP
+            addresses and ranges, (scope, value) for anything else.
+        duration (str): The duration of the decision as sent by LAPI, eg "3h59m59s".
+        until (str): The date at which the decision expires as sent by LAPI, if it did.
+        simulated (bool): Whether the decision is only simulated, as sent by LAPI.
+        uuid (str): The uuid of the decision in LAPI, if it sent one.
+    """
+
+    __slots__ = (
+        "id",
+        "origin",
+        "scenario",
+        "type",
+        "scope",
+        "value",
+        "deadline",
+        "key",
+        "duration",
+        "until",
+        "simulated",
+        "uuid",
+    )
+
+    def __init__(
+        self,
+        id,
+        origin,
+        scenario,
+        type,
+        scope,
+        value,
+        deadline=None,
+        key=None,
+        duration=None,
+        until=None,
+        simulated=None,
+        uuid=None,
+    ):
+        self.id = id
+        self.origin = intern(origin)
+        self.scenario = intern(scenario)
+        self.type = intern(type)
+        self.scope = intern(scope)
+        self.value = value
+        self.deadline = deadline
+        self.key = item_to_key(value, scope) if key is None else key
+        self.duration = duration
+        self.until = until
+        self.simulated = simulated
+        self.uuid = uuid
+
+    @classmethod
+    def from_dict(cls, decision, now):
+        """
+        Returns the Decision of a decision object of a LAPI response, fetched at now.
+        """
+        return cls(
+            decision.get("id"),
+            decision.get("origin"),
+            decision.get("scenario"),
+            decision["type"],
+            decision.get("scope"),
+            decision["value"],
+            decision_deadline(decision, now),
+            decision_key(decision),
+            decision.get("duration"),
+            decision.get("until"),
+            decision.get("simulated"),
+            decision.get("uuid"),
+        )
+
+    @property
+    def is_ip(self):
+        return len(self.key) == 3
+
+    @property
+    def version(self):
+        """
+        The IP version of the address or range, None for other scopes.
+        """
+        return self.key[0] if self.is_ip else None
+
+    @property
+    def network(self):
+        """
+        The network address of the range as an integer, or the address, None for other scopes.
+        """
+        return self.key[1] if self.is_ip else None
+
+    @property
+    def prefix_length(self):
+        """
+        The prefix length of the range, 32 or 128 for an address, None for other scopes.
+        """
+        return self.key[2] if self.is_ip else None
+
+    def __getitem__(self, name):
+        if name not in self.__slots__:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def get(self, name, default=None):
+        value = getattr(self, name) if name in self.__slots__ else None
+        return default if value is None else value
+
+    def __contains__(self, name):
+        return name in self.__slots__
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def items(self):
+        return [(name, getattr(self, name)) for name in self.__slots__]
+
+    def values(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    def __eq__(self, other):
+        if not isinstance(other, Decision):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, name) for name in self.__slots__))
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"Decision({fields})"
@@ -0,0 +1,137 @@
+import codecs
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DECODER = json.JSONDecoder()
+
+WHITESPACE = " \t\n\r"
+
+
+def loads(data):
+    """
+    Decodes a whole JSON document with orjson if it is installed, with json otherwise.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def decode_value(text, position):
+    """
+    Returns the JSON value starting at position in text and the position right after it. Raises
+    ValueError if there is no valid value, eg because text ends before it does.
+    """
+    if orjson is not None and text.startswith("{", position):
+        # orjson can't decode a prefix, try every closing brace until the object is complete.
+        end = text.find("}", position)
+        while end != -1:
+            try:
+                return orjson.loads(text[position : end + 1]), end + 1
+            except orjson.JSONDecodeError:
+                end = text.find("}", end + 1)
+        raise ValueError("unterminated object")
+    return DECODER.raw_decode(text, position)
+
+
+class TextReader:
+    """
+    Text decoded from chunks of UTF-8 bytes, read as needed. Only the text from the current
+    position on is kept.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.text = ""
+        self.position = 0
+        self.done = False
+
+    def read(self):
+        """
+        Appends the next chunk to the text. Returns False if there is none left.
+        """
+        if self.done:
+            return False
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.done = True
+            text = self.decoder.decode(b"", final=True)
+        else:
+            text = self.decoder.decode(chunk)
+        self.text = self.text[self.position :] + text
+        self.position = 0
+        return True
+
+    def peek(self):
+        """
+        Skips whitespace and returns the next character, "" at the end of the text.
+        """
+        while True:
+            text, position = self.text, self.position
+            while position < len(text) and text[position] in WHITESPACE:
+                position += 1
+            self.position = position
+            if position < len(text):
+                return text[position]
+            if not self.read():
+                return ""
+
+    def expect(self, characters):
+        """
+        Skips whitespace and the next character, which must be one of characters. Returns it.
+        """
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError(f"expected one of {characters!r}, got {character!r}")
+        self.position += 1
+        return character
+
+    def value(self):
+        """
+        Skips whitespace and returns the next JSON value.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = decode_value(self.text, self.position)
+            except ValueError:
+                if self.read():
+                    continue
+                raise
+            # A number could go on in the next chunk.
+            if end < len(self.text) or not self.read():
+                self.position = end
+                return value
+
+
+def iter_decisions(chunks):
+    """
+    Yields (key, decision) for every decision of a /v1/decisions/stream response, eg
+    ("new", {"value": "1.2.3.4", ...}), as its body is read from chunks of bytes. Only the
+    decision being decoded is kept in memory, not the whole body.
+    """
+    reader = TextReader(chunks)
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+    while True:
+        key = reader.value()
+        reader.expect(":")
+        if reader.peek() == "[":
+            reader.position += 1
+            if reader.peek() == "]":
+                reader.position += 1
+            else:
+                while True:
+                    yield key, reader.value()
+                    if reader.expect(",]") == "]":
+                        break
+        else:
+            # null, when there are no such decisions.
+            reader.value()
+        if reader.expect(",}") == "}":
+            return
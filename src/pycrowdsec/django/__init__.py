@@ -3,6 +3,7 @@ from django.core.exceptions import PermissionDenied
 from django.urls import resolve
 
 from pycrowdsec.client import StreamClient
+from pycrowdsec.tracing import span
 
 
 def crowdsec_middleware(get_response):
@@ -28,14 +29,29 @@ def crowdsec_middleware(get_response):
         )
 
         settings.pycrowdsec_exclude_views = getattr(settings, "PYCROWDSEC_EXCLUDE_VIEWS", set())
+        settings.pycrowdsec_shared_cache_path = getattr(
+            settings, "PYCROWDSEC_SHARED_CACHE_PATH", None
+        )
+        settings.pycrowdsec_metrics = getattr(settings, "PYCROWDSEC_METRICS", None)
+        settings.pycrowdsec_tracer = getattr(settings, "PYCROWDSEC_TRACER", None)
 
     set_settings()
+    kwargs = {}
+    if settings.pycrowdsec_shared_cache_path:
+        # A single worker process polls LAPI for all of them.
+        kwargs = {
+            "shared_cache_path": settings.pycrowdsec_shared_cache_path,
+            "leader_election": True,
+        }
     client = StreamClient(
         api_key=settings.PYCROWDSEC_LAPI_KEY,
         interval=settings.pycrowdsec_poll_interval,
         lapi_url=settings.pycrowdsec_lapi_url,
         scopes=settings.pycrowdsec_scopes,
         user_agent=settings.pycrowdsec_user_agent,
+        metrics=settings.pycrowdsec_metrics,
+        tracer=settings.pycrowdsec_tracer,
+        **kwargs,
     )
 
     client.run()
@@ -47,16 +63,34 @@ def crowdsec_middleware(get_response):
         except:
             return get_response(request)
 
-        for request_transformer in settings.pycrowdsec_request_transformers:
-            val = request_transformer(request)
-            action = client.get_action_for(val)
-            response = get_response(request)
-            if action not in settings.pycrowdsec_actions:
-                return response
-            res = settings.pycrowdsec_actions[action](request)
-            if not res:
-                return response
+        res = remediate(request)
+        if res:
             return res
+        return get_response(request)
+
+    def remediate(request):
+        # The client records slow lookups.
+        with span(
+            settings.pycrowdsec_tracer, "pycrowdsec.request", path=request.path
+        ) as attributes:
+            attributes["lookups"] = 0
+            for request_transformer in settings.pycrowdsec_request_transformers:
+                scope = None
+                if isinstance(request_transformer, tuple):
+                    request_transformer, scope = request_transformer
+                val = request_transformer(request)
+                action = client.get_action_for(val, *(() if scope is None else (scope,)))
+                attributes["lookups"] += 1
+                if action not in settings.pycrowdsec_actions:
+                    continue
+                if settings.pycrowdsec_metrics is not None:
+                    settings.pycrowdsec_metrics.inc(
+                        "pycrowdsec_remediations_total", (("action", action),)
+                    )
+                attributes["action"] = action
+                res = settings.pycrowdsec_actions[action](request)
+                if res:
+                    return res
 
     return middleware
 
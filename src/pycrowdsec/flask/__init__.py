@@ -1,11 +1,15 @@
 from flask import request
 
+from pycrowdsec.tracing import span, timed_lookup
+
 
 def get_crowdsec_middleware(
     actions_by_name,
     crowdsec_cache,
     ip_transformers=[lambda request: request.remote_addr],
     exclude_views=(),
+    metrics=None,
+    tracer=None,
 ):
     """
     Returns a middleware function for flask, which can be registered by passsing it to app.before_request
@@ -24,24 +28,50 @@ def get_crowdsec_middleware(
             ip_transformers(Optional):
                 List of functions which take in the request and produce some other string.
                 This produced string is looked up in the cache, if found then then the remediation
-                is applied.
-                Eg: [lambda ip: ip, lambda ip: get_country_code_for(ip)]
+                is applied. The functions are tried in order until one produces a string with an
+                action. An element can also be a (function, scope) tuple, the produced string
+                is then only looked up in the decisions of that scope.
+                Eg: [lambda ip: ip, (lambda ip: get_country_code_for(ip), "country")]
 
             exclude_views(Optional):
                 List of view function names, to exclude crowdsec actions.
                 Example: ["ban_view", "captcha_page", "contact_page"]
+
+            metrics(Optional):
+                An instance of pycrowdsec.metrics.Metrics, which counts the applied remediations
+                by action.
+
+            tracer(Optional):
+                An instance of pycrowdsec.tracing.Tracer. Every request is traced as a
+                "pycrowdsec.request" span, with the number of lookups and the applied action,
+                and slow lookups are recorded.
     """
 
     def middleware():
-        for ip_transformer in ip_transformers:
-            action_name = crowdsec_cache.get(ip_transformer(request))
-            if not action_name:
-                return
-
-            destination_view = request.url_rule.endpoint
-            if destination_view in exclude_views:
-                return
-            if action_name in actions_by_name:
-                return actions_by_name[action_name]()
+        with span(tracer, "pycrowdsec.request", path=request.path) as attributes:
+            attributes["lookups"] = 0
+            for ip_transformer in ip_transformers:
+                scope = None
+                if isinstance(ip_transformer, tuple):
+                    ip_transformer, scope = ip_transformer
+                # Caches whose get() only takes the item are still supported.
+                action_name = timed_lookup(
+                    tracer,
+                    ip_transformer(request),
+                    crowdsec_cache.get,
+                    *(() if scope is None else (scope,)),
+                )
+                attributes["lookups"] += 1
+                if not action_name:
+                    continue
+
+                destination_view = request.url_rule.endpoint
+                if destination_view in exclude_views:
+                    return
+                if action_name in actions_by_name:
+                    if metrics is not None:
+                        metrics.inc("pycrowdsec_remediations_total", (("action", action_name),))
+                    attributes["action"] = action_name
+                    return actions_by_name[action_name]()
 
     return middleware
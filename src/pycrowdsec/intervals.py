@@ -0,0 +1,245 @@
+from array import array
+from bisect import bisect_left, bisect_right
+
+UINT32 = "I" if array("I").itemsize == 4 else "L"
+
+MASK64 = (1 << 64) - 1
+
+
+class NarrowColumn:
+    """
+    Sorted integers of at most 32 bits, in a single array.
+    """
+
+    def __init__(self):
+        self.values = array(UINT32)
+
+    def append(self, value):
+        self.values.append(value)
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+    def __len__(self):
+        return len(self.values)
+
+    def find(self, value):
+        """
+        Returns the index of the last element lower or equal to value, -1 if there is none.
+        """
+        return bisect_right(self.values, value) - 1
+
+    def nbytes(self):
+        return len(self.values) * self.values.itemsize
+
+    def arrays(self):
+        return [self.values]
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        column = cls.__new__(cls)
+        (column.values,) = arrays
+        return column
+
+
+class WideColumn:
+    """
+    Sorted integers of at most 128 bits, split in arrays of their high and low 64 bits.
+    """
+
+    def __init__(self):
+        self.high = array("Q")
+        self.low = array("Q")
+
+    def append(self, value):
+        self.high.append(value >> 64)
+        self.low.append(value & MASK64)
+
+    def __getitem__(self, index):
+        return (self.high[index] << 64) | self.low[index]
+
+    def __len__(self):
+        return len(self.high)
+
+    def find(self, value):
+        """
+        Returns the index of the last element lower or equal to value, -1 if there is none.
+        """
+        high = value >> 64
+        start = bisect_left(self.high, high)
+        end = bisect_right(self.high, high, start)
+        if start == end:
+            return end - 1
+        index = bisect_right(self.low, value & MASK64, start, end) - 1
+        return index if index >= start else start - 1
+
+    def nbytes(self):
+        return len(self.high) * self.high.itemsize * 2
+
+    def arrays(self):
+        return [self.high, self.low]
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        column = cls.__new__(cls)
+        column.high, column.low = arrays
+        return column
+
+
+def column_type(bits):
+    return NarrowColumn if bits <= 32 else WideColumn
+
+
+class IntervalTable:
+    """
+    Immutable longest prefix match table stored in flat arrays.
+
+    The prefixes are kept sorted by (network, prefix length) with a small integer code each.
+    They are also flattened into disjoint intervals covering the whole address space: an
+    interval starts at every address where the code of the longest matching prefix changes,
+    so a lookup is a single binary search for the last interval starting before the address.
+    Code 0 means that no prefix matches.
+
+    Args:
+        bits (int): The size of addresses, 32 or 128.
+        prefixes: (network, prefix length, code) tuples sorted by network then prefix length,
+            without duplicates.
+    """
+
+    def __init__(self, bits, prefixes=()):
+        self.bits = bits
+        column = column_type(bits)
+        self.nets = column()
+        self.plens = array("B")
+        self.codes = array("H")
+        self.starts = column()
+        self.interval_codes = array("H")
+
+        self.starts.append(0)
+        self.interval_codes.append(0)
+        stack = []
+        for net, plen, code in prefixes:
+            self.nets.append(net)
+            self.plens.append(plen)
+            self.codes.append(code)
+            # Close the prefixes which end before this one.
+            while stack and stack[-1][0] < net:
+                end, _ = stack.pop()
+                self._start_interval(end + 1, stack[-1][1] if stack else 0)
+            self._start_interval(net, code)
+            stack.append((net | ((1 << (bits - plen)) - 1), code))
+
+        while stack:
+            end, _ = stack.pop()
+            if end + 1 < 1 << bits:
+                self._start_interval(end + 1, stack[-1][1] if stack else 0)
+
+    def _start_interval(self, start, code):
+        starts, codes = self.starts, self.interval_codes
+        if starts[-1] == start:
+            codes[-1] = code
+            if len(codes) > 1 and codes[-2] == code:
+                # Same code as the previous interval, which now simply goes on.
+                self._pop_interval()
+        elif codes[-1] != code:
+            starts.append(start)
+            codes.append(code)
+
+    def _pop_interval(self):
+        self.interval_codes.pop()
+        if isinstance(self.starts, NarrowColumn):
+            self.starts.values.pop()
+        else:
+            self.starts.high.pop()
+            self.starts.low.pop()
+
+    def lookup(self, addr):
+        """
+        Returns the code of the longest prefix containing addr, 0 if there is none.
+        """
+        return self.interval_codes[self.starts.find(addr)]
+
+    def get(self, net, plen):
+        """
+        Returns the code of exactly net/plen, 0 if there is none.
+        """
+        nets, plens = self.nets, self.plens
+        index = nets.find(net)
+        # Prefixes of the same network are sorted by prefix length, before the next network.
+        while index >= 0 and nets[index] == net:
+            if plens[index] == plen:
+                return self.codes[index]
+            index -= 1
+        return 0
+
+    def items(self):
+        """
+        Yields (network, prefix length, code) for every prefix, in order.
+        """
+        nets, plens, codes = self.nets, self.plens, self.codes
+        for index in range(len(plens)):
+            yield nets[index], plens[index], codes[index]
+
+    def __len__(self):
+        return len(self.plens)
+
+    def arrays(self):
+        """
+        Returns the arrays holding the table, from_arrays() takes them back. Any buffer of the
+        same item type can stand in for an array, eg a memoryview of a memory mapped file.
+        """
+        return [
+            *self.nets.arrays(),
+            self.plens,
+            self.codes,
+            *self.starts.arrays(),
+            self.interval_codes,
+        ]
+
+    @classmethod
+    def from_arrays(cls, bits, arrays):
+        column = column_type(bits)
+        width = len(column().arrays())
+        table = cls.__new__(cls)
+        table.bits = bits
+        table.nets = column.from_arrays(arrays[:width])
+        table.plens, table.codes = arrays[width : width + 2]
+        table.starts = column.from_arrays(arrays[width + 2 : 2 * width + 2])
+        table.interval_codes = arrays[2 * width + 2]
+        return table
+
+    def nbytes(self):
+        return (
+            self.nets.nbytes()
+            + len(self.plens)
+            + len(self.codes) * 2
+            + self.starts.nbytes()
+            + len(self.interval_codes) * 2
+        )
+
+
+def merge_prefixes(prefixes, changes):
+    """
+    Yields the sorted (network, prefix length, code) tuples of prefixes after applying changes.
+
+    Both arguments are sorted by network then prefix length. A change with a code of 0 deletes
+    the prefix, any other code replaces or inserts it.
+    """
+    changes = iter(changes)
+    change = next(changes, None)
+    for prefix in prefixes:
+        while change is not None and change[:2] < prefix[:2]:
+            if change[2]:
+                yield change
+            change = next(changes, None)
+        if change is not None and change[:2] == prefix[:2]:
+            if change[2]:
+                yield change
+            change = next(changes, None)
+        else:
+            yield prefix
+
+    while change is not None:
+        if change[2]:
+            yield change
+        change = next(changes, None)
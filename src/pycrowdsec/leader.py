@@ -0,0 +1,115 @@
+import os
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+# Extends the lease of KEYS[1] by ARGV[2] milliseconds if it is still held with the ARGV[1] token.
+RENEW_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("PEXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Deletes the lease of KEYS[1] if it is still held with the ARGV[1] token.
+RELEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+
+class LeadershipLost(Exception):
+    """
+    Raised during a cycle when the client isn't the leader anymore, so that it doesn't write
+    what it fetched.
+    """
+
+
+class FileLockElection:
+    """
+    Elects the process holding an exclusive flock() on path. The lock goes away with the
+    process holding it, so another process takes over at its next acquire().
+    """
+
+    # The lock doesn't expire, it doesn't need renewing.
+    renew_interval = None
+
+    def __init__(self, path):
+        if fcntl is None:
+            raise RuntimeError("pycrowdsec file lock leader election requires fcntl")
+        self.path = path
+        self.fd = None
+
+    def acquire(self):
+        """
+        Returns whether this instance is the leader, trying to become it if it isn't.
+        """
+        if self.fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self.fd = fd
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def after_fork(self):
+        """
+        Gives up the leadership in a child process. The lock stays held by the parent, closing
+        the inherited descriptor doesn't release it.
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class RedisLeaseElection:
+    """
+    Elects the client holding the redis key as a lease. The leader extends the lease on every
+    acquire(), another client takes over once the lease expired, at most lease_duration seconds
+    after the leader stopped renewing it. A long operation of the leader must call acquire()
+    at least every renew_interval seconds.
+    """
+
+    def __init__(self, redis_connection, key="pycrowdsec_leader", lease_duration=45):
+        self.redis = redis_connection
+        self.key = key
+        self.lease_duration = lease_duration
+        self.token = uuid.uuid4().hex
+        self.renew_script = self.redis.register_script(RENEW_SCRIPT)
+        self.release_script = self.redis.register_script(RELEASE_SCRIPT)
+
+    @property
+    def renew_interval(self):
+        return self.lease_duration / 3
+
+    def acquire(self):
+        """
+        Returns whether this instance is the leader, trying to become it if it isn't.
+        """
+        milliseconds = int(self.lease_duration * 1000)
+        if self.redis.set(self.key, self.token, nx=True, px=milliseconds):
+            return True
+        return bool(self.renew_script(keys=[self.key], args=[self.token, milliseconds]))
+
+    def release(self):
+        self.release_script(keys=[self.key], args=[self.token])
+
+    def after_fork(self):
+        """
+        Gives up the leadership in a child process, which must not renew the lease of its
+        parent.
+        """
+        self.token = uuid.uuid4().hex
@@ -0,0 +1,235 @@
+import bisect
+import threading
+import weakref
+
+# Upper bounds in seconds of the lookup latency histogram buckets.
+LOOKUP_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 1e-3, 1e-2, 0.1, 1)
+
+# Upper bounds in seconds of the poll cycle duration histogram buckets.
+CYCLE_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+
+# name -> (type, help, histogram buckets) of every metric.
+METRICS = {
+    "pycrowdsec_lookups_total": (
+        "counter",
+        "Lookups by backend, and by result: hit if a decision matched, miss if none did, "
+        "error if the lookup failed.",
+        None,
+    ),
+    "pycrowdsec_lookup_duration_seconds": (
+        "histogram",
+        "Lookup latency by backend.",
+        LOOKUP_BUCKETS,
+    ),
+    "pycrowdsec_cycles_total": ("counter", "Poll cycles by result, ok or error.", None),
+    "pycrowdsec_cycle_duration_seconds": ("histogram", "Poll cycle duration.", CYCLE_BUCKETS),
+    "pycrowdsec_cycle_payload_bytes_total": ("counter", "Bytes of LAPI stream responses.", None),
+    "pycrowdsec_cycle_decisions_total": (
+        "counter",
+        "Decisions of LAPI stream responses, by kind: new or deleted.",
+        None,
+    ),
+    "pycrowdsec_decisions": ("gauge", "Stored decisions by scope.", None),
+    "pycrowdsec_remediations_total": ("counter", "Remediations applied by action.", None),
+}
+
+
+def lookup_keys(backend):
+    """
+    Returns the keys of the miss and hit counters, of the latency histogram and of the error
+    counter of backend.
+    """
+    return (
+        ("pycrowdsec_lookups_total", (("backend", backend), ("result", "miss"))),
+        ("pycrowdsec_lookups_total", (("backend", backend), ("result", "hit"))),
+        ("pycrowdsec_lookup_duration_seconds", (("backend", backend),)),
+        ("pycrowdsec_lookups_total", (("backend", backend), ("result", "error"))),
+    )
+
+
+# backend -> lookup_keys(backend)
+LOOKUP_KEYS = {}
+
+
+class ShardHolder:
+    pass
+
+
+def format_labels(labels):
+    return ",".join(f'{name}="{value}"' for name, value in labels)
+
+
+def format_series(name, labels):
+    return f"{name}{{{labels}}}" if labels else name
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """
+    Counters and histograms of lookups, poll cycles and remediations, and gauges read on
+    collection, eg the number of stored decisions. A single instance can be shared by the
+    caches, clients and middlewares of a process.
+
+    Every thread updates its own shard without locking, shards are only summed by collect(),
+    stats() and prometheus(). Metrics are identified by name and a tuple of (label, value)
+    pairs, eg ("pycrowdsec_lookups_total", (("backend", "memory"), ("result", "hit"))).
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []
+        # Shards of the threads which exited, and their totals once collected.
+        self.retiring = []
+        self.retired = {}
+        # name -> references to the functions returning {labels: value}.
+        self.gauges = {}
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            pass
+        shard = {}
+        # The holder goes away with the thread. The finalizer can run at any time, eg during a
+        # garbage collection while the lock is held, so it doesn't lock.
+        self.local.holder = ShardHolder()
+        weakref.finalize(self.local.holder, self.retiring.append, shard)
+        with self.lock:
+            self.shards.append(shard)
+        self.local.shard = shard
+        return shard
+
+    @staticmethod
+    def merge(totals, shard):
+        for key, value in list(shard.items()):
+            if isinstance(value, list):
+                total = totals.setdefault(key, [0] * len(value))
+                for i, count in enumerate(value):
+                    total[i] += count
+            else:
+                totals[key] = totals.get(key, 0) + value
+
+    def inc(self, name, labels=(), amount=1):
+        shard = self.shard()
+        key = name, labels
+        shard[key] = shard.get(key, 0) + amount
+
+    def observe(self, name, value, labels=()):
+        """
+        Records value in the name histogram: a count per bucket, the +Inf bucket included, then
+        the sum and the count of the values.
+        """
+        shard = self.shard()
+        key = name, labels
+        histogram = shard.get(key)
+        buckets = METRICS[name][2]
+        if histogram is None:
+            histogram = shard[key] = [0] * (len(buckets) + 3)
+        histogram[bisect.bisect_left(buckets, value)] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def record_lookup(self, backend, hit, duration):
+        """
+        Records a lookup of backend: a hit if hit is True, a miss if it is False and an error if
+        it is None.
+        """
+        # On the hot path of lookups, the generic inc() and observe() are inlined.
+        shard = self.shard()
+        keys = LOOKUP_KEYS.get(backend)
+        if keys is None:
+            keys = LOOKUP_KEYS[backend] = lookup_keys(backend)
+        count_key = keys[3] if hit is None else keys[hit]
+        shard[count_key] = shard.get(count_key, 0) + 1
+        histogram = shard.get(keys[2])
+        if histogram is None:
+            histogram = shard[keys[2]] = [0] * (len(LOOKUP_BUCKETS) + 3)
+        histogram[bisect.bisect_left(LOOKUP_BUCKETS, duration)] += 1
+        histogram[-2] += duration
+        histogram[-1] += 1
+
+    def register_gauge(self, name, function):
+        """
+        Reads the name gauges from function on collection. function returns {labels: value}.
+        The values of all the functions registered under name are summed by labels, eg the
+        decisions stored by several caches. A bound method is only weakly referenced, so that
+        its gauges go away with its object.
+        """
+        if hasattr(function, "__self__"):
+            reference = weakref.WeakMethod(function)
+        else:
+            reference = lambda: function  # noqa: E731
+        with self.lock:
+            self.gauges.setdefault(name, []).append(reference)
+
+    def read_gauges(self, totals):
+        with self.lock:
+            functions = []
+            for name, references in self.gauges.items():
+                # Drops the gauges of the objects which went away.
+                references[:] = [reference for reference in references if reference() is not None]
+                functions.extend((name, reference()) for reference in references)
+        for name, function in functions:
+            if function is None:
+                continue
+            for labels, value in function().items():
+                totals[name, labels] = totals.get((name, labels), 0) + value
+
+    def collect(self):
+        """
+        Returns {(name, labels): value} of every metric, a list of the counts of every bucket,
+        the +Inf bucket included, then the sum and the count of the values for histograms.
+        """
+        with self.lock:
+            while self.retiring:
+                shard = self.retiring.pop()
+                self.shards = [s for s in self.shards if s is not shard]
+                self.merge(self.retired, shard)
+            totals = {}
+            self.merge(totals, self.retired)
+            shards = list(self.shards)
+        for shard in shards:
+            self.merge(totals, dict(shard))
+        self.read_gauges(totals)
+        return totals
+
+    def stats(self):
+        """
+        Returns {name: {labels: value}} of every metric, with labels formatted as in
+        prometheus(), eg 'backend="memory",result="hit"'. Histograms are given as
+        {"buckets": {upper bound: cumulative count}, "sum": sum, "count": count}.
+        """
+        stats = {}
+        for (name, labels), value in sorted(self.collect().items()):
+            if isinstance(value, list):
+                bounds = METRICS[name][2] + (float("inf"),)
+                counts = [sum(value[: i + 1]) for i in range(len(bounds))]
+                value = {"buckets": dict(zip(bounds, counts)), "sum": value[-2], "count": value[-1]}
+            stats.setdefault(name, {})[format_labels(labels)] = value
+        return stats
+
+    def prometheus(self):
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        stats = self.stats()
+        for name, series in stats.items():
+            kind, help, _ = METRICS.get(name, ("untyped", name, None))
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in series.items():
+                if kind != "histogram":
+                    lines.append(f"{format_series(name, labels)} {format_value(value)}")
+                    continue
+                separator = "," if labels else ""
+                for bound, count in value["buckets"].items():
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'{name}_bucket{{{labels}{separator}le="{le}"}} {count}')
+                lines.append(f"{format_series(name + '_sum', labels)} {format_value(value['sum'])}")
+                lines.append(f"{format_series(name + '_count', labels)} {value['count']}")
+        return "\n".join(lines) + "\n"
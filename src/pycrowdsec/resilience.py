@@ -0,0 +1,101 @@
+import random
+import threading
+from time import monotonic
+
+from requests.exceptions import ChunkedEncodingError, ConnectionError, HTTPError, Timeout
+
+# What a client does when LAPI can't answer a lookup: raise the error, return no action, or
+# return the fail closed action.
+FAILURE_POLICIES = ("raise", "open", "closed")
+
+# Errors of requests which are worth retrying.
+TRANSIENT_ERRORS = (ConnectionError, Timeout, ChunkedEncodingError)
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of querying LAPI while it is considered down.
+    """
+
+
+def is_transient(error, transient_errors=TRANSIENT_ERRORS):
+    """
+    Returns whether a request which failed with error can succeed if it is retried: connection
+    errors, timeouts, 5XX and 429 responses.
+    """
+    if isinstance(error, HTTPError):
+        status = error.response.status_code if error.response is not None else None
+    else:
+        # aiohttp.ClientResponseError
+        status = getattr(error, "status", None)
+    if status is not None:
+        return status >= 500 or status == 429
+    return isinstance(error, transient_errors)
+
+
+def backoff_delay(attempt, base, maximum):
+    """
+    Returns the number of seconds to wait before retry number attempt, starting from 0: a random
+    delay up to base * 2 ** attempt, capped to maximum ("full jitter").
+    """
+    return random.uniform(0, min(maximum, base * 2**attempt))
+
+
+def apply_failure_policy(policy, error, fail_closed_action):
+    """
+    Returns the action of a lookup which failed with error according to policy, or raises error.
+    """
+    if policy == "open":
+        return None
+    if policy == "closed":
+        return fail_closed_action
+    raise error
+
+
+class CircuitBreaker:
+    """
+    Stops calls to a backend after failure_threshold consecutive failures, for reset_timeout
+    seconds. A single trial call is then allowed: the circuit closes again if it succeeds, and
+    stays open for another reset_timeout if it fails.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if self.trial or monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        """
+        Returns whether a call can be made now.
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial or monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.trial = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial = False
+            if self.failures >= self.failure_threshold:
+                self.opened_at = monotonic()
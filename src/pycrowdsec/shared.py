@@ -0,0 +1,103 @@
+import os
+import threading
+import time
+
+from pycrowdsec.cache import Cache
+from pycrowdsec.snapshot import load_table, map_file, write_table
+
+
+class SharedCache(Cache):
+    """
+    Compact decision cache published to a memory mapped file, so that all the processes of a
+    host, eg the workers of a gunicorn or uwsgi server, can share the decisions fetched by a
+    single one of them.
+
+    The writer publishes its table to path after every transaction which changed it. Readers
+    map the latest file and look decisions up in it in place, the IP decisions are not copied
+    into each process. They check whether the file was replaced at most once every
+    check_interval seconds, so they can lag that long behind the writer. Since files are
+    replaced by a rename, a reader either sees a whole previous table or the whole new one.
+
+    Args:
+        path (str): The file the table is published to.
+        writer (bool): Whether this instance applies changes and publishes them. Readers can't
+            be written to.
+        check_interval (float): Maximum number of seconds before a reader sees a new table.
+        metrics (pycrowdsec.metrics.Metrics): Records the count and latency of lookups, and the
+            number of decisions per scope.
+    """
+
+    metrics_backend = "shared"
+
+    def __init__(self, path, writer=False, check_interval=1.0, metrics=None):
+        super().__init__(compact=True, metrics=metrics)
+        self.path = path
+        self.writer = writer
+        self.check_interval = check_interval
+        self.next_check = 0
+        self.published = False
+        self.file_id = None
+        self.refresh_lock = threading.Lock()
+
+    def after_fork(self):
+        super().after_fork()
+        self.refresh_lock = threading.Lock()
+
+    def transaction(self, replace=False):
+        if not self.writer:
+            raise RuntimeError("pycrowdsec shared cache readers can't be written to")
+        return super().transaction(replace)
+
+    def publish(self, table):
+        previous = self.table
+        changed = (
+            not self.published
+            or table.intervals != previous.intervals
+            or table.owned_scopes
+            or table.scopes.keys() != previous.scopes.keys()
+        )
+        self.table = table
+        if changed:
+            write_table(self.table, self.path, self.deadlines)
+            self.published = True
+
+    def refresh(self, force=False):
+        """
+        Loads the table last published to path if it changed since the last check. Does nothing
+        for the writer.
+        """
+        now = time.monotonic()
+        if self.writer or (not force and now < self.next_check):
+            return
+        # Concurrent lookups keep using the current table while one of them reloads it.
+        if not self.refresh_lock.acquire(blocking=force):
+            return
+        try:
+            self.next_check = now + self.check_interval
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                return
+            if (stat.st_ino, stat.st_mtime_ns) == self.file_id:
+                return
+            buffer, stat = map_file(self.path)
+            self.table = load_table(buffer)
+            self.file_id = stat.st_ino, stat.st_mtime_ns
+        finally:
+            self.refresh_lock.release()
+
+    def get(self, item, scope=None):
+        self.refresh()
+        return super().get(item, scope)
+
+    def get_all(self):
+        self.refresh()
+        return self.table.get_all()
+
+    def scope_sizes(self):
+        self.refresh()
+        return super().scope_sizes()
+
+    def __len__(self):
+        self.refresh()
+        return len(self.table)
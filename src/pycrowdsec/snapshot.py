@@ -0,0 +1,162 @@
+import json
+import mmap
+import os
+import struct
+import sys
+
+from pycrowdsec.cache import ADDRESS_BITS, CompactTable, CowDict, key_to_string, string_to_key
+from pycrowdsec.intervals import IntervalTable
+
+MAGIC = b"PYCSDEC1"
+
+# Magic, then the sizes of the JSON header and of the JSON deadlines which follow it.
+PREAMBLE = struct.Struct("<8sQQ")
+
+# Arrays start at offsets aligned to their largest item size.
+ALIGNMENT = 8
+
+
+def aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def typecode(array):
+    # Arrays of loaded tables are memoryviews.
+    return array.format if isinstance(array, memoryview) else array.typecode
+
+
+def compact_table(table):
+    """
+    Returns table as a frozen CompactTable.
+    """
+    if isinstance(table, CompactTable):
+        return table
+    compact = CompactTable()
+    compact.scopes = table.scopes
+    for version, net, plen, action in table.ip_items():
+        compact.insert_ip((version, net, plen), action)
+    return compact.freeze()
+
+
+def dump_table(table, file, deadlines=None):
+    """
+    Writes a frozen table and the deadlines of its items to the binary file.
+
+    The file holds a JSON header with the actions, the non IP decisions and the layout of the
+    IP decision arrays, then the deadlines as JSON, then the raw arrays in native byte order,
+    so that load_table() can use them in place.
+    """
+    table = compact_table(table)
+    arrays = {version: table.intervals[version].arrays() for version in ADDRESS_BITS}
+    header = json.dumps(
+        {
+            "byteorder": sys.byteorder,
+            "actions": table.actions,
+            "scopes": {scope: dict(values.items()) for scope, values in table.scopes.items()},
+            "arrays": {
+                version: [[typecode(array), len(array)] for array in version_arrays]
+                for version, version_arrays in arrays.items()
+            },
+        }
+    ).encode()
+    deadlines = json.dumps(
+        {key_to_string(key): deadline for key, deadline in (deadlines or {}).items()}
+    ).encode()
+    file.write(PREAMBLE.pack(MAGIC, len(header), len(deadlines)))
+    file.write(header)
+    file.write(deadlines)
+    offset = PREAMBLE.size + len(header) + len(deadlines)
+    for version_arrays in arrays.values():
+        for array in version_arrays:
+            padding = aligned(offset) - offset
+            file.write(bytes(padding))
+            file.write(array)
+            offset += padding + len(array) * array.itemsize
+
+
+def load_table(buffer):
+    """
+    Returns the CompactTable dumped in buffer, eg a memory mapped file. The IP decision arrays
+    are memoryviews of buffer, only the actions and the non IP decisions are copied.
+    """
+    magic, header_size, deadlines_size = PREAMBLE.unpack_from(buffer)
+    if magic != MAGIC:
+        raise ValueError("not a pycrowdsec decision table")
+    offset = PREAMBLE.size + header_size
+    header = json.loads(bytes(buffer[PREAMBLE.size : offset]))
+    offset += deadlines_size
+    if header["byteorder"] != sys.byteorder:
+        raise ValueError("decision table was written with another byte order")
+
+    view = memoryview(buffer)
+    table = CompactTable()
+    table.actions = header["actions"]
+    table.codes = {action: code for code, action in enumerate(table.actions) if code}
+    table.scopes = {scope: CowDict(values.items()) for scope, values in header["scopes"].items()}
+    for version, bits in ADDRESS_BITS.items():
+        arrays = []
+        for item_type, length in header["arrays"][str(version)]:
+            offset = aligned(offset)
+            size = length * struct.calcsize(item_type)
+            arrays.append(view[offset : offset + size].cast(item_type))
+            offset += size
+        table.intervals[version] = IntervalTable.from_arrays(bits, arrays)
+    return table
+
+
+def load_deadlines(buffer):
+    """
+    Returns the deadlines by key dumped in buffer along with a table.
+    """
+    _, header_size, deadlines_size = PREAMBLE.unpack_from(buffer)
+    offset = PREAMBLE.size + header_size
+    deadlines = json.loads(bytes(buffer[offset : offset + deadlines_size]))
+    return {string_to_key(field): deadline for field, deadline in deadlines.items()}
+
+
+def map_file(path):
+    """
+    Returns a read only memory map of the file at path, and the stat of the mapped file.
+    """
+    with open(path, "rb") as file:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ), os.fstat(file.fileno())
+
+
+def write_table(table, path, deadlines=None):
+    """
+    Atomically replaces the file at path with the dump of table: the dump is written next to it
+    and renamed over it, so that readers either open the previous file or the new one.
+    """
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temporary_path, "wb") as file:
+            dump_table(table, file, deadlines)
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+def save_snapshot(cache, path):
+    """
+    Atomically writes the decisions of a Cache and their deadlines to path.
+    """
+    table, deadlines = cache.snapshot()
+    write_table(table, path, deadlines)
+
+
+def load_snapshot(cache, path):
+    """
+    Replaces the decisions of a Cache with those saved to path by save_snapshot(). Returns
+    False if there is no such file.
+
+    The IP decisions are used in place from a memory map of the file, so that loading takes
+    about as long as reading the non IP decisions and the deadlines.
+    """
+    try:
+        buffer, _ = map_file(path)
+    except FileNotFoundError:
+        return False
+    cache.restore(load_table(buffer), load_deadlines(buffer))
+    return True
@@ -0,0 +1,119 @@
+import logging
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from time import perf_counter, time
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+logger = logging.getLogger(__name__)
+
+
+def otel_attributes(attributes):
+    # OpenTelemetry only accepts str, bool, int and float values.
+    return {
+        name: value if isinstance(value, (str, bool, int, float)) else str(value)
+        for name, value in attributes.items()
+        if value is not None
+    }
+
+
+class Tracer:
+    """
+    Hook points around the phases of poll cycles, eg "pycrowdsec.fetch", and around the checks
+    of requests by the middlewares. A single instance can be shared by the clients and
+    middlewares of a process.
+
+    Every span calls each hook with its name, its duration in seconds, a dict of attributes
+    and the exception it raised, None if it didn't. When opentelemetry is installed, spans are
+    also OpenTelemetry spans of the "pycrowdsec" tracer, unless opentelemetry is False.
+
+    Lookups taking slow_lookup_threshold seconds or more are kept in slow_lookups as
+    (time() timestamp, item, duration) tuples, up to the max_slow_lookups latest ones. They
+    are also reported to the hooks as "pycrowdsec.slow_lookup" spans, and as events of the
+    current OpenTelemetry span.
+    """
+
+    def __init__(
+        self, hooks=(), opentelemetry=True, slow_lookup_threshold=None, max_slow_lookups=100
+    ):
+        self.hooks = list(hooks)
+        self.otel_tracer = None
+        if opentelemetry and trace is not None:
+            self.otel_tracer = trace.get_tracer("pycrowdsec")
+        self.slow_lookup_threshold = slow_lookup_threshold
+        self.slow_lookups = deque(maxlen=max_slow_lookups)
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def call_hooks(self, name, duration, attributes, error):
+        for hook in self.hooks:
+            try:
+                hook(name, duration, attributes, error)
+            except Exception as e:
+                logger.error(f"pycrowdsec got error {e} in tracing hook {hook!r}")
+
+    def otel_span(self, name):
+        if self.otel_tracer is None:
+            return nullcontext()
+        return self.otel_tracer.start_as_current_span(name)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """
+        Times the block as the name span. Yields the attributes of the span, which the block
+        can add to.
+        """
+        error = None
+        with self.otel_span(name) as otel_span:
+            start = perf_counter()
+            try:
+                yield attributes
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                duration = perf_counter() - start
+                if otel_span is not None:
+                    otel_span.set_attributes(otel_attributes(attributes))
+                self.call_hooks(name, duration, attributes, error)
+
+    def record_lookup(self, item, duration):
+        """
+        Records the lookup of item if it took longer than slow_lookup_threshold.
+        """
+        if self.slow_lookup_threshold is None or duration < self.slow_lookup_threshold:
+            return
+        self.slow_lookups.append((time(), item, duration))
+        attributes = {"item": str(item)}
+        if self.otel_tracer is not None:
+            trace.get_current_span().add_event(
+                "pycrowdsec.slow_lookup", {"item": str(item), "duration": duration}
+            )
+        self.call_hooks("pycrowdsec.slow_lookup", duration, attributes, None)
+
+
+def span(tracer, name, **attributes):
+    """
+    Returns the context manager of tracer.span(name, **attributes), or a no-op one yielding
+    attributes if tracer is None.
+    """
+    if tracer is None:
+        return nullcontext(attributes)
+    return tracer.span(name, **attributes)
+
+
+def timed_lookup(tracer, item, function, *args):
+    """
+    Returns function(item, *args), recording its duration as the lookup of item in tracer.
+    """
+    if tracer is None:
+        return function(item, *args)
+    start = perf_counter()
+    try:
+        return function(item, *args)
+    finally:
+        tracer.record_lookup(item, perf_counter() - start)
@@ -0,0 +1,183 @@
+class _Node:
+    __slots__ = ("net", "plen", "value", "left", "right", "owner")
+
+    def __init__(self, net, plen, value=None, owner=None):
+        self.net = net
+        self.plen = plen
+        self.value = value
+        self.left = None
+        self.right = None
+        self.owner = owner
+
+
+class PrefixTrie:
+    """
+    Path compressed binary trie (Patricia trie) over integer network addresses.
+
+    Every node stores a network as an integer address plus a prefix length, only nodes
+    which carry a value or branch into two subtrees are kept. A lookup walks from the root
+    towards the address and remembers the last value it saw, which is the longest prefix
+    match.
+
+    copy() is O(1): both tries keep sharing their nodes and a node is only copied when one
+    of them modifies it. A trie which is not modified anymore can be read from any number
+    of threads while its copies are being written to.
+    """
+
+    def __init__(self, bits):
+        self.bits = bits
+        self.token = object()
+        self.root = _Node(0, 0, owner=self.token)
+        self.size = 0
+
+    def copy(self):
+        # Neither trie owns the shared nodes anymore, so both of them copy before writing.
+        self.token = object()
+        trie = PrefixTrie(self.bits)
+        trie.root = self.root
+        trie.size = self.size
+        return trie
+
+    def _own(self, node):
+        if node.owner is self.token:
+            return node
+        copy = _Node(node.net, node.plen, node.value, owner=self.token)
+        copy.left = node.left
+        copy.right = node.right
+        return copy
+
+    def _own_child(self, parent, child):
+        owned = self._own(child)
+        if owned is not child:
+            self._replace(parent, child, owned)
+        return owned
+
+    def _mask(self, plen):
+        return ((1 << plen) - 1) << (self.bits - plen)
+
+    def _bit(self, net, position):
+        return (net >> (self.bits - 1 - position)) & 1
+
+    def _attach(self, parent, child):
+        if self._bit(child.net, parent.plen):
+            parent.right = child
+        else:
+            parent.left = child
+
+    def _replace(self, parent, old, new):
+        if parent.left is old:
+            parent.left = new
+        else:
+            parent.right = new
+
+    def lookup(self, addr):
+        """
+        Returns the value of the longest prefix containing addr, None if there is none.
+        """
+        bits = self.bits
+        node = self.root
+        found = None
+        while node is not None:
+            plen = node.plen
+            if (addr ^ node.net) >> (bits - plen):
+                break
+            if node.value is not None:
+                found = node.value
+            if plen == bits:
+                break
+            node = node.right if (addr >> (bits - 1 - plen)) & 1 else node.left
+        return found
+
+    def get(self, net, plen):
+        """
+        Returns the value stored for exactly net/plen, None if there is none.
+        """
+        node = self.root
+        while node is not None and node.plen < plen:
+            node = node.right if self._bit(net, node.plen) else node.left
+        if node is None or node.plen != plen or node.net != net:
+            return None
+        return node.value
+
+    def insert(self, net, plen, value):
+        """
+        Stores value for net/plen. net must not have any bits set after plen.
+        """
+        node = self.root = self._own(self.root)
+        while node.plen < plen:
+            child = node.right if self._bit(net, node.plen) else node.left
+            if child is None:
+                self._attach(node, _Node(net, plen, value, owner=self.token))
+                self.size += 1
+                return
+
+            common = min(plen, child.plen, self.bits - (net ^ child.net).bit_length())
+            if common == child.plen:
+                node = self._own_child(node, child)
+                continue
+
+            if common == plen:
+                new = _Node(net, plen, value, owner=self.token)
+                self._attach(new, child)
+                self._replace(node, child, new)
+                self.size += 1
+                return
+
+            glue = _Node(net & self._mask(common), common, owner=self.token)
+            self._attach(glue, child)
+            self._attach(glue, _Node(net, plen, value, owner=self.token))
+            self._replace(node, child, glue)
+            self.size += 1
+            return
+
+        if node.value is None:
+            self.size += 1
+        node.value = value
+
+    def delete(self, net, plen):
+        """
+        Removes the value stored for exactly net/plen. Returns whether there was one.
+        """
+        if self.get(net, plen) is None:
+            return False
+
+        path = []
+        node = self.root = self._own(self.root)
+        while node.plen < plen:
+            path.append(node)
+            node = self._own_child(node, node.right if self._bit(net, node.plen) else node.left)
+
+        node.value = None
+        self.size -= 1
+        if not path:
+            return True
+
+        parent = path[-1]
+        if node.left is not None and node.right is not None:
+            return True
+        if node.left is not None or node.right is not None:
+            self._replace(parent, node, node.left or node.right)
+            return True
+
+        self._replace(parent, node, None)
+        if len(path) > 1 and parent.value is None:
+            # parent was a glue node for the branch we just removed, splice it out too.
+            self._replace(path[-2], parent, parent.left or parent.right)
+        return True
+
+    def items(self):
+        """
+        Yields (net, plen, value) for every stored prefix.
+        """
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.value is not None:
+                yield node.net, node.plen, node.value
+            if node.right is not None:
+                stack.append(node.right)
+            if node.left is not None:
+                stack.append(node.left)
+
+    def __len__(self):
+        return self.size
@@ -1,3 +1,33 @@
+import re
+
+DURATION_UNITS = {
+    "h": 3600,
+    "m": 60,
+    "s": 1,
+    "ms": 1e-3,
+    "us": 1e-6,
+    "\u00b5s": 1e-6,
+    "\u03bcs": 1e-6,
+    "ns": 1e-9,
+}
+
+DURATION_PART = re.compile(r"(\d+\.?\d*|\.\d+)(h|ms|m|s|us|\u00b5s|\u03bcs|ns)")
+
+
+def parse_duration(duration):
+    """
+    Returns the number of seconds in a Go formatted duration, eg "-40h37m10.022674981s".
+    """
+    body = duration.lstrip("+-")
+    if body == "0":
+        return 0.0
+    parts = DURATION_PART.findall(body)
+    if not parts or "".join(number + unit for number, unit in parts) != body:
+        raise ValueError(f"invalid duration {duration!r}")
+    seconds = sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+    return -seconds if duration.startswith("-") else seconds
+
+
 def get_geoip_looker(db_path, scope="city"):
     import geoip2.database
     from geoip2.errors import AddressNotFoundError
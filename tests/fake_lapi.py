@@ -0,0 +1,76 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeLAPI:
+    """
+    Local HTTP server answering /v1/decisions/stream and /v1/decisions requests.
+
+    stream_responses maps the value of the "startup" parameter to the response to send,
+    decisions maps IPs to the decisions returned by /v1/decisions. Every request is recorded as
+    a (path, query parameters, headers) tuple, and answered after delay seconds.
+    max_concurrent is the highest number of requests handled at once. The next requests are
+    answered with the status codes of errors, if any, instead.
+    """
+
+    def __init__(self):
+        self.stream_responses = {"true": {"new": None, "deleted": None}}
+        self.decisions = {}
+        self.requests = []
+        self.delay = 0
+        self.errors = []
+        self.lock = threading.Lock()
+        self.concurrent = 0
+        self.max_concurrent = 0
+        lapi = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                lapi.requests.append((url.path, params, dict(self.headers)))
+                with lapi.lock:
+                    lapi.concurrent += 1
+                    lapi.max_concurrent = max(lapi.max_concurrent, lapi.concurrent)
+                time.sleep(lapi.delay)
+                with lapi.lock:
+                    lapi.concurrent -= 1
+                    error = lapi.errors.pop(0) if lapi.errors else None
+                if error is not None:
+                    self.send_error(error)
+                    return
+                if url.path == "/v1/decisions/stream":
+                    response = lapi.stream_responses.get(params.get("startup"))
+                    if response is None:
+                        response = {"new": None, "deleted": None}
+                elif url.path == "/v1/decisions":
+                    response = lapi.decisions.get(params.get("ip"))
+                else:
+                    self.send_error(404)
+                    return
+                body = json.dumps(response).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True
+        )
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,196 @@
+import asyncio
+import unittest
+
+import pytest
+
+aiohttp = pytest.importorskip("aiohttp")
+
+from aiohttp import web  # noqa: E402
+from aiohttp.test_utils import TestServer  # noqa: E402
+
+from pycrowdsec.aio import AsyncQueryClient, AsyncStreamClient  # noqa: E402
+from pycrowdsec.tracing import Tracer  # noqa: E402
+
+
+class FakeLAPI:
+    """
+    aiohttp server answering /v1/decisions/stream with stream_responses[startup] and
+    /v1/decisions with decisions[ip]. The next queries are answered with the status codes of
+    errors, if any, instead.
+    """
+
+    def __init__(self):
+        self.stream_responses = {"true": {"new": None, "deleted": None}}
+        self.decisions = {}
+        self.requests = []
+        self.errors = []
+        self.concurrent = self.max_concurrent = 0
+        app = web.Application()
+        app.router.add_get("/v1/decisions/stream", self.stream)
+        app.router.add_get("/v1/decisions", self.query)
+        self.server = TestServer(app)
+
+    async def stream(self, request):
+        self.requests.append(dict(request.query))
+        if self.errors:
+            return web.Response(status=self.errors.pop(0))
+        response = self.stream_responses.get(request.query["startup"])
+        return web.json_response(response or {"new": None, "deleted": None})
+
+    async def query(self, request):
+        self.requests.append(dict(request.query))
+        self.concurrent += 1
+        self.max_concurrent = max(self.max_concurrent, self.concurrent)
+        await asyncio.sleep(0.01)
+        self.concurrent -= 1
+        if self.errors:
+            return web.Response(status=self.errors.pop(0))
+        return web.json_response(self.decisions.get(request.query["ip"]))
+
+    async def __aenter__(self):
+        await self.server.start_server()
+        self.url = str(self.server.make_url("/"))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.server.close()
+
+
+class TestAsyncQueryClient(unittest.TestCase):
+    def test_get_action_for(self):
+        async def test():
+            async with FakeLAPI() as lapi:
+                lapi.decisions["1.2.3.4"] = [
+                    {"id": 1, "type": "ban", "value": "1.2.3.4"},
+                    {"id": 2, "type": "captcha", "value": "1.2.3.4"},
+                ]
+                async with AsyncQueryClient("abcd", lapi_url=lapi.url, max_connections=2) as client:
+                    assert await client.get_action_for("1.2.3.4") == "captcha"
+                    assert await client.get_action_for("1.2.3.5") is None
+
+                    await asyncio.gather(*(client.get_action_for("1.2.3.4") for _ in range(10)))
+                    assert lapi.max_concurrent == 2
+
+        asyncio.run(test())
+
+    def test_retries_and_failure_policy(self):
+        async def test():
+            async with FakeLAPI() as lapi:
+                lapi.decisions["1.2.3.4"] = [{"id": 1, "type": "ban", "value": "1.2.3.4"}]
+                lapi.errors = [503]
+                async with AsyncQueryClient(
+                    "abcd",
+                    lapi_url=lapi.url,
+                    retry_backoff=0.01,
+                    breaker_threshold=2,
+                    failure_policy="closed",
+                    fail_closed_action="captcha",
+                ) as client:
+                    assert await client.get_action_for("1.2.3.4") == "ban"
+                    lapi.errors = [503, 503]
+                    assert await client.get_action_for("1.2.3.4") == "captcha"
+                    # The breaker opened, LAPI isn't queried anymore.
+                    assert await client.get_action_for("1.2.3.4") == "captcha"
+                    assert len(lapi.requests) == 4
+
+        asyncio.run(test())
+
+
+class TestAsyncStreamClient(unittest.TestCase):
+    def test_run(self):
+        async def test():
+            async with FakeLAPI() as lapi:
+                lapi.stream_responses["true"] = {
+                    "new": [
+                        {"scope": "Ip", "type": "ban", "value": "1.2.3.4"},
+                        {"scope": "Country", "type": "captcha", "value": "CN"},
+                    ],
+                    "deleted": None,
+                }
+                lapi.stream_responses["false"] = {
+                    "new": [{"scope": "Ip", "type": "captcha", "value": "1.2.3.5"}],
+                    "deleted": [{"scope": "Country", "type": "captcha", "value": "CN"}],
+                }
+                client = AsyncStreamClient("abcd", lapi_url=lapi.url, interval=1)
+                await client.run()
+                assert client.get_current_decisions() == {"1.2.3.4/32": "ban", "CN": "captcha"}
+                assert client.is_running()
+
+                for _ in range(300):
+                    if client.get_action_for("1.2.3.5"):
+                        break
+                    await asyncio.sleep(0.01)
+                assert client.get_current_decisions() == {
+                    "1.2.3.4/32": "ban",
+                    "1.2.3.5/32": "captcha",
+                }
+
+                await client.stop()
+                assert not client.is_running()
+                assert lapi.requests[0]["startup"] == "true"
+                assert lapi.requests[1]["startup"] == "false"
+
+        asyncio.run(test())
+
+    def test_startup_error(self):
+        async def test():
+            client = AsyncStreamClient("abcd", lapi_url="http://127.0.0.1:1/")
+            with self.assertRaises(aiohttp.ClientError):
+                await client.run()
+            assert client.death_reason is not None
+            await client.stop()
+
+        asyncio.run(test())
+
+    def test_cycle_retries(self):
+        spans = []
+        tracer = Tracer(hooks=[lambda *span: spans.append(span)], opentelemetry=False)
+
+        async def test():
+            async with FakeLAPI() as lapi:
+                lapi.stream_responses["false"] = {
+                    "new": [{"scope": "Ip", "type": "ban", "value": "1.2.3.4"}],
+                    "deleted": None,
+                }
+                client = AsyncStreamClient(
+                    "abcd", lapi_url=lapi.url, retry_backoff=0.01, tracer=tracer
+                )
+                lapi.errors = [503]
+                await client.cycle("false")
+                assert client.get_action_for("1.2.3.4") == "ban"
+                lapi.errors = [503, 503, 503]
+                await client.cycle("false")
+                assert client.get_action_for("1.2.3.4") == "ban"
+                await client.stop()
+
+        asyncio.run(test())
+        cycles = [span[2] for span in spans if span[0] == "pycrowdsec.cycle"]
+        assert cycles[0] == {"startup": False, "attempts": 2, "changed": True}
+        assert cycles[1]["attempts"] == 3 and "503" in cycles[1]["error"]
+
+    def test_tracing(self):
+        async def test():
+            spans = []
+            tracer = Tracer(hooks=[lambda *span: spans.append(span)], opentelemetry=False)
+            async with FakeLAPI() as lapi:
+                lapi.stream_responses["false"] = {
+                    "new": [{"scope": "Ip", "type": "ban", "value": "1.2.3.4"}],
+                    "deleted": None,
+                }
+                client = AsyncStreamClient("abcd", lapi_url=lapi.url, tracer=tracer)
+                await client.cycle("true")
+                await client.cycle("false")
+                await client.stop()
+            assert [span[0] for span in spans] == [
+                "pycrowdsec.fetch",
+                "pycrowdsec.apply_delta",
+                "pycrowdsec.process_decisions",
+                "pycrowdsec.cycle",
+                "pycrowdsec.fetch",
+                "pycrowdsec.decode",
+                "pycrowdsec.apply_delta",
+                "pycrowdsec.process_response",
+                "pycrowdsec.cycle",
+            ]
+
+        asyncio.run(test())
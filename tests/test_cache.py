@@ -1,7 +1,46 @@
 import random
+import threading
 from unittest import TestCase
 
-from pycrowdsec.cache import Cache
+from pycrowdsec.cache import (
+    Cache,
+    CowDict,
+    item_to_key,
+    item_to_string,
+    key_to_item,
+    key_to_string,
+    parse_ip,
+    string_to_key,
+)
+
+
+class TestKeys(TestCase):
+    def test_parse_ip(self):
+        assert parse_ip("1.2.3.4") == (4, 0x01020304)
+        assert parse_ip("::ffff") == (6, 0xFFFF)
+        assert parse_ip("::ffff:1.2.3.4") == (6, 0xFFFF01020304)
+        for item in ("CN", "1.2.3.0/24", "::/64", "1.2.3", "", None, 1234):
+            with self.subTest(item=item):
+                assert parse_ip(item) is None
+
+    def test_item_to_key(self):
+        assert item_to_key("1.2.3.4") == (4, 0x01020304, 32)
+        assert item_to_key("1.2.3.0/24") == (4, 0x01020300, 24)
+        assert item_to_key("::/64") == (6, 0, 64)
+        assert item_to_key("CN") == ("normal", "CN")
+        assert item_to_key("1.2.3.4/24") == ("normal", "1.2.3.4/24")
+
+    def test_redis_field_round_trip(self):
+        for item, field, resp in (
+            ("1.2.3.4", "ipv4_4294967295_16909060", "1.2.3.4/32"),
+            ("::/24", f"ipv6_{0xFFFFFF << 104}_0", "::/24"),
+            ("CN", "normal_CN", "CN"),
+            ("a_b", "normal_a_b", "a_b"),
+        ):
+            with self.subTest(item=item):
+                assert item_to_string(item) == field
+                assert key_to_string(string_to_key(field)) == field
+                assert key_to_item(string_to_key(field)) == resp
 
 
 class TestIPv4Cache(TestCase):
@@ -190,3 +229,238 @@ class TestCache(TestCase):
         assert resp["1.2.3.0/24"] == "ban"
         assert resp["1.2.3.4/32"] == "ban"
         assert resp["CN"] == "captcha"
+
+
+class TestCacheTransaction(TestCase):
+    def setUp(self):
+        self.cache = Cache()
+
+    def test_failed_transaction_is_not_published(self):
+        self.cache.insert("1.2.3.4", "ban")
+        with self.assertRaises(RuntimeError):
+            with self.cache.transaction() as table:
+                table.delete("1.2.3.4")
+                table.insert("CN", "captcha")
+                raise RuntimeError()
+
+        assert self.cache.get_all() == {"1.2.3.4/32": "ban"}
+
+    def test_readers_see_whole_transactions(self):
+        items = [f"10.0.{i}.0/24" for i in range(50)] + ["CN", "::1"]
+        done = threading.Event()
+
+        def writer():
+            for _ in range(200):
+                with self.cache.transaction() as table:
+                    for item in items:
+                        table.insert(item, "ban")
+                with self.cache.transaction() as table:
+                    for item in items:
+                        table.delete(item)
+            done.set()
+
+        t = threading.Thread(target=writer)
+        t.start()
+        while not done.is_set():
+            assert len(self.cache.get_all()) in (0, len(items))
+        t.join()
+        assert len(self.cache) == 0
+
+
+class TestCacheBulk(TestCase):
+    def setUp(self):
+        self.cache = Cache()
+
+    def test_insert_many_delete_many(self):
+        self.cache.insert_many([("1.2.3.4", "ban"), ("::/64", "captcha"), ("CN", "ban")])
+        assert self.cache.get("1.2.3.4") == "ban"
+        assert self.cache.get("::1") == "captcha"
+        assert self.cache.get("CN") == "ban"
+
+        self.cache.delete_many(iter(["1.2.3.4", "CN", "5.6.7.8"]))
+        assert self.cache.get_all() == {"::/64": "captcha"}
+
+    def test_apply_delta_deletes_first(self):
+        self.cache.insert("1.2.3.4", "ban")
+        self.cache.apply_delta(deleted=["1.2.3.4", "::/64"], new=[("1.2.3.4", "captcha")])
+        assert self.cache.get_all() == {"1.2.3.4/32": "captcha"}
+
+    def test_apply_delta_replace(self):
+        self.cache.apply_delta(new=[("1.2.3.4", "ban", 100), ("::/64", "ban"), ("CN", "ban")])
+        self.cache.apply_delta(new=[("1.2.3.5", "captcha")], replace=True)
+        assert self.cache.get_all() == {"1.2.3.5/32": "captcha"}
+        assert self.cache.expire(now=200) == 0
+
+        self.cache.apply_delta(replace=True)
+        assert len(self.cache) == 0
+
+    def test_apply_delta_priority(self):
+        new = [
+            ("1.2.3.4", "ban", 100),
+            ("1.2.3.4", "captcha", 200),
+            ("::/64", "ban", 300),
+            ("::/64", "ban", 100),
+            ("CN", "captcha"),
+            ("CN", "ban", 100),
+            ("CN", "ban"),
+        ]
+        for replace in (True, False):
+            self.cache.insert_many([("1.2.3.4", "throttle"), ("::/64", "captcha")])
+            self.cache.apply_delta(new=new, replace=replace, priority=("ban", "captcha"))
+            assert self.cache.get_all() == {"1.2.3.4/32": "ban", "::/64": "ban", "CN": "ban"}
+            assert self.cache.get_details("CN") is None
+            self.cache.expire(now=150)
+            assert self.cache.get_all() == {"::/64": "ban", "CN": "ban"}
+
+        # Without priority, the last entry wins.
+        self.cache.apply_delta(new=new)
+        assert self.cache.get_all() == {"1.2.3.4/32": "captcha", "::/64": "ban", "CN": "ban"}
+
+
+class TestCacheExpiry(TestCase):
+    def setUp(self):
+        self.cache = Cache()
+
+    def test_expire(self):
+        self.cache.apply_delta(
+            new=[("1.2.3.4", "ban", 100), ("::/64", "ban", 200), ("CN", "captcha", None)]
+        )
+        assert self.cache.expire(now=50) == 0
+        assert self.cache.expire(now=150) == 1
+        assert self.cache.get("1.2.3.4") is None
+        assert self.cache.get("::1") == "ban"
+
+        assert self.cache.expire(now=10**10) == 1
+        assert self.cache.get_all() == {"CN": "captcha"}
+
+    def test_reinserted_items_keep_their_new_deadline(self):
+        self.cache.apply_delta(new=[("1.2.3.4", "ban", 100), ("5.6.7.8", "ban", 100)])
+        self.cache.apply_delta(new=[("1.2.3.4", "ban", 300)])
+        self.cache.insert("5.6.7.8", "captcha")
+        assert self.cache.expire(now=200) == 0
+        assert self.cache.get("1.2.3.4") == "ban"
+        assert self.cache.get("5.6.7.8") == "captcha"
+
+        self.cache.delete("1.2.3.4")
+        self.cache.insert("1.2.3.4", "ban")
+        assert self.cache.expire(now=400) == 0
+        assert len(self.cache) == 2
+
+    def test_failed_delta_keeps_deadlines(self):
+        self.cache.apply_delta(new=[("1.2.3.4", "ban", 100), ("5.6.7.8", "ban", 200)])
+
+        def entries():
+            yield "9.9.9.9", "ban", 50
+            yield "1.2.3.4", "ban", 1000
+            raise ConnectionError("lost mid body")
+
+        for replace in (True, False):
+            with self.assertRaises(ConnectionError):
+                self.cache.apply_delta(deleted=["5.6.7.8"], new=entries(), replace=replace)
+            assert self.cache.get_all() == {"1.2.3.4/32": "ban", "5.6.7.8/32": "ban"}
+            assert self.cache.deadlines == {
+                item_to_key("1.2.3.4"): 100,
+                item_to_key("5.6.7.8"): 200,
+            }
+
+        assert self.cache.expire(now=150) == 1
+        assert self.cache.expire(now=250) == 1
+        assert len(self.cache) == 0
+
+
+class TestCacheScopes(TestCase):
+    def setUp(self):
+        self.cache = Cache()
+
+    def test_scoped_lookup(self):
+        self.cache.insert("CN", "captcha", scope="Country")
+        self.cache.insert("1234", "ban", scope="AS")
+        self.cache.insert("1.2.3.0/24", "ban", scope="Range")
+
+        assert self.cache.get("CN", scope="country") == "captcha"
+        assert self.cache.get("CN", scope="as") is None
+        assert self.cache.get("1234", scope="as") == "ban"
+        assert self.cache.get("1.2.3.4", scope="ip") == "ban"
+        assert self.cache.get("1.2.3.4", scope="country") is None
+
+    def test_unscoped_lookup_checks_every_scope(self):
+        self.cache.insert("CN", "captcha", scope="country")
+        self.cache.insert("TH", "ban")
+        assert self.cache.get("CN") == "captcha"
+        assert self.cache.get("TH") == "ban"
+        assert self.cache.get("TH", scope="country") is None
+
+    def test_scopes_do_not_collide(self):
+        self.cache.insert_many(
+            [(item_to_key("1234", "as"), "ban"), (item_to_key("1234", "custom"), "captcha")]
+        )
+        assert self.cache.get("1234", scope="as") == "ban"
+        assert self.cache.get("1234", scope="custom") == "captcha"
+
+        self.cache.delete("1234", scope="as")
+        assert self.cache.get("1234", scope="as") is None
+        assert self.cache.get_all() == {"1234": "captcha"}
+
+    def test_single_writes_only_copy_a_shard(self):
+        self.cache.insert_many((item_to_key(f"user{i}", "username"), "ban") for i in range(1000))
+        published = self.cache.table.scopes["username"]
+        self.cache.insert("user1000", "captcha", scope="username")
+        self.cache.delete("user0", scope="username")
+        current = self.cache.table.scopes["username"]
+        changed = [i for i, shard in enumerate(current.shards) if shard is not published.shards[i]]
+        assert len(changed) <= 2
+        # The published table is untouched.
+        assert published.get("user0") == "ban" and "user1000" not in published
+        assert len(published) == 1000 and len(current) == 1000
+        assert self.cache.get("user1000", scope="username") == "captcha"
+        assert self.cache.get("user0", scope="username") is None
+
+
+class TestCowDict(TestCase):
+    def test_copies_are_independent(self):
+        values = CowDict((f"key{i}", i) for i in range(100))
+        copy = values.copy()
+        copy["key0"] = -1
+        copy["new"] = 100
+        del copy["key1"]
+        assert values.get("key0") == 0 and "new" not in values and "key1" in values
+        assert copy.get("key0") == -1 and copy.get("new") == 100 and "key1" not in copy
+        assert len(values) == 100 and len(copy) == 100
+        assert dict(copy.items()) == {
+            **{f"key{i}": i for i in range(2, 100)},
+            "key0": -1,
+            "new": 100,
+        }
+
+
+class CompactCacheMixin:
+    def setUp(self):
+        self.cache = Cache(compact=True)
+
+
+class TestCompactIPv4Cache(CompactCacheMixin, TestIPv4Cache):
+    pass
+
+
+class TestCompactIPv6Cache(CompactCacheMixin, TestIPv6Cache):
+    pass
+
+
+class TestCompactCache(CompactCacheMixin, TestCache):
+    pass
+
+
+class TestCompactCacheTransaction(CompactCacheMixin, TestCacheTransaction):
+    pass
+
+
+class TestCompactCacheBulk(CompactCacheMixin, TestCacheBulk):
+    pass
+
+
+class TestCompactCacheExpiry(CompactCacheMixin, TestCacheExpiry):
+    pass
+
+
+class TestCompactCacheScopes(CompactCacheMixin, TestCacheScopes):
+    pass
@@ -0,0 +1,124 @@
+import threading
+import unittest
+
+from pycrowdsec.cache import Cache
+from pycrowdsec.decision import Decision
+
+DECISION = {
+    "duration": "3h59m59s",
+    "id": 97,
+    "origin": "CAPI",
+    "scenario": "crowdsecurity/http-crawl-non_statics",
+    "scope": "Ip",
+    "type": "ban",
+    "value": "185.220.101.204",
+    "simulated": False,
+    "uuid": "b4d6e5a0-8f3c-4a1e-9c7b-2d5f0e6a1b3c",
+}
+
+
+class TestDecision(unittest.TestCase):
+    def test_from_dict(self):
+        decision = Decision.from_dict(DECISION, 1000)
+        assert decision.deadline == 1000 + 4 * 3600 - 1
+        assert decision.key == (4, 0xB9DC65CC, 32)
+        assert decision["scenario"] == DECISION["scenario"]
+        assert decision["duration"] == decision.get("duration") == "3h59m59s"
+        assert decision["until"] is None
+        assert decision.get("until", "never") == "never"
+        assert decision.get("missing") is None
+        with self.assertRaises(KeyError):
+            decision["missing"]
+        assert not hasattr(decision, "__dict__")
+
+        # Repeated strings are shared.
+        other = Decision.from_dict(dict(DECISION, scenario="".join(DECISION["scenario"])), 0)
+        assert other.scenario is decision.scenario
+
+    def test_read_like_a_dict(self):
+        decision = Decision.from_dict(DECISION, 1000)
+        assert decision["simulated"] is False
+        assert decision["uuid"] == DECISION["uuid"]
+        assert "until" in decision and "duration" in decision
+        assert "missing" not in decision
+
+        as_dict = dict(decision)
+        assert {name: as_dict[name] for name in DECISION} == DECISION
+        assert as_dict["until"] is None
+        assert as_dict["deadline"] == decision.deadline
+        assert list(decision) == decision.keys() == list(as_dict)
+        assert dict(decision.items()) == as_dict
+
+    def test_hashable(self):
+        decision = Decision.from_dict(DECISION, 1000)
+        same = Decision.from_dict(DECISION, 1000)
+        later = Decision.from_dict(DECISION, 2000)
+        assert decision == same and decision != later
+        assert {decision, same, later} == {decision, later}
+        assert {decision: "ban"}[same] == "ban"
+
+    def test_other_scopes(self):
+        decision = Decision.from_dict({"scope": "Country", "type": "captcha", "value": "CN"}, 0)
+        assert decision.key == ("country", "CN")
+        assert decision.deadline is None
+        assert (decision.version, decision.network, decision.prefix_length) == (None, None, None)
+
+
+class TestCacheDetails(unittest.TestCase):
+    def test_details_follow_decisions(self):
+        cache = Cache()
+        decision = Decision.from_dict(DECISION, 0)
+        cache.apply_delta(new=[(decision.key, decision.type, decision.deadline, decision)])
+        assert cache.get_details("185.220.101.204") is decision
+        assert cache.get_details("185.220.101.205") is None
+
+        cache.expire(now=4 * 3600)
+        assert cache.get_details("185.220.101.204") is None
+
+        cache.apply_delta(new=[(decision.key, decision.type, None, decision)])
+        cache.apply_delta(replace=True, new=[(decision.key, decision.type)])
+        assert cache.get("185.220.101.204") == "ban"
+        assert cache.get_details("185.220.101.204") is None
+
+    def test_details_are_published_with_the_table(self):
+        cache = Cache()
+        decisions = [
+            Decision(i, "CAPI", "scenario", "ban", "Ip", f"10.0.{i // 256}.{i % 256}")
+            for i in range(2000)
+        ] + [Decision(2000 + i, "CAPI", "scenario", "ban", "User", f"user{i}") for i in range(500)]
+        done = threading.Event()
+
+        def write():
+            for i in range(20):
+                batch = (
+                    decisions[i * 100 : (i + 1) * 100] + decisions[2000 + i * 25 : 2025 + i * 25]
+                )
+                cache.apply_delta(new=[(d.key, d.type, None, d) for d in batch])
+                cache.apply_delta(deleted=[d.key for d in batch[:10]])
+            done.set()
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        while not done.is_set():
+            table = cache.table
+            for decision in decisions[::50]:
+                action = table.get(decision.value, decision.scope)
+                details = table.get_details(decision.value, decision.scope)
+                # Both come from the same table.
+                assert (details is None) == (action is None)
+                assert details is None or details is decision
+        writer.join()
+
+    def test_failed_transaction_keeps_details(self):
+        cache = Cache()
+        decision = Decision.from_dict(DECISION, 0)
+        cache.apply_delta(new=[(decision.key, decision.type, None, decision)])
+
+        def entries():
+            yield decision.key, "captcha", None, Decision.from_dict(DECISION, 1)
+            raise ConnectionError("lost")
+
+        with self.assertRaises(ConnectionError):
+            cache.apply_delta(new=entries())
+        assert cache.get("185.220.101.204") == "ban"
+        assert cache.get_details("185.220.101.204") is decision
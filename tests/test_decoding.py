@@ -0,0 +1,56 @@
+import json
+import random
+import unittest
+
+import pycrowdsec.decoding
+from pycrowdsec.decoding import iter_decisions
+
+
+def split(data, rng):
+    chunks = []
+    while data:
+        size = rng.randint(1, 40)
+        chunks.append(data[:size])
+        data = data[size:]
+    return chunks
+
+
+class TestIterDecisions(unittest.TestCase):
+    response = {
+        "new": [
+            {"id": 1, "scope": "Ip", "type": "ban", "value": "1.2.3.4", "duration": "4h"},
+            {"scenario": 'a "quoted} {name}', "type": "ban", "value": "é\\ü"},
+            {"type": "captcha", "value": "CN", "extra": {"nested": [1, {"x": None}]}},
+        ],
+        "deleted": [{"type": "ban", "value": "::1"}],
+        "count": 123456,
+    }
+
+    def decisions(self, response):
+        return [(key, decision) for key in response if key != "count" for decision in response[key]]
+
+    def test_chunked(self):
+        rng = random.Random(3)
+        for fast in (True, False):
+            with self.subTest(fast=fast):
+                if not fast:
+                    self.disable_orjson()
+                for indent in (None, 2):
+                    data = json.dumps(self.response, indent=indent, ensure_ascii=False).encode()
+                    for _ in range(50):
+                        chunks = split(data, rng)
+                        assert list(iter_decisions(chunks)) == self.decisions(self.response)
+
+    def test_null_and_empty(self):
+        for data in (b'{"new": null, "deleted": []}', b" { } ", b'{"new": [], "deleted": null}'):
+            assert list(iter_decisions([data])) == []
+
+    def test_invalid(self):
+        for data in (b"", b'{"new": [{"value": "1.2.3.4"}', b'{"new": [1 2]}', b"[]"):
+            with self.assertRaises(ValueError):
+                list(iter_decisions([data]))
+
+    def disable_orjson(self):
+        orjson = pycrowdsec.decoding.orjson
+        pycrowdsec.decoding.orjson = None
+        self.addCleanup(setattr, pycrowdsec.decoding, "orjson", orjson)
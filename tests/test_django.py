@@ -0,0 +1,95 @@
+import unittest
+from unittest import mock
+
+import pytest
+
+django = pytest.importorskip("django")
+
+from django.conf import settings  # noqa: E402
+from django.http import HttpResponse  # noqa: E402
+from django.test import RequestFactory  # noqa: E402
+from django.urls import path  # noqa: E402
+
+from pycrowdsec.cache import Cache  # noqa: E402
+from pycrowdsec.django import crowdsec_middleware  # noqa: E402
+from tests.fake_lapi import FakeLAPI  # noqa: E402
+
+
+class PlainCache(Cache):
+    def get(self, item):
+        return super().get(item)
+
+
+def index(request):
+    return HttpResponse("ok")
+
+
+urlpatterns = [path("", index, name="index")]
+
+if not settings.configured:
+    settings.configure(ROOT_URLCONF=__name__, ALLOWED_HOSTS=["*"], PYCROWDSEC_LAPI_KEY="abcd")
+    django.setup()
+
+
+class TestDjangoMiddleware(unittest.TestCase):
+    def setUp(self):
+        self.lapi = FakeLAPI()
+        self.lapi.stream_responses["true"] = {
+            "new": [
+                {"scope": "Country", "type": "ban", "value": "CN"},
+                {"scope": "Ip", "type": "captcha", "value": "1.2.3.4"},
+            ],
+            "deleted": None,
+        }
+        self.lapi.__enter__()
+        self.addCleanup(self.lapi.__exit__, None, None, None)
+        self.views = []
+        settings.PYCROWDSEC_LAPI_URL = self.lapi.url
+        settings.PYCROWDSEC_POLL_INTERVAL = 3600
+        settings.PYCROWDSEC_ACTIONS = {
+            "ban": lambda request: HttpResponse("banned", status=403),
+            "captcha": lambda request: HttpResponse("captcha", status=401),
+        }
+        self.factory = RequestFactory()
+
+    def get_middleware(self, request_transformers):
+        settings.PYCROWDSEC_REQUEST_TRANSFORMERS = request_transformers
+
+        def get_response(request):
+            self.views.append(request.path)
+            return index(request)
+
+        return crowdsec_middleware(get_response)
+
+    def test_scoped_transformer(self):
+        middleware = self.get_middleware(
+            [(lambda request: request.headers.get("X-Country"), "country")]
+        )
+        assert middleware(self.factory.get("/", HTTP_X_COUNTRY="CN")).status_code == 403
+        assert middleware(self.factory.get("/", HTTP_X_COUNTRY="FR")).status_code == 200
+
+        middleware = self.get_middleware([(lambda request: request.headers.get("X-Country"), "as")])
+        assert middleware(self.factory.get("/", HTTP_X_COUNTRY="CN")).status_code == 200
+
+    def test_every_transformer_is_tried_before_the_view(self):
+        middleware = self.get_middleware(
+            [
+                lambda request: request.META.get("REMOTE_ADDR"),
+                (lambda request: request.headers.get("X-Country"), "country"),
+            ]
+        )
+        assert middleware(self.factory.get("/", HTTP_X_COUNTRY="CN")).status_code == 403
+        assert self.views == []
+        assert middleware(self.factory.get("/", HTTP_X_COUNTRY="FR")).status_code == 200
+        assert self.views == ["/"]
+
+    def test_ip_transformer(self):
+        middleware = self.get_middleware([lambda request: request.META.get("REMOTE_ADDR")])
+        assert middleware(self.factory.get("/", REMOTE_ADDR="1.2.3.4")).status_code == 401
+        assert middleware(self.factory.get("/")).status_code == 200
+
+    def test_cache_without_scope(self):
+        with mock.patch("pycrowdsec.client.Cache", PlainCache):
+            middleware = self.get_middleware([lambda request: request.META.get("REMOTE_ADDR")])
+        assert middleware(self.factory.get("/", REMOTE_ADDR="1.2.3.4")).status_code == 401
+        assert middleware(self.factory.get("/")).status_code == 200
@@ -0,0 +1,68 @@
+import unittest
+
+import pytest
+
+flask = pytest.importorskip("flask")
+
+from pycrowdsec.cache import Cache  # noqa: E402
+from pycrowdsec.flask import get_crowdsec_middleware  # noqa: E402
+
+
+class PlainCache:
+    def __init__(self, actions):
+        self.actions = actions
+
+    def get(self, item):
+        return self.actions.get(item)
+
+
+class TestFlaskMiddleware(unittest.TestCase):
+    def setUp(self):
+        self.cache = Cache()
+        self.cache.insert("CN", "ban", scope="country")
+        self.cache.insert("1.2.3.4", "captcha")
+
+    def get_client(self, ip_transformers, cache=None):
+        app = flask.Flask(__name__)
+
+        @app.route("/")
+        def index():
+            return "ok"
+
+        actions = {"ban": lambda: ("banned", 403), "captcha": lambda: ("captcha", 401)}
+        app.before_request(
+            get_crowdsec_middleware(
+                actions, self.cache if cache is None else cache, ip_transformers=ip_transformers
+            )
+        )
+        return app.test_client()
+
+    def test_scoped_transformer(self):
+        client = self.get_client([(lambda request: request.headers.get("X-Country"), "country")])
+        assert client.get("/", headers={"X-Country": "CN"}).status_code == 403
+        assert client.get("/", headers={"X-Country": "FR"}).status_code == 200
+
+        client = self.get_client([(lambda request: request.headers.get("X-Country"), "as")])
+        assert client.get("/", headers={"X-Country": "CN"}).status_code == 200
+
+    def test_every_transformer_is_tried(self):
+        client = self.get_client(
+            [
+                lambda request: request.remote_addr,
+                (lambda request: request.headers.get("X-Country"), "country"),
+            ]
+        )
+        assert client.get("/", headers={"X-Country": "CN"}).status_code == 403
+        assert client.get("/", headers={"X-Country": "FR"}).status_code == 200
+
+    def test_ip_transformer(self):
+        client = self.get_client([lambda request: request.remote_addr])
+        assert client.get("/", environ_overrides={"REMOTE_ADDR": "1.2.3.4"}).status_code == 401
+        assert client.get("/").status_code == 200
+
+    def test_cache_without_scope(self):
+        client = self.get_client(
+            [lambda request: request.remote_addr], cache=PlainCache({"1.2.3.4": "captcha"})
+        )
+        assert client.get("/", environ_overrides={"REMOTE_ADDR": "1.2.3.4"}).status_code == 401
+        assert client.get("/").status_code == 200
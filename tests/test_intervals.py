@@ -0,0 +1,60 @@
+import random
+from unittest import TestCase
+
+from pycrowdsec.intervals import IntervalTable, merge_prefixes
+from tests.test_trie import brute_force_lookup
+
+
+class TestIntervalTable(TestCase):
+    def test_empty(self):
+        table = IntervalTable(32)
+        assert table.lookup(0) == 0
+        assert table.lookup(2**32 - 1) == 0
+        assert len(table) == 0
+
+    def test_nested_prefixes(self):
+        table = IntervalTable(
+            32, [(0, 0, 1), (0x0A000000, 8, 2), (0x0A010000, 16, 3), (0x0A010000, 24, 2)]
+        )
+        assert table.lookup(0x0B000000) == 1
+        assert table.lookup(0x0A020000) == 2
+        assert table.lookup(0x0A010001) == 2
+        assert table.lookup(0x0A01FFFF) == 3
+        assert table.lookup(0x0A000000 - 1) == 1
+        assert list(table.items())[1] == (0x0A000000, 8, 2)
+        assert table.get(0x0A010000, 16) == 3
+        assert table.get(0x0A010000, 24) == 2
+        assert table.get(0x0A010000, 20) == 0
+        assert table.get(0x0A000001, 32) == 0
+
+    def test_random_against_brute_force(self):
+        rng = random.Random(7)
+        for bits in (32, 128):
+            prefixes = {}
+            for _ in range(300):
+                plen = rng.choice([0, 4, 8, 16, 24, 63, 64, 65, bits - 1, bits])
+                plen = min(plen, bits)
+                net = (rng.getrandbits(3) << (bits - 3)) | rng.getrandbits(bits - 10)
+                net &= ((1 << plen) - 1) << (bits - plen)
+                prefixes[(net, plen)] = rng.randint(1, 3)
+            table = IntervalTable(bits, sorted((n, p, c) for (n, p), c in prefixes.items()))
+            for net, plen in prefixes:
+                for addr in (net, net | ((1 << (bits - plen)) - 1), net | rng.getrandbits(8)):
+                    addr &= (1 << bits) - 1
+                    expected = brute_force_lookup(prefixes, addr, bits) or 0
+                    assert table.lookup(addr) == expected
+                    if addr + 1 < 1 << bits:
+                        expected = brute_force_lookup(prefixes, addr + 1, bits) or 0
+                        assert table.lookup(addr + 1) == expected
+
+
+class TestMergePrefixes(TestCase):
+    def test_merge(self):
+        prefixes = [(1, 32, 1), (2, 32, 1), (4, 31, 2)]
+        changes = [(0, 32, 3), (2, 32, 0), (4, 31, 1), (6, 32, 0), (8, 32, 2)]
+        assert list(merge_prefixes(prefixes, changes)) == [
+            (0, 32, 3),
+            (1, 32, 1),
+            (4, 31, 1),
+            (8, 32, 2),
+        ]
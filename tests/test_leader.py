@@ -0,0 +1,129 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from redislite import Redis
+
+from pycrowdsec.client import StreamClient
+from pycrowdsec.leader import FileLockElection, RedisLeaseElection
+from tests.fake_lapi import FakeLAPI
+
+
+class TestFileLockElection(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "lock")
+
+    def test_single_leader(self):
+        first, second = FileLockElection(self.path), FileLockElection(self.path)
+        assert first.acquire()
+        assert not second.acquire()
+        assert first.acquire()
+
+        first.release()
+        assert second.acquire()
+        assert not first.acquire()
+        second.release()
+
+
+class TestRedisLeaseElection(unittest.TestCase):
+    def setUp(self):
+        self.redis = Redis()
+
+    def test_single_leader(self):
+        first = RedisLeaseElection(self.redis, lease_duration=10)
+        second = RedisLeaseElection(self.redis, lease_duration=10)
+        assert first.acquire()
+        assert not second.acquire()
+        assert first.acquire()
+
+        first.release()
+        assert second.acquire()
+        assert not first.acquire()
+
+    def test_expired_lease(self):
+        first = RedisLeaseElection(self.redis, lease_duration=0.1)
+        second = RedisLeaseElection(self.redis, lease_duration=0.1)
+        assert first.acquire()
+        time.sleep(0.2)
+        assert second.acquire()
+        assert not first.acquire()
+
+
+class TestStreamClientLeaderElection(unittest.TestCase):
+    def test_shared_cache_failover(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "decisions")
+            first = StreamClient("abcd", shared_cache_path=path, leader_election=True)
+            second = StreamClient("abcd", shared_cache_path=path, leader_election=True)
+            assert first.update_leadership()
+            assert first.resync
+            assert not second.update_leadership()
+
+            first.process_response(
+                {"deleted": None, "new": [{"scope": "Ip", "type": "ban", "value": "1.2.3.4"}]}
+            )
+            second.cache.refresh(force=True)
+            assert second.get_action_for("1.2.3.4") == "ban"
+            with self.assertRaises(RuntimeError):
+                second.cache.insert("1.2.3.5", "ban")
+
+            # The leader dies.
+            first.election.release()
+            assert second.update_leadership()
+            assert second.resync
+            assert second.cache.writer
+            second.startup = True
+            second.process_response(
+                {"deleted": None, "new": [{"scope": "Ip", "type": "ban", "value": "1.2.3.5"}]}
+            )
+            assert second.get_current_decisions() == {"1.2.3.5/32": "ban"}
+
+    def test_redis_lease(self):
+        redis = Redis()
+        first = StreamClient("abcd", redis_connection=redis, leader_election=True)
+        second = StreamClient("abcd", redis_connection=redis, leader_election=True)
+        assert first.update_leadership()
+        assert not second.update_leadership()
+        assert first.election.lease_duration == 45
+
+    def test_cycle_past_the_lease(self):
+        redis = Redis()
+        decision = {"scope": "Ip", "type": "ban", "value": "1.2.3.4"}
+        with FakeLAPI() as lapi:
+            lapi.stream_responses["true"] = {"new": [decision], "deleted": None}
+            lapi.stream_responses["false"] = {"new": [decision], "deleted": None}
+            lapi.delay = 0.6
+            for startup in (True, False):
+                first, second = (
+                    StreamClient(
+                        "abcd",
+                        lapi_url=lapi.url,
+                        redis_connection=redis,
+                        leader_election=True,
+                        leader_lease_duration=lease_duration,
+                    )
+                    for lease_duration in (0.2, 10)
+                )
+                if not startup:
+                    assert first.update_leadership()
+                    first.resync = False
+                # The cycle of the first client outlasts its lease, the second one takes over.
+                cycle = threading.Thread(target=first.cycle, args=("false",))
+                cycle.start()
+                time.sleep(0.35)
+                assert second.update_leadership()
+                cycle.join()
+                # The first client doesn't write what it fetched.
+                assert not first.leader
+                assert first.death_reason is None
+                assert second.get_action_for("1.2.3.4") is None
+                second.election.release()
+        assert [params["startup"] for _, params, _ in lapi.requests] == ["true", "false"]
+
+    def test_requires_shared_cache(self):
+        with self.assertRaises(ValueError):
+            StreamClient("abcd", leader_election=True)
@@ -0,0 +1,128 @@
+import threading
+import unittest
+
+from pycrowdsec.cache import Cache
+from pycrowdsec.client import QueryClient, StreamClient
+from pycrowdsec.metrics import Metrics
+from tests.fake_lapi import FakeLAPI
+
+
+class TestMetrics(unittest.TestCase):
+    def test_threads_are_aggregated(self):
+        metrics = Metrics()
+
+        def count():
+            for _ in range(1000):
+                metrics.inc("pycrowdsec_remediations_total", (("action", "ban"),))
+
+        threads = [threading.Thread(target=count) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        del threads, thread
+        count()
+        # The counts of the threads which exited are kept.
+        assert metrics.stats()["pycrowdsec_remediations_total"] == {'action="ban"': 5000}
+        assert len(metrics.shards) == 1
+
+    def test_histogram(self):
+        metrics = Metrics()
+        for duration in (0.005, 0.01, 2, 100):
+            metrics.observe("pycrowdsec_cycle_duration_seconds", duration)
+        histogram = metrics.stats()["pycrowdsec_cycle_duration_seconds"][""]
+        assert histogram["count"] == 4
+        assert histogram["sum"] == 102.015
+        assert histogram["buckets"][0.01] == 2
+        assert histogram["buckets"][5] == 3
+        assert histogram["buckets"][float("inf")] == 4
+
+        text = metrics.prometheus()
+        assert "# TYPE pycrowdsec_cycle_duration_seconds histogram\n" in text
+        assert 'pycrowdsec_cycle_duration_seconds_bucket{le="0.01"} 2\n' in text
+        assert 'pycrowdsec_cycle_duration_seconds_bucket{le="+Inf"} 4\n' in text
+        assert "pycrowdsec_cycle_duration_seconds_count 4\n" in text
+
+    def test_cache(self):
+        metrics = Metrics()
+        cache = Cache(metrics=metrics)
+        cache.insert_many([("1.2.3.4", "ban"), ("1.2.4.0/24", "ban"), (("country", "CN"), "ban")])
+        cache.get("1.2.3.4")
+        cache.get("4.3.2.1")
+        stats = metrics.stats()
+        assert stats["pycrowdsec_lookups_total"] == {
+            'backend="memory",result="hit"': 1,
+            'backend="memory",result="miss"': 1,
+        }
+        assert stats["pycrowdsec_lookup_duration_seconds"]['backend="memory"']["count"] == 2
+        assert stats["pycrowdsec_decisions"] == {'scope="country"': 1, 'scope="ip"': 2}
+        assert 'pycrowdsec_decisions{scope="ip"} 2\n' in metrics.prometheus()
+
+    def test_caches_sharing_metrics(self):
+        metrics = Metrics()
+        cache = Cache(metrics=metrics)
+        cache.insert_many([("1.2.3.4", "ban"), (("country", "CN"), "ban")])
+        other = Cache(metrics=metrics, compact=True)
+        other.insert_many([("4.3.2.1", "ban"), ("4.3.2.0/24", "ban")])
+        assert metrics.stats()["pycrowdsec_decisions"] == {'scope="country"': 1, 'scope="ip"': 3}
+
+        # The gauges of a cache go away with it.
+        del other
+        assert metrics.stats()["pycrowdsec_decisions"] == {'scope="country"': 1, 'scope="ip"': 1}
+        assert len(metrics.gauges["pycrowdsec_decisions"]) == 1
+
+    def test_stream_client(self):
+        metrics = Metrics()
+        with FakeLAPI() as lapi:
+            lapi.stream_responses["true"] = {
+                "new": [{"scope": "Ip", "type": "ban", "value": "1.2.3.4"}],
+                "deleted": None,
+            }
+            lapi.stream_responses["false"] = {
+                "new": None,
+                "deleted": [{"scope": "Ip", "type": "ban", "value": "1.2.3.4"}],
+            }
+            client = StreamClient("abcd", lapi_url=lapi.url, metrics=metrics)
+            client.cycle("true")
+            client.cycle("false")
+            assert client.get_action_for("1.2.3.4") is None
+        stats = metrics.stats()
+        assert stats["pycrowdsec_cycles_total"] == {'result="ok"': 2}
+        assert stats["pycrowdsec_cycle_duration_seconds"][""]["count"] == 2
+        assert stats["pycrowdsec_cycle_decisions_total"] == {
+            'kind="deleted"': 1,
+            'kind="new"': 1,
+        }
+        assert stats["pycrowdsec_cycle_payload_bytes_total"][""] > 0
+        assert stats["pycrowdsec_lookups_total"] == {'backend="memory",result="miss"': 1}
+
+    def test_query_client(self):
+        metrics = Metrics()
+        with FakeLAPI() as lapi:
+            lapi.decisions["1.2.3.4"] = [{"id": 1, "type": "ban", "value": "1.2.3.4"}]
+            client = QueryClient("abcd", lapi_url=lapi.url, metrics=metrics)
+            client.get_action_for("1.2.3.4")
+            client.get_action_for("1.2.3.5")
+        assert metrics.stats()["pycrowdsec_lookups_total"] == {
+            'backend="query",result="hit"': 1,
+            'backend="query",result="miss"': 1,
+        }
+
+    def test_query_client_failures(self):
+        metrics = Metrics()
+        with FakeLAPI() as lapi:
+            lapi.errors = [503]
+            client = QueryClient(
+                "abcd",
+                lapi_url=lapi.url,
+                retries=0,
+                breaker_threshold=1,
+                failure_policy="closed",
+                metrics=metrics,
+            )
+            # The failure and the open breaker are errors, not hits of fail_closed_action.
+            assert client.get_action_for("1.2.3.4") == "ban"
+            assert client.get_action_for("1.2.3.4") == "ban"
+        assert metrics.stats()["pycrowdsec_lookups_total"] == {
+            'backend="query",result="error"': 2,
+        }
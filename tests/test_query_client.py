@@ -0,0 +1,181 @@
+import itertools
+import threading
+import time
+import unittest
+
+from requests.exceptions import HTTPError, Timeout
+
+from pycrowdsec.client import QueryClient
+from pycrowdsec.resilience import CircuitOpenError
+from tests.fake_lapi import FakeLAPI
+
+
+class TestQueryClient(unittest.TestCase):
+    def setUp(self):
+        self.lapi = FakeLAPI().__enter__()
+        self.addCleanup(self.lapi.__exit__, None, None, None)
+        self.lapi.decisions["1.2.3.4"] = [
+            {"id": 1, "type": "ban", "value": "1.2.3.4"},
+            {"id": 2, "type": "captcha", "value": "1.2.3.4"},
+        ]
+
+    def query_count(self):
+        return sum(path == "/v1/decisions" for path, _, _ in self.lapi.requests)
+
+    def test_get_action_for(self):
+        client = QueryClient("abcd", lapi_url=self.lapi.url)
+        assert client.get_action_for("1.2.3.4") == "captcha"
+        assert client.get_action_for("1.2.3.5") is None
+        assert client.get_action_for("1.2.3.4") == "captcha"
+        assert self.query_count() == 3
+        assert client.stats()["hits"] == 0
+
+    def test_cache(self):
+        client = QueryClient("abcd", lapi_url=self.lapi.url, cache_size=2, negative_cache_ttl=0)
+        for _ in range(3):
+            assert client.get_action_for("1.2.3.4") == "captcha"
+            assert client.get_action_for("1.2.3.5") is None
+        # Misses aren't cached for long.
+        assert self.query_count() == 4
+        assert client.stats() == {
+            "hits": 2,
+            "misses": 4,
+            "coalesced": 0,
+            "cached": 2,
+            "hit_ratio": 2 / 6,
+            "breaker": "closed",
+        }
+
+    def test_cache_is_bounded(self):
+        client = QueryClient("abcd", lapi_url=self.lapi.url, cache_size=2)
+        for item in ("1.1.1.1", "2.2.2.2", "1.1.1.1", "3.3.3.3"):
+            client.get_action_for(item)
+        assert list(client.results) == ["1.1.1.1", "3.3.3.3"]
+
+    def test_cache_ttl(self):
+        client = QueryClient("abcd", lapi_url=self.lapi.url, cache_size=10, cache_ttl=0.05)
+        client.get_action_for("1.2.3.4")
+        client.get_action_for("1.2.3.4")
+        time.sleep(0.1)
+        client.get_action_for("1.2.3.4")
+        assert self.query_count() == 2
+
+    def test_concurrent_queries_are_coalesced(self):
+        self.lapi.delay = 0.2
+        client = QueryClient("abcd", lapi_url=self.lapi.url)
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(client.get_action_for("1.2.3.4")))
+            for _ in range(10)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == ["captcha"] * 10
+        assert self.query_count() == 1
+        assert client.stats()["coalesced"] == 9
+        assert client.in_flight == {}
+
+    def test_errors_are_shared_and_not_cached(self):
+        client = QueryClient("abcd", lapi_url=self.lapi.url + "missing/", cache_size=10)
+        for _ in range(2):
+            with self.assertRaises(HTTPError):
+                client.get_action_for("1.2.3.4")
+        assert client.stats()["cached"] == 0
+
+    def test_transient_errors_are_retried(self):
+        self.lapi.errors = [503, 502]
+        client = QueryClient("abcd", lapi_url=self.lapi.url, retries=2, retry_backoff=0.01)
+        assert client.get_action_for("1.2.3.4") == "captcha"
+        assert self.query_count() == 3
+
+        self.lapi.errors = [503, 503, 503]
+        with self.assertRaises(HTTPError):
+            client.get_action_for("1.2.3.4")
+        assert self.query_count() == 6
+
+    def test_client_errors_are_not_retried(self):
+        self.lapi.errors = [403]
+        client = QueryClient("abcd", lapi_url=self.lapi.url, breaker_threshold=1)
+        with self.assertRaises(HTTPError):
+            client.get_action_for("1.2.3.4")
+        assert self.query_count() == 1
+        assert client.stats()["breaker"] == "closed"
+
+    def test_timeout_and_deadline(self):
+        self.lapi.delay = 0.5
+        client = QueryClient("abcd", lapi_url=self.lapi.url, timeout=0.05, retries=0)
+        with self.assertRaises(Timeout):
+            client.get_action_for("1.2.3.4")
+
+        client = QueryClient(
+            "abcd", lapi_url=self.lapi.url, timeout=1, deadline=0.1, retries=10, retry_backoff=0
+        )
+        start = time.monotonic()
+        with self.assertRaises(Timeout):
+            client.get_action_for("1.2.3.4")
+        assert time.monotonic() - start < 0.4
+
+    def test_circuit_breaker(self):
+        self.lapi.errors = [503] * 3
+        client = QueryClient(
+            "abcd",
+            lapi_url=self.lapi.url,
+            retries=0,
+            breaker_threshold=3,
+            breaker_reset_timeout=0.1,
+        )
+        for _ in range(3):
+            with self.assertRaises(HTTPError):
+                client.get_action_for("1.2.3.4")
+        # LAPI isn't queried anymore until the reset timeout.
+        with self.assertRaises(CircuitOpenError):
+            client.get_action_for("1.2.3.4")
+        assert self.query_count() == 3
+        assert client.stats()["breaker"] == "open"
+
+        time.sleep(0.1)
+        assert client.get_action_for("1.2.3.4") == "captcha"
+        assert client.stats()["breaker"] == "closed"
+
+    def test_failure_policy(self):
+        for policy, action in (("open", None), ("closed", "ban")):
+            self.lapi.errors = [503]
+            client = QueryClient(
+                "abcd",
+                lapi_url=self.lapi.url,
+                retries=0,
+                breaker_threshold=1,
+                failure_policy=policy,
+            )
+            assert client.get_action_for("1.2.3.4") == action
+            assert client.get_action_for("1.2.3.4") == action
+        assert self.query_count() == 2
+
+        with self.assertRaises(ValueError):
+            QueryClient("abcd", failure_policy="ignore")
+
+    def test_get_actions_for(self):
+        self.lapi.delay = 0.05
+        client = QueryClient("abcd", lapi_url=self.lapi.url, max_concurrency=4)
+        items = (f"1.2.3.{i}" for i in range(5, 25))
+        results = dict(client.get_actions_for(itertools.chain(["1.2.3.4"], items)))
+        assert len(results) == 21
+        assert results["1.2.3.4"] == "captcha"
+        assert results["1.2.3.5"] is None
+        assert self.lapi.max_concurrent == 4
+
+    def test_get_actions_for_max_in_flight(self):
+        self.lapi.delay = 0.05
+        client = QueryClient("abcd", lapi_url=self.lapi.url, max_concurrency=4)
+        results = list(client.get_actions_for([f"1.2.3.{i}" for i in range(6)], max_in_flight=2))
+        assert len(results) == 6
+        assert self.lapi.max_concurrent == 2
+
+    def test_get_actions_for_stops_early(self):
+        client = QueryClient("abcd", lapi_url=self.lapi.url, max_concurrency=2)
+        results = client.get_actions_for(f"1.2.3.{i}" for i in range(100))
+        next(results)
+        results.close()
+        assert self.query_count() <= 4
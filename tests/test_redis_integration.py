@@ -2,7 +2,7 @@ import unittest
 
 from redislite import Redis
 
-from pycrowdsec.cache import RedisCache
+from pycrowdsec.cache import RedisCache, item_to_key, item_to_string
 
 
 class TestRedisIntegration(unittest.TestCase):
@@ -15,6 +15,7 @@ class TestRedisIntegration(unittest.TestCase):
         self.cache.insert("124122", "ban")
         assert self.redis.exists("pycrowdsec_cache")
         assert self.redis.hget("pycrowdsec_cache", b"normal_124122") == b"ban"
+        assert self.cache.get("124122") == "ban"
 
     def test_ip_to_redis(self):
         self.cache.insert("1.2.3.4", "captcha")
@@ -49,3 +50,254 @@ class TestRedisIntegration(unittest.TestCase):
         assert resp["1.2.3.4/32"] == "captcha"
         assert resp["TH"] == "ban"
         assert resp["::ffff/128"] == "captcha"
+
+    def test_apply_delta(self):
+        self.cache.insert("1.2.3.4", "captcha")
+        self.cache.insert("TH", "ban")
+
+        self.cache.apply_delta(
+            deleted=["1.2.3.4", "TH", "5.6.7.8"],
+            new=[("1.2.3.4", "ban"), ("::ffff", "captcha")],
+        )
+        assert self.cache.get_all() == {"1.2.3.4/32": "ban", "::ffff/128": "captcha"}
+
+        self.cache.delete_many(["1.2.3.4", "::ffff"])
+        self.cache.insert_many([])
+        assert self.redis.hlen("pycrowdsec_cache") == 0
+
+    def test_apply_delta_replace(self):
+        self.cache.apply_delta(new=[("1.2.3.4", "ban", 100), ("::/64", "ban"), ("CN", "ban")])
+        self.cache.insert("FR", "ban", scope="country")
+        self.cache.apply_delta(new=[("1.2.3.0/24", "captcha")], replace=True)
+        assert self.cache.get_all() == {"1.2.3.0/24": "captcha"}
+        assert self.cache.get("1.2.3.4") == "captcha"
+        assert self.cache.scopes == []
+        assert self.redis.zcard("pycrowdsec_cache_expiry") == 0
+        assert self.redis.hgetall("pycrowdsec_cache_prefixes") == {
+            b"complete": b"1",
+            b"ipv4_4294967040": b"1",
+        }
+
+    def test_apply_delta_priority(self):
+        cache = RedisCache(redis_connection=self.redis, chunk_size=2)
+        new = [
+            ("1.2.3.4", "ban", 100),
+            ("1.2.3.4", "captcha", 200),
+            ("::/64", "ban", 300.5),
+            ("::/64", "ban", 100),
+            ("CN", "captcha"),
+            ("CN", "ban", 100),
+            ("CN", "ban"),
+        ]
+        for replace in (True, False):
+            cache.insert_many([("1.2.3.4", "throttle"), ("::/64", "captcha")])
+            cache.apply_delta(new=new, replace=replace, priority=("ban", "captcha"))
+            assert cache.get_all() == {"1.2.3.4/32": "ban", "::/64": "ban", "CN": "ban"}
+            assert self.redis.zscore("pycrowdsec_cache_expiry", item_to_string("::/64")) == 300.5
+            assert cache.expire(now=150) == 1
+            assert cache.get_all() == {"::/64": "ban", "CN": "ban"}
+        assert self.redis.hget("pycrowdsec_cache_prefixes", "ipv4_4294967295") is None
+
+    def test_replace_is_staged(self):
+        cache = RedisCache(redis_connection=self.redis, chunk_size=2)
+        cache.apply_delta(new=[("1.2.3.4", "ban", 100), ("CN", "ban")])
+        generation = int(self.redis.get("pycrowdsec_cache_generation"))
+
+        def new():
+            for i in range(5):
+                yield f"10.0.0.{i}", "captcha", 200
+                # Earlier chunks were sent, but aren't visible yet.
+                assert self.redis.hgetall("pycrowdsec_cache") == {
+                    b"ipv4_4294967295_16909060": b"ban",
+                    b"normal_CN": b"ban",
+                }
+                assert int(self.redis.get("pycrowdsec_cache_generation")) == generation
+            yield item_to_key("FR", "country"), "ban"
+
+        cache.apply_delta(new=new(), replace=True)
+        assert len(cache) == 6
+        assert cache.get("10.0.0.4") == "captcha"
+        assert cache.get("FR") == "ban"
+        assert cache.scopes == ["country"]
+        assert self.redis.zcard("pycrowdsec_cache_expiry") == 5
+        assert self.redis.ttl("pycrowdsec_cache") == -1
+        assert sorted(self.redis.keys("pycrowdsec_cache*")) == [
+            b"pycrowdsec_cache",
+            b"pycrowdsec_cache_expiry",
+            b"pycrowdsec_cache_generation",
+            b"pycrowdsec_cache_prefixes",
+            b"pycrowdsec_cache_scopes",
+        ]
+
+        # Without any decision, the keys are deleted.
+        cache.apply_delta(replace=True)
+        assert sorted(self.redis.keys("pycrowdsec_cache*")) == [
+            b"pycrowdsec_cache_generation",
+            b"pycrowdsec_cache_prefixes",
+        ]
+
+    def test_failed_replace_keeps_the_stored_items(self):
+        cache = RedisCache(redis_connection=self.redis, chunk_size=2)
+        cache.insert("1.2.3.4", "ban")
+
+        def new():
+            yield from [("10.0.0.1", "ban"), ("10.0.0.2", "ban"), ("10.0.0.3", "ban")]
+            raise ConnectionError("connection lost")
+
+        with self.assertRaises(ConnectionError):
+            cache.apply_delta(new=new(), replace=True)
+        assert cache.get_all() == {"1.2.3.4/32": "ban"}
+        assert b"pycrowdsec_cache_staging" not in b" ".join(self.redis.keys())
+
+    def test_apply_delta_in_chunks(self):
+        cache = RedisCache(redis_connection=self.redis, chunk_size=7)
+        items = [f"10.0.0.{i}" for i in range(50)]
+        cache.insert_many((item, "ban") for item in items)
+        assert len(cache) == 50
+        assert cache.get("10.0.0.49") == "ban"
+
+        cache.apply_delta(deleted=iter(items[:45]), new=[("TH", "captcha")])
+        assert len(cache) == 6
+
+
+class TestRedisLocalCache(unittest.TestCase):
+    def setUp(self):
+        self.redis = Redis()
+        self.writer = RedisCache(redis_connection=self.redis)
+        self.reader = RedisCache(
+            redis_connection=self.redis, local_cache_size=2, generation_check_interval=3600
+        )
+
+    def test_results_are_cached_until_generation_changes(self):
+        self.writer.insert("1.2.3.4", "ban")
+        assert self.reader.get("1.2.3.4") == "ban"
+        assert self.reader.get("5.6.7.8") is None
+
+        # Bypasses the generation counter, so the reader keeps serving its local results.
+        self.redis.hset("pycrowdsec_cache", "ipv4_4294967295_84281096", "captcha")
+        self.redis.hdel("pycrowdsec_cache", "ipv4_4294967295_16909060")
+        assert self.reader.get("1.2.3.4") == "ban"
+        assert self.reader.get("5.6.7.8") is None
+
+        self.writer.delete("::1")
+        assert self.reader.get("5.6.7.8") is None
+        self.reader.check_generation(force=True)
+        assert self.reader.get("1.2.3.4") is None
+        assert self.reader.get("5.6.7.8") == "captcha"
+
+    def test_own_writes_are_seen_immediately(self):
+        assert self.reader.get("1.2.3.4") is None
+        self.reader.insert("1.2.3.4", "ban")
+        assert self.reader.get("1.2.3.4") == "ban"
+
+    def test_local_cache_is_bounded(self):
+        for item in ("1.1.1.1", "2.2.2.2", "3.3.3.3", "2.2.2.2"):
+            self.reader.get(item)
+        assert list(self.reader.local_cache) == ["3.3.3.3", "2.2.2.2"]
+
+
+class TestRedisExpiry(unittest.TestCase):
+    def setUp(self):
+        self.redis = Redis()
+        self.cache = RedisCache(redis_connection=self.redis, chunk_size=2)
+
+    def test_expire(self):
+        self.cache.apply_delta(
+            new=[
+                ("1.2.3.4", "ban", 100),
+                ("1.2.3.5", "ban", 100),
+                ("1.2.3.6", "ban", 100),
+                ("::/64", "ban", 200),
+                ("TH", "captcha", None),
+            ]
+        )
+        assert self.redis.zcard("pycrowdsec_cache_expiry") == 4
+        assert self.cache.expire(now=50) == 0
+        assert self.cache.expire(now=150) == 3
+        assert self.cache.get("1.2.3.4") is None
+        assert self.cache.get("::1") == "ban"
+
+        self.cache.insert("::/64", "captcha")
+        assert self.cache.expire(now=10**10) == 0
+        assert len(self.cache) == 2
+        assert self.redis.zcard("pycrowdsec_cache_expiry") == 0
+
+
+class TestRedisScopes(unittest.TestCase):
+    def setUp(self):
+        self.redis = Redis()
+        self.cache = RedisCache(redis_connection=self.redis)
+
+    def test_scoped_lookup(self):
+        self.cache.insert("CN", "captcha", scope="Country")
+        self.cache.insert("1234", "ban", scope="as")
+        self.cache.insert("1.2.3.0/24", "ban", scope="range")
+        assert self.redis.hget("pycrowdsec_cache", "country_CN") == b"captcha"
+
+        assert self.cache.get("CN", scope="country") == "captcha"
+        assert self.cache.get("CN", scope="as") is None
+        assert self.cache.get("1.2.3.4", scope="ip") == "ban"
+        assert self.cache.get("CN") == "captcha"
+
+    def test_unscoped_lookup_sees_scopes_of_other_writers(self):
+        writer = RedisCache(redis_connection=self.redis)
+        assert self.cache.get("CN") is None
+        writer.insert("CN", "captcha", scope="country")
+        self.cache.check_generation(force=True)
+        assert self.cache.get("CN") == "captcha"
+
+    def test_scope_with_separator(self):
+        self.cache.insert("a_b", "ban", scope="my_scope")
+        assert self.cache.get("a_b", scope="my_scope") == "ban"
+        assert self.cache.get_all() == {"a_b": "ban"}
+
+
+class TestRedisPrefixes(unittest.TestCase):
+    def setUp(self):
+        self.redis = Redis()
+        self.cache = RedisCache(redis_connection=self.redis)
+
+    def prefix_counts(self):
+        return {
+            key.decode(): int(value)
+            for key, value in self.redis.hgetall("pycrowdsec_cache_prefixes").items()
+        }
+
+    def test_counts_are_maintained(self):
+        self.cache.insert_many([("1.2.3.4", "ban"), ("1.2.3.5", "ban"), ("1.2.3.0/24", "ban")])
+        self.cache.insert("1.2.3.4", "captcha")
+        self.cache.insert("CN", "ban", scope="country")
+        assert self.prefix_counts() == {
+            "complete": 1,
+            "ipv4_4294967295": 2,
+            "ipv4_4294967040": 1,
+        }
+
+        self.cache.delete_many(["1.2.3.4", "1.2.3.0/24", "1.2.3.0/24"])
+        assert self.prefix_counts() == {"complete": 1, "ipv4_4294967295": 1}
+
+        self.cache.apply_delta(new=[("::1", "ban", 100)])
+        self.cache.expire(now=200)
+        assert self.prefix_counts() == {"complete": 1, "ipv4_4294967295": 1}
+
+    def test_lookup_only_checks_stored_prefixes(self):
+        self.cache.insert("1.2.3.0/24", "ban")
+        fields = []
+        lookup_fields = self.cache.lookup_fields
+        self.cache.lookup_fields = lambda f: fields.append(f) or lookup_fields(f)
+
+        assert self.cache.get("1.2.3.4") == "ban"
+        assert fields == [["ipv4_4294967040_16909056"]]
+        assert self.cache.get("::1") is None
+        assert len(fields) == 1
+
+    def test_counts_existing_fields(self):
+        # Written by a version which didn't count prefixes.
+        self.redis.hset("pycrowdsec_cache", "ipv6_0_0", "ban")
+        self.redis.hset("pycrowdsec_cache", "normal_CN", "ban")
+        assert self.cache.get("::1") == "ban"
+
+        self.cache.insert("1.2.3.4", "ban")
+        assert self.prefix_counts() == {"complete": 1, "ipv6_0": 1, "ipv4_4294967295": 1}
+        assert self.cache.get("::1") == "ban"
+        assert self.cache.get("1.2.3.4") == "ban"
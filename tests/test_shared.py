@@ -0,0 +1,113 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from pycrowdsec.shared import SharedCache
+from tests import test_cache
+
+
+class SharedCacheMixin:
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache = SharedCache(os.path.join(directory.name, "decisions"), writer=True)
+
+
+class TestSharedIPv4Cache(SharedCacheMixin, test_cache.TestIPv4Cache):
+    pass
+
+
+class TestSharedIPv6Cache(SharedCacheMixin, test_cache.TestIPv6Cache):
+    pass
+
+
+class TestSharedCache(SharedCacheMixin, test_cache.TestCache):
+    pass
+
+
+class TestSharedCacheTransaction(SharedCacheMixin, test_cache.TestCacheTransaction):
+    pass
+
+
+class TestSharedCacheBulk(SharedCacheMixin, test_cache.TestCacheBulk):
+    pass
+
+
+class TestSharedCacheExpiry(SharedCacheMixin, test_cache.TestCacheExpiry):
+    pass
+
+
+class TestSharedCacheScopes(SharedCacheMixin, test_cache.TestCacheScopes):
+    pass
+
+
+class TestSharedCacheReader(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "decisions")
+        self.writer = SharedCache(self.path, writer=True)
+        self.reader = SharedCache(self.path, check_interval=3600)
+
+    def test_reader_sees_published_table(self):
+        assert self.reader.get("1.2.3.4") is None
+        self.writer.insert_many(
+            [
+                ("1.2.3.0/24", "ban"),
+                ("1.2.3.4", "captcha"),
+                ("2001:db8::/32", "ban"),
+                ("CN", "captcha"),
+                (("country", "FR"), "ban"),
+            ]
+        )
+        # Not checked again before check_interval.
+        assert self.reader.get("1.2.3.4") is None
+
+        self.reader.refresh(force=True)
+        assert self.reader.get("1.2.3.4") == "captcha"
+        assert self.reader.get("1.2.3.5") == "ban"
+        assert self.reader.get("2001:db8::1") == "ban"
+        assert self.reader.get("CN") == "captcha"
+        assert self.reader.get("FR", scope="country") == "ban"
+        assert self.reader.get_all() == self.writer.get_all()
+        assert len(self.reader) == 5
+
+    def test_ip_decisions_are_not_copied(self):
+        self.writer.insert("1.2.3.4", "ban")
+        self.reader.refresh(force=True)
+        assert isinstance(self.reader.table.intervals[4].nets.values, memoryview)
+
+    def test_reader_keeps_table_until_replaced(self):
+        self.writer.insert("1.2.3.4", "ban")
+        self.reader.refresh(force=True)
+        table = self.reader.table
+        self.reader.refresh(force=True)
+        assert self.reader.table is table
+
+        self.writer.delete("1.2.3.4")
+        assert table.get("1.2.3.4") == "ban"
+        self.reader.refresh(force=True)
+        assert self.reader.get("1.2.3.4") is None
+
+    def test_unchanged_table_is_not_published_again(self):
+        self.writer.insert("1.2.3.4", "ban")
+        mtime = os.stat(self.path).st_mtime_ns
+        self.writer.apply_delta()
+        self.writer.delete("CN")
+        assert os.stat(self.path).st_mtime_ns == mtime
+
+    def test_reader_cant_be_written_to(self):
+        with self.assertRaises(RuntimeError):
+            self.reader.insert("1.2.3.4", "ban")
+
+    def test_loaded_table_can_be_written_to(self):
+        self.writer.insert_many([("1.2.3.4", "ban"), ("CN", "captcha")])
+        self.reader.refresh(force=True)
+        self.reader.writer = True
+        self.reader.insert_many([("1.2.3.5", "captcha"), ("::1", "ban")])
+        self.reader.delete("CN")
+        assert self.reader.get_all() == {
+            "1.2.3.4/32": "ban",
+            "1.2.3.5/32": "captcha",
+            "::1/128": "ban",
+        }
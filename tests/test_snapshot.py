@@ -0,0 +1,125 @@
+import os
+import random
+import tempfile
+import threading
+import unittest
+
+from pycrowdsec.cache import Cache, CompactTable, DecisionTable
+from pycrowdsec.client import StreamClient
+from pycrowdsec.snapshot import load_snapshot, load_table, save_snapshot, write_table
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "snapshot")
+
+    def test_save_load(self):
+        for compact in (False, True):
+            cache = Cache(compact=compact)
+            cache.apply_delta(
+                new=[
+                    ("1.2.3.0/24", "ban", 100),
+                    ("1.2.3.4", "captcha"),
+                    ("::1", "ban", 200),
+                    (("country", "CN"), "captcha", 100),
+                ]
+            )
+            save_snapshot(cache, self.path)
+
+            loaded = Cache(compact=compact)
+            assert load_snapshot(loaded, self.path)
+            assert loaded.get_all() == cache.get_all()
+            assert loaded.get("1.2.3.5") == "ban"
+            assert loaded.get("CN", scope="country") == "captcha"
+            assert isinstance(loaded.table.intervals[4].nets.values, memoryview)
+
+            assert loaded.expire(now=150) == 2
+            assert loaded.get_all() == {"1.2.3.4/32": "captcha", "::1/128": "ban"}
+
+    def test_missing_snapshot(self):
+        assert not load_snapshot(Cache(), self.path)
+
+    def test_loaded_cache_can_be_written_to(self):
+        cache = Cache()
+        cache.insert_many([("1.2.3.4", "ban"), ("CN", "captcha")])
+        save_snapshot(cache, self.path)
+
+        loaded = Cache()
+        load_snapshot(loaded, self.path)
+        loaded.insert("1.2.3.5", "captcha")
+        loaded.delete("CN")
+        assert loaded.get_all() == {"1.2.3.4/32": "ban", "1.2.3.5/32": "captcha"}
+        assert isinstance(loaded.table, CompactTable)
+
+        # A replacing delta starts from a table of the configured kind.
+        loaded.apply_delta(new=[("1.2.3.6", "ban")], replace=True)
+        assert isinstance(loaded.table, DecisionTable)
+        assert loaded.get_all() == {"1.2.3.6/32": "ban"}
+
+    def test_random_against_cache(self):
+        rng = random.Random(11)
+        cache = Cache()
+        items = []
+        for _ in range(500):
+            version = rng.choice((4, 6))
+            bits = 32 if version == 4 else 128
+            plen = rng.randint(bits - 12, bits)
+            net = (rng.getrandbits(12) << (bits - 12)) & ~((1 << (bits - plen)) - 1)
+            items.append(((version, net, plen), rng.choice(("ban", "captcha", "throttle"))))
+        cache.insert_many(items)
+        write_table(cache.table, self.path)
+
+        with open(self.path, "rb") as file:
+            table = load_table(file.read())
+        for _ in range(2000):
+            version = rng.choice((4, 6))
+            bits = 32 if version == 4 else 128
+            address = (rng.getrandbits(12) << (bits - 12)) | rng.getrandbits(bits - 12)
+            assert table.lookup_ip(version, address) == cache.table.lookup_ip(version, address)
+
+
+class TestStreamClientWarmStart(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "snapshot")
+
+    def test_warm_start(self):
+        client = StreamClient("abcd", snapshot_path=self.path)
+        client.process_response(
+            {"deleted": None, "new": [{"scope": "Ip", "type": "ban", "value": "1.2.3.4"}]}
+        )
+        client.save_snapshot()
+
+        client = StreamClient("abcd", snapshot_path=self.path)
+        cycled = threading.Event()
+        cycles = []
+
+        def cycle(first_time):
+            cycles.append((first_time, client.resync))
+            cycled.set()
+
+        client.cycle = cycle
+        client.run()
+        # Decisions are served before LAPI is queried, which happens in the background with a
+        # startup request.
+        assert client.get_action_for("1.2.3.4") == "ban"
+        assert cycled.wait(5)
+        assert cycles[0] == ("false", True)
+
+    def test_snapshot_interval(self):
+        client = StreamClient("abcd", snapshot_path=self.path, snapshot_interval=3600)
+        client.process_response(
+            {"deleted": None, "new": [{"scope": "Ip", "type": "ban", "value": "1.2.3.4"}]}
+        )
+        client.save_snapshot()
+        client.process_response(
+            {"deleted": None, "new": [{"scope": "Ip", "type": "ban", "value": "1.2.3.5"}]}
+        )
+        client.save_snapshot()
+
+        cache = Cache()
+        load_snapshot(cache, self.path)
+        assert cache.get_all() == {"1.2.3.4/32": "ban"}
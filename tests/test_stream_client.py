@@ -1,8 +1,14 @@
 import ipaddress
+import os
+import tempfile
 import threading
+import time
 import unittest
 
-from pycrowdsec.client import StreamClient
+from pycrowdsec.cache import item_to_key
+from pycrowdsec.client import StreamClient, coalesce_delta
+from pycrowdsec.shared import SharedCache
+from tests.fake_lapi import FakeLAPI
 
 
 class TestStreamClient(unittest.TestCase):
@@ -50,6 +56,273 @@ class TestStreamClient(unittest.TestCase):
         self.client.process_response(response)
         assert len(self.client.cache) == 0
 
+    def test_coalesce_delta(self):
+        response = {
+            "deleted": [
+                {"scope": "Ip", "type": "ban", "value": "1.2.3.4"},
+                {"scope": "Ip", "type": "ban", "value": "1.2.3.5"},
+                {"scope": "Ip", "type": "captcha", "value": "1.2.3.5"},
+            ],
+            "new": [
+                {"scope": "Ip", "type": "captcha", "value": "1.2.3.4", "duration": "1h"},
+                {"scope": "Ip", "type": "ban", "value": "1.2.3.4", "duration": "1h"},
+                {"scope": "Ip", "type": "ban", "value": "1.2.3.4", "duration": "2h"},
+                {"scope": "Ip", "type": "captcha", "value": "1.2.3.4"},
+                {"scope": "Country", "type": "custom", "value": "CN"},
+                {"scope": "Country", "type": "throttle", "value": "CN"},
+                {"scope": "Country", "type": "other", "value": "CN"},
+            ],
+        }
+        deleted, new = coalesce_delta(response, 0)
+        # 1.2.3.4 is inserted again, and deleted keys are only deleted once.
+        assert deleted == [item_to_key("1.2.3.5")]
+        # The longest ban wins over captchas, then known types over other ones.
+        assert [(decision.key, decision.type, decision.deadline) for decision in new] == [
+            (item_to_key("1.2.3.4"), "ban", 7200),
+            (item_to_key("CN", "country"), "throttle", None),
+        ]
+
+    def test_process_response_writes_once(self):
+        calls = []
+        apply_delta = self.client.cache.apply_delta
+
+        def record_apply_delta(deleted, new, replace):
+            calls.append((list(deleted), list(new), replace))
+            apply_delta(calls[-1][0], calls[-1][1], replace)
+
+        self.client.cache.apply_delta = record_apply_delta
+        self.client.process_response(
+            {
+                "deleted": [{"scope": "Ip", "type": "ban", "value": "1.2.3.4"}] * 2,
+                "new": [
+                    {"scope": "Ip", "type": "captcha", "value": "1.2.3.4"},
+                    {"scope": "Ip", "type": "ban", "value": "1.2.3.4"},
+                ],
+            }
+        )
+        assert calls == [([], [(item_to_key("1.2.3.4"), "ban", None)], False)]
+        assert self.client.get_action_for("1.2.3.4") == "ban"
+
+        # Empty deltas don't touch the cache.
+        self.client.process_response({"deleted": None, "new": None})
+        assert len(calls) == 1
+
+    def test_decision_details(self):
+        client = StreamClient("abcd", decision_details=True)
+        client.process_response(
+            {
+                "deleted": None,
+                "new": [
+                    {
+                        "id": 1,
+                        "origin": "CAPI",
+                        "scenario": "crowdsecurity/ssh-bf",
+                        "scope": "Range",
+                        "type": "ban",
+                        "value": "1.2.3.0/24",
+                        "duration": "1h",
+                    },
+                    {"id": 2, "scope": "Ip", "type": "captcha", "value": "1.2.3.4"},
+                    {"id": 3, "scope": "Country", "type": "captcha", "value": "CN"},
+                ],
+            }
+        )
+        decision = client.get_decision_details("1.2.3.5")
+        assert (decision.id, decision.origin, decision.scenario) == (
+            1,
+            "CAPI",
+            "crowdsecurity/ssh-bf",
+        )
+        assert (decision.version, decision.network, decision.prefix_length) == (4, 0x01020300, 24)
+        assert decision.deadline > time.time()
+        assert decision["value"] == "1.2.3.0/24"
+        # Longest prefix first.
+        assert client.get_decision_details("1.2.3.4").id == 2
+        assert client.get_decision_details("CN").id == 3
+        assert client.get_decision_details("CN", scope="country").id == 3
+        assert client.get_decision_details("1.2.4.1") is None
+
+        client.process_response(
+            {"deleted": [{"scope": "Ip", "type": "captcha", "value": "1.2.3.4"}], "new": None}
+        )
+        assert client.get_decision_details("1.2.3.4").id == 1
+        assert client.get_action_for("1.2.3.4") == "ban"
+
+        with self.assertRaises(ValueError):
+            self.client.get_decision_details("1.2.3.4")
+
+    def test_scoped_decisions(self):
+        self.client.process_response(
+            {
+                "deleted": None,
+                "new": [
+                    {"scope": "Country", "type": "captcha", "value": "CN"},
+                    {"scope": "AS", "type": "ban", "value": "1234"},
+                    {"scope": "Range", "type": "ban", "value": "1.2.3.0/24"},
+                ],
+            }
+        )
+        assert self.client.get_action_for("CN", scope="country") == "captcha"
+        assert self.client.get_action_for("CN", scope="as") is None
+        assert self.client.get_action_for("1.2.3.4") == "ban"
+        assert self.client.get_action_for("1234", scope="AS") == "ban"
+
+        self.client.process_response(
+            {"deleted": [{"scope": "Country", "type": "captcha", "value": "CN"}], "new": None}
+        )
+        assert self.client.get_action_for("CN") is None
+
+    def test_decisions_expire(self):
+        self.client.process_response(
+            {
+                "deleted": None,
+                "new": [
+                    {"duration": "-1s", "type": "ban", "value": "1.2.3.4"},
+                    {"duration": "4h", "type": "ban", "value": "1.2.3.5"},
+                    {"type": "captcha", "value": "1.2.3.6"},
+                ],
+            }
+        )
+        assert self.client.cache.expire() == 1
+        assert self.client.get_current_decisions() == {
+            "1.2.3.5/32": "ban",
+            "1.2.3.6/32": "captcha",
+        }
+
+    def test_streamed_startup_keeps_the_strongest_decision(self):
+        self.client.startup = True
+        self.client.process_decisions(
+            [
+                ("new", {"duration": "4h", "type": "ban", "value": "1.2.3.4"}),
+                ("new", {"duration": "1s", "type": "captcha", "value": "1.2.3.4"}),
+                ("new", {"duration": "1s", "type": "ban", "value": "1.2.3.5"}),
+                ("new", {"duration": "4h", "type": "ban", "value": "1.2.3.5"}),
+            ]
+        )
+        self.client.startup = False
+        assert self.client.cache.expire(time.time() + 60) == 0
+        assert self.client.get_current_decisions() == {"1.2.3.4/32": "ban", "1.2.3.5/32": "ban"}
+
+    def test_shared_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "decisions")
+            client = StreamClient("abcd", shared_cache_path=path)
+            client.process_response(
+                {"deleted": None, "new": [{"scope": "Ip", "type": "ban", "value": "1.2.3.4"}]}
+            )
+            assert SharedCache(path).get("1.2.3.4") == "ban"
+
+    def test_cycles(self):
+        with FakeLAPI() as lapi:
+            client = StreamClient("abcd", lapi_url=lapi.url)
+            lapi.stream_responses["true"] = {
+                "new": [
+                    {"scope": "Ip", "type": "ban", "value": "1.2.3.4"},
+                    {"scope": "Country", "type": "captcha", "value": "CN"},
+                ],
+                "deleted": [{"scope": "Ip", "type": "ban", "value": "1.2.3.4"}],
+            }
+            client.cycle("true")
+            assert client.get_current_decisions() == {"1.2.3.4/32": "ban", "CN": "captcha"}
+
+            lapi.stream_responses["false"] = {
+                "new": [{"scope": "Ip", "type": "captcha", "value": "1.2.3.5"}],
+                "deleted": [{"scope": "Country", "type": "captcha", "value": "CN"}],
+            }
+            client.cycle("false")
+            assert client.get_current_decisions() == {
+                "1.2.3.4/32": "ban",
+                "1.2.3.5/32": "captcha",
+            }
+
+            # A resync replaces every decision.
+            client.resync = True
+            client.cycle("false")
+            assert client.get_current_decisions() == {"1.2.3.4/32": "ban", "CN": "captcha"}
+            assert [params["startup"] for _, params, _ in lapi.requests] == [
+                "true",
+                "false",
+                "true",
+            ]
+
+    def test_cycle_retries(self):
+        with FakeLAPI() as lapi:
+            lapi.stream_responses["true"] = {
+                "new": [{"scope": "Ip", "type": "ban", "value": "1.2.3.4"}],
+                "deleted": None,
+            }
+            lapi.errors = [503]
+            client = StreamClient("abcd", lapi_url=lapi.url, retry_backoff=0.01)
+            client.cycle("true")
+            assert client.get_current_decisions() == {"1.2.3.4/32": "ban"}
+
+            lapi.errors = [503] * 3
+            with self.assertRaises(Exception):
+                client.cycle("true")
+            assert len(lapi.requests) == 5
+
+    def test_stop_interrupts_retries(self):
+        with FakeLAPI() as lapi:
+            lapi.errors = [503] * 10
+            client = StreamClient("abcd", lapi_url=lapi.url)
+            client.retry_delay = lambda attempt, error: 30
+            cycle = threading.Thread(target=client.cycle, args=("false",))
+            cycle.start()
+            while not lapi.requests:
+                time.sleep(0.01)
+            client.stop()
+            cycle.join(5)
+            assert not cycle.is_alive()
+            assert len(lapi.requests) == 1
+
+    def test_run_refresh_now_and_stop(self):
+        with FakeLAPI() as lapi:
+            client = StreamClient("abcd", lapi_url=lapi.url, interval=60)
+            client.run()
+            assert client.is_running()
+
+            lapi.stream_responses["false"] = {
+                "new": [{"scope": "Ip", "type": "ban", "value": "1.2.3.4"}],
+                "deleted": None,
+            }
+            client.refresh_now()
+            for _ in range(100):
+                if client.get_action_for("1.2.3.4"):
+                    break
+                time.sleep(0.01)
+            assert client.get_action_for("1.2.3.4") == "ban"
+
+            client.stop()
+            assert not client.is_running()
+
+    def test_adaptive_interval(self):
+        client = StreamClient("abcd", interval=10, min_interval=2, max_interval=30)
+        intervals = []
+        for changed in (False, False, None, False, True, False):
+            client.changed = changed
+            client.update_interval()
+            intervals.append(client.next_interval)
+        assert intervals == [20, 30, 30, 30, 2, 4]
+
+        client = StreamClient("abcd", interval=10)
+        for changed in (True, False):
+            client.changed = changed
+            client.update_interval()
+            assert client.next_interval == 10
+
+    @unittest.skipUnless(hasattr(os, "register_at_fork"), "requires os.register_at_fork")
+    def test_restarts_after_fork(self):
+        with FakeLAPI() as lapi:
+            client = StreamClient("abcd", lapi_url=lapi.url, interval=60)
+            client.run()
+            pid = os.fork()
+            if pid == 0:
+                # Threads of the parent don't exist in the child.
+                os._exit(0 if client.is_running() else 1)
+            _, status = os.waitpid(pid, 0)
+            assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+            client.stop()
+
     def test_read_write_race(self):
         response = {
             "deleted": [
@@ -3,6 +3,8 @@ import threading
 import unittest
 
 from pycrowdsec.client import StreamDecisionClient
+from pycrowdsec.decision import Decision
+from tests.fake_lapi import FakeLAPI
 
 
 class TestStreamDecisionClient(unittest.TestCase):
@@ -97,3 +99,97 @@ class TestStreamDecisionClient(unittest.TestCase):
         for _ in range(1000):
             list(self.client.get_deleted_decision())
             list(self.client.get_new_decision())
+
+    def test_startup_cycle(self):
+        with FakeLAPI() as lapi:
+            client = StreamDecisionClient("abcd", lapi_url=lapi.url)
+            decision = {"scope": "Ip", "type": "ban", "value": "1.2.3.4"}
+            lapi.stream_responses["true"] = {"new": [decision], "deleted": None}
+            client.cycle("true")
+            assert list(client.get_new_decision()) == [Decision.from_dict(decision, 0)]
+            assert list(client.get_deleted_decision()) == []
+
+            assert client.get_batch(timeout=0) == []
+
+    def test_get_batch(self):
+        decisions = [{"scope": "Ip", "type": "ban", "value": f"1.2.3.{i}"} for i in range(4)]
+        self.client.process_response({"deleted": decisions[:1], "new": decisions[1:]})
+        decisions = [Decision.from_dict(decision, 0) for decision in decisions]
+        assert self.client.get_batch(2) == [("deleted", decisions[0]), ("new", decisions[1])]
+        assert self.client.get_batch() == [("new", decisions[2]), ("new", decisions[3])]
+        assert self.client.get_batch(timeout=0.01) == []
+
+    def test_startup_marker(self):
+        with FakeLAPI() as lapi:
+            client = StreamDecisionClient("abcd", lapi_url=lapi.url)
+            decision = {"scope": "Ip", "type": "ban", "value": "1.2.3.4"}
+            lapi.stream_responses["true"] = {"new": [decision], "deleted": None}
+            client.cycle("true")
+            assert client.get_batch() == [
+                ("startup", None),
+                ("new", Decision.from_dict(decision, 0)),
+            ]
+
+    def test_drop_backpressure(self):
+        with FakeLAPI() as lapi:
+            client = StreamDecisionClient(
+                "abcd", lapi_url=lapi.url, max_queue_size=2, backpressure="drop"
+            )
+            decisions = [{"scope": "Ip", "type": "ban", "value": f"1.2.3.{i}"} for i in range(3)]
+            lapi.stream_responses["false"] = {"new": decisions, "deleted": None}
+            client.cycle("false")
+            assert client.dropped == 1
+            decisions = [Decision.from_dict(decision, 0) for decision in decisions]
+            assert client.get_batch() == [("new", decisions[0]), ("new", decisions[1])]
+
+            # The next cycle fetches every active decision again.
+            lapi.stream_responses["true"] = {
+                "new": [{"scope": "Ip", "type": "ban", "value": "1.2.3.0"}],
+                "deleted": None,
+            }
+            client.cycle("false")
+            assert [params["startup"] for _, params, _ in lapi.requests] == ["false", "true"]
+            assert client.get_batch() == [("startup", None), ("new", decisions[0])]
+            assert not client.resync
+
+        with self.assertRaises(ValueError):
+            StreamDecisionClient("abcd", backpressure="ignore")
+
+    def test_block_backpressure(self):
+        client = StreamDecisionClient("abcd", max_queue_size=1)
+        decisions = [{"scope": "Ip", "type": "ban", "value": f"1.2.3.{i}"} for i in range(10)]
+        t = threading.Thread(
+            target=client.process_response, args=({"deleted": None, "new": decisions},)
+        )
+        t.start()
+        received = []
+        while len(received) < 10:
+            received.extend(decision for _, decision in client.get_batch(timeout=1))
+        t.join()
+        assert [decision.value for decision in received] == [
+            decision["value"] for decision in decisions
+        ]
+        assert client.dropped == 0
+
+    def test_bounded_startup_does_not_block_run(self):
+        with FakeLAPI() as lapi:
+            decisions = [{"scope": "Ip", "type": "ban", "value": f"1.2.3.{i}"} for i in range(20)]
+            lapi.stream_responses["true"] = {"new": decisions, "deleted": None}
+            client = StreamDecisionClient(
+                "abcd", lapi_url=lapi.url, interval=3600, max_queue_size=10
+            )
+            # The consumer runs on the thread which called run().
+            client.run()
+            try:
+                received = []
+                while len(received) < 21:
+                    batch = client.get_batch(timeout=5)
+                    assert batch
+                    received.extend(batch)
+            finally:
+                client.stop()
+        assert received[0] == ("startup", None)
+        assert [decision.value for _, decision in received[1:]] == [
+            decision["value"] for decision in decisions
+        ]
+        assert client.dropped == 0
@@ -0,0 +1,98 @@
+import unittest
+
+from pycrowdsec.client import QueryClient, StreamClient
+from pycrowdsec.tracing import Tracer
+from tests.fake_lapi import FakeLAPI
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        self.spans = []
+        self.tracer = Tracer(
+            hooks=[lambda *span: self.spans.append(span)],
+            opentelemetry=False,
+            slow_lookup_threshold=0.01,
+        )
+
+    def test_span(self):
+        with self.tracer.span("test", a=1) as attributes:
+            attributes["b"] = 2
+        with self.assertRaises(KeyError):
+            with self.tracer.span("failing"):
+                {}["missing"]
+        (name, duration, attributes, error), failing = self.spans
+        assert (name, attributes, error) == ("test", {"a": 1, "b": 2}, None)
+        assert duration >= 0
+        assert failing[0] == "failing" and isinstance(failing[3], KeyError)
+
+    def test_failing_hook_is_ignored(self):
+        def hook(*span):
+            raise ValueError("broken hook")
+
+        self.tracer.add_hook(hook)
+        with self.assertLogs("pycrowdsec.tracing", level="ERROR"):
+            with self.tracer.span("test"):
+                pass
+        assert len(self.spans) == 1
+
+    def test_stream_client_cycle(self):
+        with FakeLAPI() as lapi:
+            lapi.stream_responses["true"] = {
+                "new": [{"scope": "Ip", "type": "ban", "value": "1.2.3.4", "duration": "1h"}],
+                "deleted": None,
+            }
+            lapi.stream_responses["false"] = {
+                "new": [{"scope": "Ip", "type": "ban", "value": "1.2.3.5", "duration": "1h"}],
+                "deleted": None,
+            }
+            client = StreamClient("abcd", lapi_url=lapi.url, tracer=self.tracer)
+            client.cycle("true")
+            client.cycle("false")
+        names = [span[0] for span in self.spans]
+        # Spans end, and call the hooks, from the innermost one.
+        assert names == [
+            "pycrowdsec.fetch",
+            "pycrowdsec.apply_delta",
+            "pycrowdsec.process_decisions",
+            "pycrowdsec.cycle",
+            "pycrowdsec.fetch",
+            "pycrowdsec.decode",
+            "pycrowdsec.apply_delta",
+            "pycrowdsec.process_response",
+            "pycrowdsec.cycle",
+        ]
+        attributes = {span[0]: span[2] for span in self.spans[4:]}
+        assert attributes["pycrowdsec.fetch"]["bytes"] > 0
+        assert attributes["pycrowdsec.process_response"] == {"new": 1, "deleted": 0}
+        assert attributes["pycrowdsec.cycle"] == {"startup": False, "attempts": 1, "changed": True}
+
+    def test_failed_cycle(self):
+        with FakeLAPI() as lapi:
+            lapi.errors = [403]
+            client = StreamClient("abcd", lapi_url=lapi.url, tracer=self.tracer)
+            client.cycle("false")
+        name, _, attributes, error = self.spans[-1]
+        assert name == "pycrowdsec.cycle"
+        # The cycle logs the error instead of raising it.
+        assert error is None
+        assert "403" in attributes["error"]
+
+    def test_slow_lookups(self):
+        with FakeLAPI() as lapi:
+            lapi.decisions["1.2.3.4"] = [{"id": 1, "type": "ban", "value": "1.2.3.4"}]
+            client = QueryClient("abcd", lapi_url=lapi.url, tracer=self.tracer)
+            lapi.delay = 0.05
+            client.get_action_for("1.2.3.4")
+            lapi.delay = 0
+            self.tracer.slow_lookup_threshold = 1
+            client.get_action_for("1.2.3.5")
+        ((timestamp, item, duration),) = self.tracer.slow_lookups
+        assert item == "1.2.3.4" and duration >= 0.05
+        assert [span[0] for span in self.spans] == ["pycrowdsec.slow_lookup"]
+        assert self.spans[0][2] == {"item": "1.2.3.4"}
+
+    def test_slow_lookups_are_bounded(self):
+        tracer = Tracer(opentelemetry=False, slow_lookup_threshold=0, max_slow_lookups=2)
+        for i in range(3):
+            tracer.record_lookup(f"1.2.3.{i}", 0.1)
+        assert [lookup[1] for lookup in tracer.slow_lookups] == ["1.2.3.1", "1.2.3.2"]
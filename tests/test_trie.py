@@ -0,0 +1,86 @@
+import random
+from unittest import TestCase
+
+from pycrowdsec.trie import PrefixTrie
+
+
+def brute_force_lookup(prefixes, addr, bits):
+    best = None
+    for (net, plen), value in prefixes.items():
+        if (addr ^ net) >> (bits - plen) == 0 and (best is None or plen > best[0]):
+            best = (plen, value)
+    return best[1] if best else None
+
+
+class TestPrefixTrie(TestCase):
+    def test_insert_replaces_value(self):
+        trie = PrefixTrie(32)
+        trie.insert(0x01020300, 24, "ban")
+        trie.insert(0x01020300, 24, "captcha")
+        assert len(trie) == 1
+        assert trie.lookup(0x01020304) == "captcha"
+
+    def test_nested_prefixes(self):
+        trie = PrefixTrie(32)
+        trie.insert(0, 0, "a")
+        trie.insert(0x0A000000, 8, "b")
+        trie.insert(0x0A010000, 16, "c")
+        assert trie.lookup(0x0B000000) == "a"
+        assert trie.lookup(0x0A020000) == "b"
+        assert trie.lookup(0x0A01FFFF) == "c"
+
+        assert trie.delete(0x0A000000, 8)
+        assert not trie.delete(0x0A000000, 8)
+        assert trie.lookup(0x0A020000) == "a"
+        assert trie.lookup(0x0A01FFFF) == "c"
+        assert len(trie) == 2
+
+    def test_delete_missing(self):
+        trie = PrefixTrie(32)
+        trie.insert(0x0A000000, 8, "b")
+        assert not trie.delete(0x0A000000, 16)
+        assert not trie.delete(0x0B000000, 8)
+        assert not trie.delete(0, 0)
+        assert len(trie) == 1
+
+    def test_random_against_brute_force(self):
+        rng = random.Random(42)
+        for bits in (32, 128):
+            trie = PrefixTrie(bits)
+            prefixes = {}
+            for _ in range(2000):
+                plen = rng.choice([0, 1, 7, 8, 16, 24, bits - 1, bits])
+                # Only use a handful of distinct high bits so that prefixes overlap.
+                net = (rng.getrandbits(4) << (bits - 4)) | rng.getrandbits(bits - 12)
+                net &= ((1 << plen) - 1) << (bits - plen)
+                if prefixes and rng.random() < 0.3:
+                    net, plen = rng.choice(list(prefixes))
+                    del prefixes[(net, plen)]
+                    assert trie.delete(net, plen)
+                else:
+                    prefixes[(net, plen)] = rng.choice(["ban", "captcha"])
+                    trie.insert(net, plen, prefixes[(net, plen)])
+
+                assert len(trie) == len(prefixes)
+                addr = rng.choice(list(prefixes))[0] if prefixes else 0
+                addr |= rng.getrandbits(4)
+                assert trie.lookup(addr) == brute_force_lookup(prefixes, addr, bits)
+
+            assert {(net, plen): value for net, plen, value in trie.items()} == prefixes
+
+    def test_copy_is_isolated(self):
+        trie = PrefixTrie(32)
+        trie.insert(0x0A000000, 8, "a")
+        trie.insert(0x0A010000, 16, "b")
+        snapshot = trie.copy()
+
+        trie.insert(0x0A010100, 24, "c")
+        trie.delete(0x0A000000, 8)
+        snapshot.insert(0x0A000000, 8, "d")
+
+        assert trie.lookup(0x0A010101) == "c"
+        assert trie.lookup(0x0A020000) is None
+        assert snapshot.lookup(0x0A010101) == "b"
+        assert snapshot.lookup(0x0A020000) == "d"
+        assert len(trie) == 2
+        assert len(snapshot) == 2
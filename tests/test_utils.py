@@ -0,0 +1,18 @@
+from unittest import TestCase
+
+from pycrowdsec.utils import parse_duration
+
+
+class TestParseDuration(TestCase):
+    def test_valid(self):
+        assert parse_duration("4h") == 4 * 3600
+        assert parse_duration("3h59m59s") == 4 * 3600 - 1
+        assert parse_duration("500ms") == 0.5
+        assert parse_duration("0") == 0
+        assert abs(parse_duration("-40h37m10.022674981s") + 146230.022674981) < 1e-6
+
+    def test_invalid(self):
+        for duration in ("", "4", "4x", "h", "4h 2m"):
+            with self.subTest(duration=duration):
+                with self.assertRaises(ValueError):
+                    parse_duration(duration)